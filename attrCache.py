@@ -0,0 +1,84 @@
+"""
+Bounded cache of getattr results with a time-to-live per tier.
+
+Files on primaryFS change under the mount's feet the most, so they get the
+shortest TTL; fallbackFS and the remote tier are read-mostly and can be
+trusted for longer. The mount's own write paths invalidate entries directly.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTLS = {'primary': 1.0, 'fallback': 30.0, 'remote': 60.0}
+
+
+def parse_ttls(text):
+    # "primary=1,fallback=30,remote=60"; tiers not named keep their default
+    ttls = dict(DEFAULT_TTLS)
+    for item in text.split(','):
+        tier, _, seconds = item.partition('=')
+        ttls[tier.strip()] = float(seconds)
+    return ttls
+
+
+class AttrCache:
+    def __init__(self, ttls=None, max_entries=65536, uncached=()):
+        self.ttls = ttls or DEFAULT_TTLS
+        # Tiers whose attributes are never kept, whatever their TTL (see
+        # tierChain.py)
+        self.uncached = uncached
+        self.max_entries = max_entries
+        # partial path -> (expiry, attrs)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, partial):
+        with self.lock:
+            entry = self.entries.get(partial)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(partial)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, partial, tier, attrs, generation=None):
+        ttl = self.ttls.get(tier, 0)
+        if ttl <= 0 or tier in self.uncached:
+            return
+        with self.lock:
+            # Same race as the resolution cache: drop what was read while a
+            # mutation was running
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[partial] = (time.monotonic() + ttl, attrs)
+            self.entries.move_to_end(partial)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, partial):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+
+    def invalidate_tree(self, partial):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
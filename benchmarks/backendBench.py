@@ -0,0 +1,149 @@
+"""
+Remote-tier throughput through the sshfs path and through --backend.
+
+Builds --files files of --size bytes on the remote tier, then, on a fresh
+mount each time:
+
+- stat:  getattr of every file
+- read:  --threads clients open, read in --chunk pieces and release every
+         file, each client taking its share
+
+The sshfs path is the local directory served through
+slowRemote.SlowRemoteOs, which adds --remote-delay to every call reaching
+it, as an SFTP round trip would. The backend runs a remoteBackend
+BackendServer on 127.0.0.1 with the same delay added to every request, and
+the mount talks to it through RemoteClient with 1 and --connections
+connections. Neither side pays for the second FUSE hop of real sshfs, so
+the gap shown is the round trips saved per operation and the overlap of
+pipelined requests, not all of it.
+
+With --readahead the mount keeps several range reads of a file in flight,
+which is where pipelining on few connections shows.
+
+Usage: python3 benchmarks/backendBench.py [--files 64] [--size 1M] [--threads 8] [--remote-delay 0.002]
+                                          [--readahead N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remoteCallBackFuse  # noqa: E402
+from remoteBackend import BackendServer, RemoteClient  # noqa: E402
+from remoteTier import RemoteTier  # noqa: E402
+from slowRemote import SlowRemoteOs, installed  # noqa: E402
+from units import parse_size  # noqa: E402
+
+
+def build(base, files, size):
+    tiers = dict((tier, os.path.join(base, tier)) for tier in ('primary', 'fallback', 'remote'))
+    for tier in tiers.values():
+        os.mkdir(tier)
+    paths = []
+    for i in range(files):
+        with open(os.path.join(tiers['remote'], 'f%04d' % i), 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append('/f%04d' % i)
+    return tiers, paths
+
+
+def workload(ops, paths, threads, chunk):
+    # (stat seconds, read seconds, bytes read)
+    start = time.perf_counter()
+    for path in paths:
+        ops('getattr', path)
+    stat_time = time.perf_counter() - start
+    total = [0]
+    lock = threading.Lock()
+
+    def client(share):
+        read = 0
+        for path in share:
+            fh = ops('open', path, os.O_RDONLY)
+            offset = 0
+            while True:
+                data = ops('read', path, chunk, offset, fh)
+                if not data:
+                    break
+                offset += len(data)
+            ops('release', path, fh)
+            read += offset
+        with lock:
+            total[0] += read
+
+    clients = [threading.Thread(target=client, args=(paths[i::threads],)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return stat_time, time.perf_counter() - start, total[0]
+
+
+def run_sshfs(tiers, paths, args):
+    ops = remoteCallBackFuse.Passthrough(tiers['primary'], tiers['fallback'], local_mount_point=tiers['remote'],
+                                         threads=args.threads, readahead=args.readahead,
+                                         remote=RemoteTier(None, None, tiers['remote'], mount=False))
+    proxy = SlowRemoteOs(tiers['remote'], args.remote_delay)
+    try:
+        with installed(proxy):
+            result = workload(ops, paths, args.threads, args.chunk)
+    finally:
+        ops('destroy', '/')
+    return result + (proxy.delayed + proxy.path.delayed,)
+
+
+def run_backend(tiers, paths, args, connections):
+    server = BackendServer(tiers['remote'], ('127.0.0.1', 0), workers=max(16, args.threads * 2),
+                           delay=args.remote_delay)
+    server.start()
+    client = RemoteClient(server.address, connections)
+    remote = RemoteTier(None, None, None, backend=client)
+    ops = remoteCallBackFuse.Passthrough(tiers['primary'], tiers['fallback'], threads=args.threads,
+                                         readahead=args.readahead, remote=remote, backend=client)
+    try:
+        while not remote.available():
+            time.sleep(0.01)
+        result = workload(ops, paths, args.threads, args.chunk)
+        requests = client.stats()['requests']
+    finally:
+        ops('destroy', '/')
+        server.stop()
+    return result + (requests,)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test tree")
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--size', type=parse_size, default=1 << 20)
+    parser.add_argument('--chunk', type=parse_size, default=128 << 10)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--readahead', type=int, default=0, help="readahead windows, as --readahead of the mount")
+    parser.add_argument('--remote-delay', type=float, default=0.002, help="seconds added to every round trip")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-backend-', dir=args.dir)
+    try:
+        tiers, paths = build(base, args.files, args.size)
+        runs = [('sshfs path', lambda: run_sshfs(tiers, paths, args)),
+                ('backend x1', lambda: run_backend(tiers, paths, args, 1)),
+                ('backend x%d' % args.connections, lambda: run_backend(tiers, paths, args, args.connections))]
+        print("%-14s %12s %12s %12s %14s" % ('mode', 'stat/s', 'read MB/s', 'round trips', 'trips per file'))
+        for name, run in runs:
+            stat_time, read_time, nbytes, trips = run()
+            print("%-14s %12.0f %12.1f %12d %14.1f" % (name, len(paths) / stat_time, nbytes / read_time / 1e6,
+                                                         trips, trips / len(paths)))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
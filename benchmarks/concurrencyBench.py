@@ -0,0 +1,122 @@
+"""
+Local-tier read latency while the remote tier is slow, single vs multi thread.
+
+FUSE is modelled as a pool of worker threads pulling requests off the kernel
+queue: with nothreads=True that pool has one worker, with --threads N it has
+N. A handful of clients keep reading a file on the (artificially slow) remote
+tier while one client reads a primaryFS file and records how long each read
+takes from submission to completion.
+
+Usage: python3 benchmarks/concurrencyBench.py [--threads 8] [--delay 0.05]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remoteCallBackFuse  # noqa: E402
+from remoteTier import RemoteTier  # noqa: E402
+
+
+class SlowRemotePassthrough(remoteCallBackFuse.Passthrough):
+    # Treats a local directory as the sshfs mount and adds a fixed delay to
+    # every read served from it
+    def __init__(self, root, fallbackPath, remote_dir, delay, threads):
+        # Nothing is mounted with sshfs: the directory is the tree already
+        super().__init__(root, fallbackPath, local_mount_point=remote_dir, threads=threads,
+                         remote=RemoteTier(None, None, remote_dir, mount=False))
+        self.delay = delay
+
+    def read(self, path, length, offset, fh):
+        if self._full_path(path).startswith(self.local_mount_point):
+            time.sleep(self.delay)
+        return super().read(path, length, offset, fh)
+
+
+def make_tree(base):
+    tiers = {}
+    for tier in ('primary', 'fallback', 'remote'):
+        tiers[tier] = os.path.join(base, tier)
+        os.mkdir(tiers[tier])
+    with open(os.path.join(tiers['primary'], 'local.bin'), 'wb') as f:
+        f.write(os.urandom(1 << 20))
+    with open(os.path.join(tiers['remote'], 'remote.bin'), 'wb') as f:
+        f.write(os.urandom(1 << 20))
+    return tiers
+
+
+def run(tiers, workers, delay, remote_clients, local_reads):
+    ops = SlowRemotePassthrough(tiers['primary'], tiers['fallback'], tiers['remote'], delay, workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    stop = threading.Event()
+
+    local_fh = ops('open', '/local.bin', os.O_RDONLY)
+    remote_fh = ops('open', '/remote.bin', os.O_RDONLY)
+
+    def remote_client():
+        while not stop.is_set():
+            pool.submit(ops, 'read', '/remote.bin', 131072, 0, remote_fh).result()
+
+    clients = [threading.Thread(target=remote_client) for _ in range(remote_clients)]
+    for t in clients:
+        t.start()
+    # Let the remote clients fill the queue first
+    time.sleep(delay * 2)
+
+    latencies = []
+    for i in range(local_reads):
+        start = time.perf_counter()
+        pool.submit(ops, 'read', '/local.bin', 4096, (i * 4096) % (1 << 20), local_fh).result()
+        latencies.append(time.perf_counter() - start)
+
+    stop.set()
+    for t in clients:
+        t.join()
+    pool.shutdown()
+    ops('release', '/local.bin', local_fh)
+    ops('release', '/remote.bin', remote_fh)
+
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+        'max': latencies[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0.05, help="seconds added to every remote read")
+    parser.add_argument('--remote-clients', type=int, default=4)
+    parser.add_argument('--local-reads', type=int, default=200)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-concurrency-')
+    try:
+        tiers = make_tree(base)
+        print("remote delay %.1f ms, %d remote clients, %d local reads"
+              % (args.delay * 1000, args.remote_clients, args.local_reads))
+        print("%-10s %12s %12s %12s" % ('threads', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+        for workers in (1, args.threads):
+            # The remote code path prints on every read; keep the table readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = run(tiers, workers, args.delay, args.remote_clients, args.local_reads)
+            print("%-10d %12.3f %12.3f %12.3f"
+                  % (workers, result['p50'] * 1000, result['p99'] * 1000, result['max'] * 1000))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
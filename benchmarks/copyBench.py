@@ -0,0 +1,143 @@
+"""
+Large copies and moves inside the mount, with and without the data leaving
+the kernel.
+
+Builds --files files of --size bytes on primaryFS, then, in-process:
+
+- read/write:  open, read in --chunk pieces, write them to a new file and
+               release both, as `cp` does through a libfuse2 binding
+- copy_range:  the same copy as one copy_file_range call per file, as `cp`
+               does through a libfuse3 binding
+- rename:      rename every file into a directory that only exists on
+               fallbackFS, so it lands there, and back
+
+Put fallbackFS on another filesystem with --fallback-dir (e.g. /dev/shm) to
+make the renames cross devices: they then copy in the kernel instead of
+failing with EXDEV. On one filesystem they stay plain renames.
+
+Usage: python3 benchmarks/copyBench.py [--files 4] [--size 64M] [--chunk 128K] [--fallback-dir DIR]
+                                       [--build sampleFuse|remoteCallBackFuse]
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from units import parse_size  # noqa: E402
+
+
+def make_ops(build, primary, fallback):
+    if build == 'sampleFuse':
+        import sampleFuse
+        return sampleFuse.Passthrough(primary, fallback)
+    import remoteCallBackFuse
+    return remoteCallBackFuse.Passthrough(primary, fallback)
+
+
+def read_write(ops, src, dst, chunk):
+    fh_in = ops('open', src, os.O_RDONLY)
+    fh_out = ops('create', dst, 0o644)
+    offset = 0
+    while True:
+        data = ops('read', src, chunk, offset, fh_in)
+        if not data:
+            break
+        ops('write', dst, data, offset, fh_out)
+        offset += len(data)
+    ops('release', src, fh_in)
+    ops('release', dst, fh_out)
+    return offset
+
+
+def copy_range(ops, src, dst, size):
+    fh_in = ops('open', src, os.O_RDONLY)
+    fh_out = ops('create', dst, 0o644)
+    done = 0
+    while done < size:
+        copied = ops('copy_file_range', src, fh_in, done, dst, fh_out, done, size - done, 0)
+        if not copied:
+            break
+        done += copied
+    ops('release', src, fh_in)
+    ops('release', dst, fh_out)
+    return done
+
+
+def digest(ops, path, chunk):
+    # Through the mount: the build decides which tier a path lands on
+    fh = ops('open', path, os.O_RDONLY)
+    h = hashlib.sha1()
+    offset = 0
+    while True:
+        data = ops('read', path, chunk, offset, fh)
+        if not data:
+            break
+        h.update(data)
+        offset += len(data)
+    ops('release', path, fh)
+    return h.digest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create primaryFS")
+    parser.add_argument('--fallback-dir', default=None, help="where to create fallbackFS, default next to primaryFS")
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size', type=parse_size, default=64 << 20)
+    parser.add_argument('--chunk', type=parse_size, default=128 << 10)
+    parser.add_argument('--build', choices=('sampleFuse', 'remoteCallBackFuse'), default='sampleFuse')
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-copy-', dir=args.dir)
+    fallback_base = tempfile.mkdtemp(prefix='fuse-copy-', dir=args.fallback_dir or base)
+    try:
+        primary = os.path.join(base, 'primary')
+        fallback = os.path.join(fallback_base, 'fallback')
+        os.mkdir(primary)
+        os.makedirs(os.path.join(fallback, 'far'))
+        paths = []
+        for i in range(args.files):
+            with open(os.path.join(primary, 'f%d' % i), 'wb') as f:
+                f.write(os.urandom(args.size))
+            paths.append('/f%d' % i)
+        cross = os.stat(primary).st_dev != os.stat(fallback).st_dev
+        ops = make_ops(args.build, primary, fallback)
+        total = args.size * args.files
+
+        print("%-12s %10s %10s" % ('mode', 'seconds', 'MB/s'))
+        start = time.perf_counter()
+        for path in paths:
+            read_write(ops, path, path + '.rw', args.chunk)
+        elapsed = time.perf_counter() - start
+        print("%-12s %10.3f %10.1f" % ('read/write', elapsed, total / elapsed / 1e6))
+
+        start = time.perf_counter()
+        for path in paths:
+            copy_range(ops, path, path + '.cr', args.size)
+        elapsed = time.perf_counter() - start
+        print("%-12s %10.3f %10.1f" % ('copy_range', elapsed, total / elapsed / 1e6))
+
+        start = time.perf_counter()
+        for path in paths:
+            ops('rename', path, '/far' + path)
+            ops('rename', '/far' + path, path)
+        elapsed = time.perf_counter() - start
+        print("%-12s %10.3f %10.1f   (%s, both ways)" % ('rename', elapsed, 2 * total / elapsed / 1e6,
+                                                           'across filesystems' if cross else 'same filesystem'))
+        for path in paths:
+            if len(set(digest(ops, p, 1 << 20) for p in (path, path + '.rw', path + '.cr'))) != 1:
+                raise SystemExit("copies of %s differ" % path)
+        ops('destroy', '/')
+    finally:
+        shutil.rmtree(base)
+        shutil.rmtree(fallback_base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Per-op latency of the mount under each durability mode.
+
+Drives sampleFuse.Passthrough in-process, like FUSE would:
+
+- untar:  create / write 4 KiB / flush (close) / release for many small files
+- fsync:  several threads doing write + fsync on their own file
+
+Point --dir at the disk you care about: on tmpfs fsync is free and every
+mode looks the same.
+
+Usage: python3 benchmarks/durabilityBench.py [--dir /var/tmp] [--files 2000]
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sampleFuse  # noqa: E402
+from durability import MODES, Durability  # noqa: E402
+
+
+def timed(samples, op, *args):
+    start = time.perf_counter()
+    result = op(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def untar(ops, files):
+    samples = {'create': [], 'write': [], 'flush': [], 'release': []}
+    payload = os.urandom(4096)
+    for i in range(files):
+        path = '/untar/f%06d' % i
+        fh = timed(samples['create'], ops, 'create', path, 0o644)
+        timed(samples['write'], ops, 'write', path, payload, 0, fh)
+        timed(samples['flush'], ops, 'flush', path, fh)
+        timed(samples['release'], ops, 'release', path, fh)
+    return samples
+
+
+def fsyncs(ops, writers, rounds):
+    samples = {'fsync': []}
+    lock = threading.Lock()
+    payload = os.urandom(4096)
+
+    def writer(n):
+        path = '/fsync%d' % n
+        local = []
+        fh = ops('create', path, 0o644)
+        for i in range(rounds):
+            ops('write', path, payload, i * 4096, fh)
+            timed(local, ops, 'fsync', path, 0, fh)
+        ops('release', path, fh)
+        with lock:
+            samples['fsync'].extend(local)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def report(mode, samples):
+    for op, values in samples.items():
+        values.sort()
+        print("%-13s %-8s %8d %10.1f %10.1f %10.1f" % (
+            mode, op, len(values), statistics.mean(values) * 1e6,
+            statistics.median(values) * 1e6, values[int(len(values) * 0.99) - 1] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test tree")
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--group-commit-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    print("%-13s %-8s %8s %10s %10s %10s" % ('mode', 'op', 'count', 'mean (us)', 'p50 (us)', 'p99 (us)'))
+    for mode in MODES:
+        base = tempfile.mkdtemp(prefix='fuse-durability-', dir=args.dir)
+        try:
+            primary = os.path.join(base, 'primary')
+            fallback = os.path.join(base, 'fallback')
+            os.makedirs(os.path.join(primary, 'untar'))
+            os.mkdir(fallback)
+
+            durability = Durability(mode, args.group_commit_ms / 1000)
+            ops = sampleFuse.Passthrough(primary, fallback, threads=args.writers, durability=durability)
+            report(mode, untar(ops, args.files))
+            report(mode, fsyncs(ops, args.writers, args.rounds))
+            ops('destroy', '/')
+        finally:
+            shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Reads of fallbackFS files through pread and through --mmap-budget mappings.
+
+Builds --files files of --size bytes on fallbackFS, then for each mode runs
+--passes passes in which --threads clients open, read in --chunk pieces and
+release every file. Every read result is memmoved into a buffer, as fusepy
+hands it to the kernel, so each mode pays for what it returns. The files
+stay in the page cache, so this is the hot reference data case.
+
+Reported per mode: throughput, and from a separate single-threaded pass
+under tracemalloc, the Python memory allocated per read (the peak reached
+during the call).
+
+Usage: python3 benchmarks/mmapBench.py [--files 16] [--size 8M] [--chunk 128K] [--threads 4] [--passes 3]
+"""
+
+import argparse
+import ctypes
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sampleFuse  # noqa: E402
+from mappingCache import MappingCache  # noqa: E402
+from units import parse_size  # noqa: E402
+
+
+def build(base, files, size):
+    primary = os.path.join(base, 'primary')
+    fallback = os.path.join(base, 'fallback')
+    os.mkdir(primary)
+    os.mkdir(fallback)
+    paths = []
+    for i in range(files):
+        with open(os.path.join(fallback, 'ref%03d' % i), 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append('/ref%03d' % i)
+    return primary, fallback, paths
+
+
+def read_file(ops, path, chunk, buf, allocations=None):
+    fh = ops('open', path, os.O_RDONLY)
+    offset = 0
+    while True:
+        if allocations is not None:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        data = ops('read', path, chunk, offset, fh)
+        if allocations is not None:
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+        if not data:
+            break
+        ctypes.memmove(buf, data, len(data))
+        offset += len(data)
+        del data
+    ops('release', path, fh)
+    return offset
+
+
+def throughput(ops, paths, args):
+    total = [0]
+    lock = threading.Lock()
+
+    def client(share):
+        buf = ctypes.create_string_buffer(args.chunk)
+        read = 0
+        for _ in range(args.passes):
+            for path in share:
+                read += read_file(ops, path, args.chunk, buf)
+        with lock:
+            total[0] += read
+
+    clients = [threading.Thread(target=client, args=(paths[i::args.threads],)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return total[0] / (time.perf_counter() - start)
+
+
+def allocated(ops, paths, args):
+    buf = ctypes.create_string_buffer(args.chunk)
+    allocations = []
+    tracemalloc.start()
+    try:
+        for path in paths[:4]:
+            read_file(ops, path, args.chunk, buf, allocations)
+    finally:
+        tracemalloc.stop()
+    return sum(allocations) / len(allocations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test tree")
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--size', type=parse_size, default=8 << 20)
+    parser.add_argument('--chunk', type=parse_size, default=128 << 10)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--passes', type=int, default=3)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-mmap-', dir=args.dir)
+    try:
+        primary, fallback, paths = build(base, args.files, args.size)
+        print("%-8s %12s %16s %s" % ('mode', 'read MB/s', 'bytes/read', 'mappings'))
+        for mode in ('pread', 'mmap'):
+            mappings = MappingCache(args.files * args.size) if mode == 'mmap' else None
+            ops = sampleFuse.Passthrough(primary, fallback, threads=args.threads, mappings=mappings)
+            try:
+                rate = throughput(ops, paths, args)
+                per_read = allocated(ops, paths, args)
+                stats = mappings.stats() if mappings else None
+            finally:
+                ops('destroy', '/')
+            print("%-8s %12.1f %16.0f %s" % (mode, rate / 1e6, per_read,
+                                             "%d hits / %d misses" % (stats['hits'], stats['misses']) if stats else '-'))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
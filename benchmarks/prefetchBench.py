@@ -0,0 +1,83 @@
+"""
+Remote round trips of a metadata walk, with and without --prefetch.
+
+Builds a remote tree of --dirs directories of --files files each and stats
+every file by path, the way make or a compiler checks what it depends on:
+a lookup and a getattr per file, no readdir. The remote tree is served
+through slowRemote.SlowRemoteOs, which counts (and delays) every call
+reaching it, i.e. every SFTP round trip sshfs would make. Prefetched
+listings come from one os.scandir per directory: sshfs answers readdir
+with the attributes of every entry, so DirEntry.stat costs no round trip.
+
+Usage: python3 benchmarks/prefetchBench.py [--dirs 20] [--files 200] [--remote-delay 0.002]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remoteCallBackFuse  # noqa: E402
+from remotePrefetch import RemotePrefetcher  # noqa: E402
+from remoteTier import RemoteTier  # noqa: E402
+from slowRemote import SlowRemoteOs, installed  # noqa: E402
+
+
+def build(base, dirs, files):
+    tiers = dict((tier, os.path.join(base, tier)) for tier in ('primary', 'fallback', 'remote'))
+    for tier in tiers.values():
+        os.mkdir(tier)
+    paths = []
+    for d in range(dirs):
+        directory = os.path.join(tiers['remote'], 'd%03d' % d)
+        os.mkdir(directory)
+        for f in range(files):
+            open(os.path.join(directory, 'f%05d' % f), 'w').close()
+            paths.append('/d%03d/f%05d' % (d, f))
+    return tiers, paths
+
+
+def run(tiers, paths, delay, prefetch):
+    prefetcher = None
+    if prefetch:
+        prefetcher = RemotePrefetcher(tiers['remote'], 60.0, remoteCallBackFuse.STAT_FIELDS)
+    ops = remoteCallBackFuse.Passthrough(tiers['primary'], tiers['fallback'], local_mount_point=tiers['remote'],
+                                         remote=RemoteTier(None, None, tiers['remote'], mount=False),
+                                         prefetcher=prefetcher)
+    proxy = SlowRemoteOs(tiers['remote'], delay)
+    try:
+        with installed(proxy):
+            start = time.perf_counter()
+            for path in paths:
+                ops('getattr', path)
+            elapsed = time.perf_counter() - start
+    finally:
+        ops('destroy', '/')
+    return elapsed, proxy.delayed + proxy.path.delayed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test tree")
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--remote-delay', type=float, default=0.002, help="seconds added to every remote call")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-prefetch-', dir=args.dir)
+    try:
+        tiers, paths = build(base, args.dirs, args.files)
+        print("%-10s %10s %14s %14s" % ('mode', 'wall (s)', 'round trips', 'per file'))
+        for mode, prefetch in (('probe', False), ('prefetch', True)):
+            elapsed, trips = run(tiers, paths, args.remote_delay, prefetch)
+            print("%-10s %10.3f %14d %14.2f" % (mode, elapsed, trips, trips / len(paths)))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
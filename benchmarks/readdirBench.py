@@ -0,0 +1,172 @@
+"""
+Cost of `ls -l` and `find -ls` on a big directory that lives on fallbackFS.
+
+Drives sampleFuse.Passthrough in-process the way the kernel does: one
+readdir, then a getattr per entry. Each run is done twice:
+
+- names:  readdir returns bare names, as it used to, so every getattr
+          probes the tiers
+- plus:   readdir hands out attributes and seeds the caches
+
+Filesystem calls made by the mount (os.*, os.path.* and DirEntry.stat, but
+not pure path arithmetic like os.path.join) are counted by swapping a
+counting proxy in for `os` in every module of the repository (see
+slowRemote.installed).
+
+Usage: python3 benchmarks/readdirBench.py [--dir /var/tmp] [--entries 100000]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sampleFuse  # noqa: E402
+from slowRemote import installed  # noqa: E402
+
+
+# Path arithmetic that never reaches the filesystem
+PURE = {'fspath', 'path.join', 'path.split', 'path.dirname', 'path.basename', 'path.relpath', 'path.normpath'}
+
+
+class CountingOs:
+    # Stands in for the `os` module and counts every call made through it
+    def __init__(self, module, counts, prefix=''):
+        self._module = module
+        self._counts = counts
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if name == 'path':
+            return CountingOs(value, self._counts, 'path.')
+        if name == 'scandir':
+            return self._scandir
+        if not callable(value) or isinstance(value, type):
+            return value
+        key = self._prefix + name
+        if key in PURE:
+            return value
+
+        def counted(*args, **kwargs):
+            self._counts[key] += 1
+            return value(*args, **kwargs)
+        return counted
+
+    def _scandir(self, directory):
+        self._counts['scandir'] += 1
+        return _CountingScandir(self._module.scandir(directory), self._counts)
+
+
+class _CountingScandir:
+    def __init__(self, it, counts):
+        self.it = it
+        self.counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.it.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountingEntry(next(self.it), self.counts)
+
+    def close(self):
+        self.it.close()
+
+
+class _CountingEntry:
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.counts = counts
+
+    def stat(self, follow_symlinks=True):
+        self.counts['DirEntry.stat'] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+def build(base, entries, subdirs):
+    primary = os.path.join(base, 'primary')
+    fallback = os.path.join(base, 'fallback')
+    os.mkdir(primary)
+    big = os.path.join(fallback, 'big')
+    os.makedirs(big)
+    for i in range(entries):
+        # A few subdirectories so find has something to descend into
+        if i < subdirs:
+            os.mkdir(os.path.join(big, 'd%06d' % i))
+            open(os.path.join(big, 'd%06d' % i, 'leaf'), 'w').close()
+        else:
+            open(os.path.join(big, 'f%06d' % i), 'w').close()
+    return primary, fallback
+
+
+def listing(ops, path):
+    names = [entry if isinstance(entry, str) else entry[0] for entry in ops('readdir', path, None)]
+    children = []
+    for name in names:
+        if name in ('.', '..'):
+            continue
+        child = path.rstrip('/') + '/' + name
+        attrs = ops('getattr', child)
+        if attrs['st_mode'] & 0o170000 == 0o040000:
+            children.append(child)
+    return children
+
+
+def ls_l(ops):
+    listing(ops, '/big')
+
+
+def find_ls(ops):
+    pending = ['/big']
+    while pending:
+        pending.extend(listing(ops, pending.pop()))
+
+
+def run(tree, workload, plus):
+    primary, fallback = tree
+    ops = sampleFuse.Passthrough(primary, fallback)
+    if not plus:
+        ops._seed = lambda partial, tier, entry, generations: None
+    counts = Counter()
+    with installed(CountingOs(os, counts)):
+        start = time.perf_counter()
+        workload(ops)
+        elapsed = time.perf_counter() - start
+    return elapsed, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test tree")
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--subdirs', type=int, default=100)
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-readdir-', dir=args.dir)
+    try:
+        tree = build(base, args.entries, args.subdirs)
+        print("%-8s %-6s %10s %10s  %s" % ('workload', 'mode', 'wall (s)', 'fs calls', 'breakdown'))
+        for name, workload in (('ls -l', ls_l), ('find -ls', find_ls)):
+            for mode, plus in (('names', False), ('plus', True)):
+                elapsed, counts = run(tree, workload, plus)
+                breakdown = ", ".join("%s=%d" % item for item in counts.most_common())
+                print("%-8s %-6s %10.3f %10d  %s" % (name, mode, elapsed, sum(counts.values()), breakdown))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+Replays a trace recorded with --trace against a regenerated tree.
+
+The tree is rebuilt from the trace itself. Every path whose first traced
+operation succeeded and did not create it is created on the tier it was
+served from (primaryFS when the trace does not say): as a directory when it
+was listed or has traced children, otherwise as a sparse file as long as
+the furthest byte read from it. Misses and paths the trace creates are left
+out, so they miss and get created again.
+
+The records then run in-process against the chosen build, on --threads
+workers, at the recorded pace (--speed original) or back to back
+(--speed max). Operations on the same path, handles included, stay in
+order on one worker; so do those on the two paths of a rename, link or
+symlink, and on any path tied to them that way. The remote tier is served through
+slowRemote.SlowRemoteOs with --remote-delay per call.
+
+Prints, per op, the recorded and the replayed latency (p50/p99) and errors,
+and the replay's wall time; run it twice with different options to compare
+cache or threading changes on the same workload.
+
+Usage: python3 benchmarks/replay.py TRACE [--build remoteCallBackFuse|sampleFuse] [--speed original|max]
+                                    [--threads 8] [--remote-delay 0.002] [--dir DIR]
+"""
+
+import argparse
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remoteTier import RemoteTier  # noqa: E402
+from slowRemote import SlowRemoteOs, installed  # noqa: E402
+from traceLog import read_trace  # noqa: E402
+
+# Ops that bring their path into existence
+CREATING = ('create', 'mkdir', 'mknod', 'symlink')
+
+# Ops with a second path
+TWO_PATHS = ('rename', 'link', 'symlink')
+
+
+def regenerate(records, base, tiers_available):
+    # Builds the tree the trace started from under `base`; returns {tier: root}
+    tiers = dict((tier, os.path.join(base, tier)) for tier in ('primary', 'fallback', 'remote'))
+    for root in tiers.values():
+        os.makedirs(root, exist_ok=True)
+    first = {}
+    tier_of = {}
+    sizes = defaultdict(int)
+    listed = set()
+    for record in records:
+        if record.tier and record.path not in tier_of:
+            tier_of[record.path] = record.tier
+        if record.op == 'read' and not record.errno:
+            sizes[record.path] = max(sizes[record.path], record.offset + record.length)
+        if record.op == 'readdir':
+            listed.add(record.path)
+        for path, created in ((record.path, record.op in CREATING),
+                              (record.second, record.op in TWO_PATHS)):
+            if path and path not in first:
+                first[path] = not (created or record.errno)
+    existing = set(path for path, present in first.items() if present and path.startswith('/') and path != '/')
+    parents = set()
+    for path in existing:
+        parent = os.path.dirname(path)
+        while parent != '/':
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+    for path in sorted(existing):
+        tier = tier_of.get(path, 'primary')
+        if tier not in tiers_available:
+            tier = tiers_available[-1]
+        real = os.path.join(tiers[tier], path.lstrip('/'))
+        if path in listed or path in parents:
+            os.makedirs(real, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(real), exist_ok=True)
+        with open(real, 'wb') as f:
+            f.truncate(sizes[path])
+    return tiers
+
+
+def shards(records):
+    # path -> the path naming its shard: paths tied by a two-path op share
+    # one, so the ops on both sides of it run in order on one worker
+    parent = {}
+
+    def find(path):
+        root = path
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while path != root:
+            parent[path], path = root, parent[path]
+        return root
+
+    for record in records:
+        if record.op in TWO_PATHS and record.second:
+            a, b = find(record.path), find(record.second)
+            if a != b:
+                parent[b] = a
+    return find
+
+
+def _simple(op):
+    return lambda ops, record, fh: ops(op, record.path)
+
+
+def _with_mode(op):
+    return lambda ops, record, fh: ops(op, record.path, record.offset)
+
+
+def _with_owner(op):
+    return lambda ops, record, fh: ops(op, record.path, record.offset, record.length)
+
+
+def _with_second(op):
+    return lambda ops, record, fh: ops(op, record.path, record.second)
+
+
+def _on_handle(op):
+    return lambda ops, record, fh: ops(op, record.path, fh)
+
+
+# op -> replay(ops, record, fh), fh being the replay's own handle for
+# record.fh; records of other ops are counted as skipped
+REPLAYS = {
+    'getattr': lambda ops, record, fh: ops('getattr', record.path, None),
+    'readdir': lambda ops, record, fh: sum(1 for _ in ops('readdir', record.path, 0)),
+    'open': _with_mode('open'),
+    'create': lambda ops, record, fh: ops('create', record.path, record.offset & 0o7777 or 0o644),
+    'read': lambda ops, record, fh: ops('read', record.path, record.length, record.offset, fh),
+    'write': lambda ops, record, fh: ops('write', record.path, bytes(record.length), record.offset, fh),
+    'release': _on_handle('release'),
+    'flush': _on_handle('flush'),
+    'fsync': lambda ops, record, fh: ops('fsync', record.path, record.offset, fh),
+    'truncate': lambda ops, record, fh: ops('truncate', record.path, record.length, fh),
+    'access': _with_mode('access'),
+    'chmod': _with_mode('chmod'),
+    'mkdir': _with_mode('mkdir'),
+    'mknod': _with_owner('mknod'),
+    'chown': _with_owner('chown'),
+    'rename': _with_second('rename'),
+    'link': _with_second('link'),
+    'symlink': _with_second('symlink'),
+    'unlink': _simple('unlink'),
+    'rmdir': _simple('rmdir'),
+    'readlink': _simple('readlink'),
+    'statfs': _simple('statfs'),
+    'utimens': lambda ops, record, fh: ops('utimens', record.path, None),
+}
+
+
+class Replayer:
+    def __init__(self, ops, threads):
+        self.ops = ops
+        self.queues = [queue.Queue() for _ in range(threads)]
+        # (path, recorded fh) -> replay fh; fds get reused across paths
+        self.handles = {}
+        # op -> [(seconds, failed)]
+        self.results = defaultdict(list)
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self.queues]
+
+    def run(self, records, original):
+        shard = shards(records)
+        for worker in self.workers:
+            worker.start()
+        started = time.perf_counter()
+        for record in records:
+            if original:
+                wait = started + record.start - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            self.queues[hash(shard(record.path)) % len(self.queues)].put(record)
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+        return time.perf_counter() - started
+
+    def _work(self, q):
+        while True:
+            record = q.get()
+            if record is None:
+                return
+            replay = REPLAYS.get(record.op)
+            if replay is None:
+                # Not an op the replay knows how to run
+                with self.lock:
+                    self.skipped += 1
+                continue
+            fh = None
+            if record.fh is not None and record.op not in ('open', 'create'):
+                fh = self.handles.get((record.path, record.fh))
+                if fh is None:
+                    # Its open failed or was not traced
+                    with self.lock:
+                        self.skipped += 1
+                    continue
+            start = time.perf_counter()
+            failed = False
+            try:
+                result = replay(self.ops, record, fh)
+            except OSError:
+                failed = True
+                result = None
+            elapsed = time.perf_counter() - start
+            if record.op in ('open', 'create') and not failed:
+                self.handles[(record.path, record.fh)] = result
+            elif record.op == 'release':
+                self.handles.pop((record.path, record.fh), None)
+            with self.lock:
+                self.results[record.op].append((elapsed, failed))
+
+
+def quantile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def make_ops(build, tiers, threads):
+    if build == 'sampleFuse':
+        import sampleFuse
+        return sampleFuse.Passthrough(tiers['primary'], tiers['fallback'], threads=threads)
+    import remoteCallBackFuse
+    return remoteCallBackFuse.Passthrough(tiers['primary'], tiers['fallback'], local_mount_point=tiers['remote'],
+                                          threads=threads, remote=RemoteTier(None, None, tiers['remote'], mount=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace')
+    parser.add_argument('--build', choices=('remoteCallBackFuse', 'sampleFuse'), default='remoteCallBackFuse')
+    parser.add_argument('--speed', choices=('original', 'max'), default='max')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--remote-delay', type=float, default=0.002, help="seconds added to every remote call")
+    parser.add_argument('--dir', default=None, help="where to regenerate the tree")
+    args = parser.parse_args()
+
+    records = sorted(read_trace(args.trace), key=lambda record: record.start)
+    records = [record for record in records if record.op not in ('init', 'destroy')]
+    available = ('primary', 'fallback') if args.build == 'sampleFuse' else ('primary', 'fallback', 'remote')
+    base = tempfile.mkdtemp(prefix='fuse-replay-', dir=args.dir)
+    try:
+        tiers = regenerate(records, base, available)
+        ops = make_ops(args.build, tiers, args.threads)
+        replayer = Replayer(ops, args.threads)
+        proxy = SlowRemoteOs(tiers['remote'], args.remote_delay)
+        try:
+            with installed(proxy):
+                wall = replayer.run(records, args.speed == 'original')
+        finally:
+            ops('destroy', '/')
+    finally:
+        shutil.rmtree(base)
+
+    recorded = defaultdict(list)
+    for record in records:
+        recorded[record.op].append((record.latency, bool(record.errno)))
+    print("%d records, replayed in %.3fs at %s speed, %d skipped" % (len(records), wall, args.speed, replayer.skipped))
+    print("%-10s %8s %12s %12s %12s %12s %9s %9s" % ('op', 'count', 'rec p50 us', 'rec p99 us', 'rep p50 us',
+                                                      'rep p99 us', 'rec errs', 'rep errs'))
+    for op in sorted(recorded):
+        before = [s for s, _ in recorded[op]]
+        after = [s for s, _ in replayer.results.get(op, [])]
+        print("%-10s %8d %12.1f %12.1f %12.1f %12.1f %9d %9d" % (
+            op, len(before), quantile(before, 0.5) * 1e6, quantile(before, 0.99) * 1e6,
+            quantile(after, 0.5) * 1e6, quantile(after, 0.99) * 1e6,
+            sum(failed for _, failed in recorded[op]), sum(failed for _, failed in replayer.results.get(op, []))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+A local directory that behaves like the sshfs tier, latency-wise.
+
+`SlowRemoteOs` stands in for the `os` module of the mount's modules and
+sleeps `delay` seconds in every call that reaches into `remote_dir`: calls
+taking a path under it, and calls on file descriptors opened there. Other
+calls go straight to `os`. `installed` swaps it in for the duration of a
+with block, so the Passthrough classes run unmodified against it.
+"""
+
+import contextlib
+import os
+import sys
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Calls whose first argument is a file descriptor
+FD_CALLS = {'pread', 'pwrite', 'read', 'write', 'fstat', 'fsync', 'fdatasync', 'ftruncate', 'lseek'}
+# Calls whose second argument is the source descriptor
+SOURCE_FD_CALLS = {'sendfile': 1, 'copy_file_range': 0}
+# Path arithmetic that never reaches the filesystem
+PURE = {'fspath', 'fsencode', 'fsdecode', 'join', 'split', 'splitext', 'dirname', 'basename',
+        'normpath', 'abspath', 'relpath'}
+
+
+class SlowRemoteOs:
+    def __init__(self, remote_dir, delay, module=os):
+        self._module = module
+        self._remote = os.path.abspath(remote_dir) + os.sep
+        self._delay = delay
+        self._fds = set()
+        self._lock = threading.Lock()
+        self.delayed = 0
+        if module is os:
+            self.path = SlowRemoteOs(remote_dir, delay, os.path)
+            self.path._fds = self._fds
+
+    def _remote_path(self, arg):
+        if isinstance(arg, (str, bytes, os.PathLike)):
+            path = os.path.abspath(os.fsdecode(arg))
+            return (path + os.sep).startswith(self._remote)
+        return False
+
+    def _sleep(self):
+        self.delayed += 1
+        time.sleep(self._delay)
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if not callable(value) or isinstance(value, type) or name in PURE:
+            return value
+
+        def call(*args, **kwargs):
+            remote = False
+            if args:
+                if name in FD_CALLS or name == 'close':
+                    remote = args[0] in self._fds
+                elif name in SOURCE_FD_CALLS:
+                    remote = args[SOURCE_FD_CALLS[name]] in self._fds
+                else:
+                    remote = self._remote_path(args[0])
+            if remote:
+                self._sleep()
+            result = value(*args, **kwargs)
+            if remote and name == 'open':
+                with self._lock:
+                    self._fds.add(result)
+            elif name == 'close':
+                with self._lock:
+                    self._fds.discard(args[0])
+            return result
+        return call
+
+
+@contextlib.contextmanager
+def installed(proxy):
+    # Replaces `os` in every module of the repository that imported it
+    patched = []
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None) or ''
+        if path.startswith(REPO + os.sep) and os.sep + 'benchmarks' + os.sep not in path \
+                and getattr(module, 'os', None) is os:
+            module.os = proxy
+            patched.append(module)
+    try:
+        yield proxy
+    finally:
+        for module in patched:
+            module.os = os
@@ -0,0 +1,295 @@
+"""
+Per-operation benchmark of the Passthrough builds, with regression checks.
+
+Generates primaryFS, fallbackFS and a "remote" tree in a temp dir and runs
+the same workloads against each build:
+
+- getattr:  stat every file, spread over the three tiers
+- miss:     stat paths that are on no tier, a few times each
+- readdir:  list every directory
+- read:     open / read 64 KiB / release every file
+- create:   create / write 4 KiB / flush / release new files
+- rename:   rename the new files
+
+In-process mode (the default) drives the Operations methods directly, like
+FUSE would, so it needs no /dev/fuse. The remote tree is served through
+slowRemote.SlowRemoteOs, which adds --remote-delay to every call reaching
+it, as the sshfs round trip would.
+
+With --mount each build is mounted for real and driven through the kernel.
+The builds are command templates; the C++ build joins with
+--mount-cmd cpp='Cpp_Implementation/main {mount} {primary} --fallback {fallback}'.
+There is no stand-in for the remote tier in that mode.
+
+--save FILE stores the results as a JSON baseline; --baseline FILE compares
+against one and exits 1 when an op's median latency regressed by more than
+--tolerance.
+
+Usage: python3 benchmarks/suite.py [--files 300] [--save baseline.json | --baseline baseline.json]
+       python3 benchmarks/suite.py --mount [--mount-cmd NAME=TEMPLATE ...]
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remoteTier import RemoteTier  # noqa: E402
+from slowRemote import SlowRemoteOs, installed  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MOUNT_COMMANDS = {
+    'sampleFuse': sys.executable + ' ' + os.path.join(REPO, 'sampleFuse.py') + ' {primary} {fallback} {mount}',
+    'remoteCallBackFuse': sys.executable + ' ' + os.path.join(REPO, 'remoteCallBackFuse.py') + ' {mount} {primary} --fallback {fallback}',
+}
+
+
+def make_tiers(base, files, dirs):
+    # Files 0, 3, 6... live on primaryFS, 1, 4, 7... on fallbackFS and the
+    # rest on the remote tier, each in one of `dirs` directories
+    tiers = dict((tier, os.path.join(base, tier)) for tier in ('primary', 'fallback', 'remote'))
+    paths = []
+    for i in range(files):
+        tier = ('primary', 'fallback', 'remote')[i % 3]
+        partial = os.path.join('d%02d' % (i % dirs), 'f%05d' % i)
+        os.makedirs(os.path.join(tiers[tier], os.path.dirname(partial)), exist_ok=True)
+        with open(os.path.join(tiers[tier], partial), 'wb') as f:
+            f.write(os.urandom(64 << 10))
+        paths.append('/' + partial)
+    for tier in tiers.values():
+        os.makedirs(tier, exist_ok=True)
+    return tiers, paths
+
+
+class InProcess:
+    # Calls into an Operations instance the way the FUSE loop does
+    def __init__(self, ops):
+        self.ops = ops
+
+    def getattr(self, path):
+        self.ops('getattr', path)
+
+    def missing(self, path):
+        try:
+            self.ops('getattr', path)
+        except FileNotFoundError:
+            pass
+
+    def readdir(self, path):
+        for _ in self.ops('readdir', path, None):
+            pass
+
+    def read(self, path, length):
+        fh = self.ops('open', path, os.O_RDONLY)
+        self.ops('read', path, length, 0, fh)
+        self.ops('release', path, fh)
+
+    def create(self, path, data):
+        fh = self.ops('create', path, 0o644)
+        self.ops('write', path, data, 0, fh)
+        self.ops('flush', path, fh)
+        self.ops('release', path, fh)
+
+    def rename(self, old, new):
+        self.ops('rename', old, new)
+
+
+class Mounted:
+    # The same calls through the kernel
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+
+    def _real(self, path):
+        return self.mountpoint + path
+
+    def getattr(self, path):
+        os.lstat(self._real(path))
+
+    def missing(self, path):
+        try:
+            os.lstat(self._real(path))
+        except FileNotFoundError:
+            pass
+
+    def readdir(self, path):
+        with os.scandir(self._real(path)) as it:
+            for _ in it:
+                pass
+
+    def read(self, path, length):
+        fd = os.open(self._real(path), os.O_RDONLY)
+        try:
+            os.read(fd, length)
+        finally:
+            os.close(fd)
+
+    def create(self, path, data):
+        fd = os.open(self._real(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def rename(self, old, new):
+        os.rename(self._real(old), self._real(new))
+
+
+def timed(samples, fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    samples.append(time.perf_counter() - start)
+
+
+def workloads(client, paths, rounds):
+    dirs = sorted(set(os.path.dirname(p) for p in paths))
+    samples = dict((op, []) for op in ('getattr', 'miss', 'readdir', 'read', 'create', 'rename'))
+    payload = os.urandom(4096)
+    for r in range(rounds):
+        for path in paths:
+            timed(samples['getattr'], client.getattr, path)
+        for directory in dirs:
+            for i in range(10):
+                # Like a compiler walking its include path: same misses again
+                for _ in range(3):
+                    timed(samples['miss'], client.missing, '%s/missing-%d.h' % (directory, i))
+        for directory in dirs:
+            timed(samples['readdir'], client.readdir, directory)
+        for path in paths:
+            timed(samples['read'], client.read, path, 64 << 10)
+        created = []
+        for i, directory in enumerate(dirs):
+            path = '%s/new-%d-%d' % (directory, r, i)
+            timed(samples['create'], client.create, path, payload)
+            created.append(path)
+        for path in created:
+            timed(samples['rename'], client.rename, path, path + '.renamed')
+    return dict((op, summarize(values)) for op, values in samples.items())
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean_us': statistics.mean(values) * 1e6,
+        'p50_us': statistics.median(values) * 1e6,
+        'p99_us': values[max(int(len(values) * 0.99) - 1, 0)] * 1e6,
+    }
+
+
+def in_process(name, tiers, paths, rounds, delay):
+    module = __import__(name)
+    if name == 'sampleFuse':
+        ops = module.Passthrough(tiers['primary'], tiers['fallback'])
+        paths = [p for i, p in enumerate(paths) if i % 3 != 2]
+    else:
+        # `remote` stands in for the sshfs mount, so nothing is mounted
+        ops = module.Passthrough(tiers['primary'], tiers['fallback'], local_mount_point=tiers['remote'],
+                                 remote=RemoteTier(None, None, tiers['remote'], mount=False))
+    try:
+        with installed(SlowRemoteOs(tiers['remote'], delay)):
+            return workloads(InProcess(ops), paths, rounds)
+    finally:
+        if hasattr(ops, 'destroy'):
+            ops('destroy', '/')
+
+
+def mounted(name, template, tiers, paths, rounds, base):
+    mountpoint = os.path.join(base, 'mnt-' + name)
+    os.mkdir(mountpoint)
+    command = template.format(mount=mountpoint, primary=tiers['primary'], fallback=tiers['fallback'], repo=REPO)
+    try:
+        # Relative commands are taken from the repository
+        process = subprocess.Popen(shlex.split(command), cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.ismount(mountpoint):
+            if process.poll() is not None or time.monotonic() > deadline:
+                return None
+            time.sleep(0.05)
+        # Only primaryFS and fallbackFS are behind the mount
+        return workloads(Mounted(mountpoint), [p for i, p in enumerate(paths) if i % 3 != 2], rounds)
+    finally:
+        if os.path.ismount(mountpoint):
+            subprocess.run(['fusermount', '-u', mountpoint], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for build, ops in results.items():
+        for op, now in ops.items():
+            before = baseline.get(build, {}).get(op)
+            if before and now['p50_us'] > before['p50_us'] * (1 + tolerance):
+                found.append("%s %s: p50 %.1f us, baseline %.1f us" % (build, op, now['p50_us'], before['p50_us']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help="where to create the test trees")
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--dirs', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--remote-delay', type=float, default=0.002, help="seconds added to every remote call")
+    parser.add_argument('--builds', default='sampleFuse,remoteCallBackFuse', help="in-process builds to run")
+    parser.add_argument('--mount', action='store_true', help="mount the builds and go through the kernel")
+    parser.add_argument('--mount-cmd', action='append', default=[], metavar='NAME=TEMPLATE',
+                        help="extra build to mount; {mount}, {primary}, {fallback} and {repo} are filled in")
+    parser.add_argument('--save', help="write the results to this JSON baseline")
+    parser.add_argument('--baseline', help="compare with this JSON baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p50 slowdown, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='fuse-suite-', dir=args.dir)
+    results = {}
+    try:
+        if args.mount:
+            commands = dict(MOUNT_COMMANDS)
+            commands.update(item.split('=', 1) for item in args.mount_cmd)
+            for name, template in commands.items():
+                tiers, paths = make_tiers(os.path.join(base, name), args.files, args.dirs)
+                result = mounted(name, template, tiers, paths, args.rounds, base)
+                if result is None:
+                    print("%s: did not mount, skipped" % name)
+                    continue
+                results[name + '@mount'] = result
+        else:
+            for name in args.builds.split(','):
+                tiers, paths = make_tiers(os.path.join(base, name), args.files, args.dirs)
+                results[name] = in_process(name, tiers, paths, args.rounds, args.remote_delay)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    print("%-28s %-8s %8s %10s %10s %10s" % ('build', 'op', 'count', 'mean (us)', 'p50 (us)', 'p99 (us)'))
+    for build, ops in results.items():
+        for op, s in ops.items():
+            print("%-28s %-8s %8d %10.1f %10.1f %10.1f" % (build, op, s['count'], s['mean_us'], s['p50_us'], s['p99_us']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
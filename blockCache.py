@@ -0,0 +1,151 @@
+"""
+Read-through cache of fixed-size blocks on local disk for remote-tier files.
+
+Blocks live under `cache_dir/<hash of path>/<size>-<mtime_ns>/<block index>`,
+so an entry is keyed by (path, size, mtime): once the remote file changes,
+the next open sees a different generation and drops the old one. The index
+is rebuilt from the directory at startup, so the cache survives remounts.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    def __init__(self, cache_dir, budget_bytes=1 << 30, block_size=1 << 20):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.block_size = block_size
+        # block file -> size, least recently used first
+        self.blocks = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                block_file = os.path.join(dirpath, name)
+                if name.endswith('.tmp'):
+                    # Left behind by a crash in the middle of a store
+                    os.unlink(block_file)
+                    continue
+                st = os.stat(block_file)
+                found.append((st.st_mtime, block_file, st.st_size))
+        # Oldest blocks are evicted first after a remount
+        for _, block_file, size in sorted(found):
+            self.blocks[block_file] = size
+            self.used_bytes += size
+        self._evict()
+
+    def _path_dir(self, path):
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest())
+
+    def _generation_dir(self, path, size, mtime_ns):
+        return os.path.join(self._path_dir(path), '%d-%d' % (size, mtime_ns))
+
+    def validate(self, path, size, mtime_ns):
+        # Called on open: drop every generation of `path` but the current one
+        path_dir = self._path_dir(path)
+        current = '%d-%d' % (size, mtime_ns)
+        try:
+            generations = os.listdir(path_dir)
+        except FileNotFoundError:
+            return
+        for generation in generations:
+            if generation != current:
+                self._drop_dir(os.path.join(path_dir, generation))
+
+    def drop(self, path):
+        # The mount itself changed `path`
+        self._drop_dir(self._path_dir(path))
+
+    def _drop_dir(self, directory):
+        prefix = directory + os.sep
+        with self.lock:
+            for block_file in [b for b in self.blocks if b.startswith(prefix)]:
+                self.used_bytes -= self.blocks.pop(block_file)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def read(self, path, size, mtime_ns, offset, length, fetch):
+        # fetch(offset, length) reads from the remote file on a miss
+        end = min(offset + length, size)
+        if offset >= end:
+            return b''
+
+        generation_dir = self._generation_dir(path, size, mtime_ns)
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        data = b''.join(self._block(generation_dir, index, fetch) for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + end - offset]
+
+    def _block(self, generation_dir, index, fetch):
+        block_file = os.path.join(generation_dir, str(index))
+        with self.lock:
+            cached = block_file in self.blocks
+            if cached:
+                self.blocks.move_to_end(block_file)
+        if cached:
+            try:
+                with open(block_file, 'rb') as f:
+                    data = f.read()
+                with self.lock:
+                    self.hits += 1
+                    self.bytes_saved += len(data)
+                return data
+            except FileNotFoundError:
+                # Evicted between the index check and the open
+                pass
+
+        data = fetch(index * self.block_size, self.block_size)
+        with self.lock:
+            self.misses += 1
+        self._store(block_file, data)
+        return data
+
+    def _store(self, block_file, data):
+        os.makedirs(os.path.dirname(block_file), exist_ok=True)
+        # Write aside and rename so a crash never leaves a truncated block
+        tmp = '%s.%d.tmp' % (block_file, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, block_file)
+        with self.lock:
+            self.used_bytes += len(data) - self.blocks.pop(block_file, 0)
+            self.blocks[block_file] = len(data)
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.used_bytes <= self.budget_bytes or not self.blocks:
+                    return
+                block_file, size = self.blocks.popitem(last=False)
+                self.used_bytes -= size
+            try:
+                os.unlink(block_file)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'blocks': len(self.blocks),
+                'used_bytes': self.used_bytes,
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+            }
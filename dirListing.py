@@ -0,0 +1,145 @@
+"""
+Directory listings merged across tiers.
+
+`union` streams the entries of the same directory on several tiers with
+os.scandir, highest priority first, yielding each name once together with
+the tier it comes from. Only names of the tiers that still have a lower tier
+after them are remembered for the de-duplication, so listing a huge
+directory that lives on a single tier (or on the last one) keeps nothing in
+memory.
+
+Both `union` and `tier_mtimes` make their filesystem calls through
+`call(tier, fn, *args)`, so the mount can bound the remote tier's by its
+per-op timeout and breaker. A directory is read BATCH entries per call,
+with their lstat taken in the same call when asked (DirEntry keeps it).
+
+`DirCache` keeps complete merged listings, keyed on the mtime of the
+directory on every tier so a listing is only reused while no tier changed.
+"""
+
+import itertools
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+# Entries read from a directory per call
+BATCH = 1024
+
+
+def _direct(tier, fn, *args):
+    return fn(*args)
+
+
+def _batch(it, lstat):
+    # The next entries of a scandir iterator
+    entries = list(itertools.islice(it, BATCH))
+    if lstat:
+        for entry in entries:
+            try:
+                entry.stat(follow_symlinks=False)
+            except OSError:
+                pass
+    return entries
+
+
+def tier_mtimes(dirs, call=_direct):
+    # `dirs` is [(tier, directory)]. Returns the ones that exist and the
+    # mtimes keying their listing
+    existing = []
+    mtimes = []
+    for tier, directory in dirs:
+        try:
+            st = call(tier, os.stat, directory)
+        except OSError:
+            mtimes.append(None)
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            mtimes.append(None)
+            continue
+        existing.append((tier, directory))
+        mtimes.append(st.st_mtime_ns)
+    return existing, tuple(mtimes)
+
+
+def union(dirs, call=_direct, lstat=False):
+    seen = set()
+    for i, (tier, directory) in enumerate(dirs):
+        last = i == len(dirs) - 1
+        try:
+            it = call(tier, os.scandir, directory)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        # Closed here, unless a call that gave up may still be reading it
+        idle = True
+        try:
+            while True:
+                idle = False
+                entries = call(tier, _batch, it, lstat)
+                idle = True
+                if not entries:
+                    break
+                for entry in entries:
+                    if entry.name in seen:
+                        continue
+                    if not last:
+                        seen.add(entry.name)
+                    yield tier, entry
+        finally:
+            if idle:
+                it.close()
+
+
+class DirCache:
+    def __init__(self, max_entries=1024, max_names=100000):
+        self.max_entries = max_entries
+        # Bigger listings are streamed every time rather than held in memory
+        self.max_names = max_names
+        # partial path -> (tier mtimes, names)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, partial, mtimes):
+        with self.lock:
+            entry = self.entries.get(partial)
+            if entry is None or entry[0] != mtimes:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(partial)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, partial, mtimes, names, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[partial] = (mtimes, names)
+            self.entries.move_to_end(partial)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, partial):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+
+    def invalidate_tree(self, partial):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
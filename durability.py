@@ -0,0 +1,116 @@
+"""
+When the Passthrough classes sync data to disk.
+
+FUSE sends `flush` on every close() and `fsync` only when the application asks
+for it. The policy decides what each of them costs:
+
+- strict:       flush and fsync both sync the file (the historical behaviour)
+- fsync-only:   flush only hands data to the backing file, fsync syncs it
+- group-commit: a background thread syncs everything submitted during the
+                last `interval` seconds in one batch; flush submits without
+                waiting, fsync waits for the batch holding its file
+"""
+
+import os
+import threading
+import time
+
+STRICT = 'strict'
+FSYNC_ONLY = 'fsync-only'
+GROUP_COMMIT = 'group-commit'
+MODES = (STRICT, FSYNC_ONLY, GROUP_COMMIT)
+
+
+class _Pending:
+    def __init__(self, fd, datasync):
+        self.fd = fd
+        self.datasync = datasync
+        self.error = None
+
+
+class GroupCommitter:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.pending = []
+        # Id of the batch now collecting submissions, and of the last synced one
+        self.next_batch = 1
+        self.completed = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, fd, wait, datasync=False):
+        # The caller may close its fd before the batch runs: sync a duplicate
+        entry = _Pending(os.dup(fd), datasync)
+        with self.cond:
+            self.pending.append(entry)
+            batch = self.next_batch
+            self.cond.notify_all()
+            if not wait:
+                return
+            while self.completed < batch:
+                self.cond.wait()
+        if entry.error:
+            raise entry.error
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped and not self.pending:
+                    return
+            # Let the batch fill up
+            time.sleep(self.interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+                batch_id = self.next_batch
+                self.next_batch += 1
+            for entry in batch:
+                try:
+                    if entry.datasync:
+                        os.fdatasync(entry.fd)
+                    else:
+                        os.fsync(entry.fd)
+                except OSError as e:
+                    entry.error = e
+                finally:
+                    os.close(entry.fd)
+            with self.cond:
+                self.completed = batch_id
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class Durability:
+    def __init__(self, mode=STRICT, interval=0.005):
+        if mode not in MODES:
+            raise ValueError("durability must be one of %s" % ", ".join(MODES))
+        self.mode = mode
+        self.committer = GroupCommitter(interval) if mode == GROUP_COMMIT else None
+
+    def flush(self, fd):
+        # close() on the mount
+        if self.mode == STRICT:
+            os.fsync(fd)
+        elif self.mode == GROUP_COMMIT:
+            self.committer.submit(fd, wait=False)
+
+    def fsync(self, fd, datasync=False):
+        # An explicit fsync()/fdatasync() on the mount
+        if self.mode == GROUP_COMMIT:
+            self.committer.submit(fd, wait=True, datasync=datasync)
+        elif datasync:
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+
+    def stop(self):
+        if self.committer:
+            self.committer.stop()
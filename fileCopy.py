@@ -0,0 +1,142 @@
+"""
+File copies that stay in the kernel.
+
+`copy_range` moves bytes between two file descriptors without passing them
+through Python: copy_file_range first (the filesystem may reflink or copy
+server-side), sendfile when the two files live on different filesystems or
+the kernel refuses, and a pread/pwrite loop only when neither is available.
+
+`copy_file` copies a whole file, as a reflink (FICLONE) when the filesystem
+can share blocks, and `move` is a rename(2) that falls back to such copies
+when source and destination are on different filesystems (EXDEV).
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import threading
+
+# copy_file_range and sendfile fail with these when they cannot handle the
+# pair of files, rather than because of an I/O error
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+CHUNK = 1 << 20
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _copy_file_range(src, src_offset, dst, dst_offset, length):
+    return os.copy_file_range(src, dst, length, src_offset, dst_offset)
+
+
+def _sendfile(src, src_offset, dst, dst_offset, length):
+    # sendfile writes at the current offset of `dst`
+    os.lseek(dst, dst_offset, os.SEEK_SET)
+    return os.sendfile(dst, src, src_offset, length)
+
+
+def _read_write(src, src_offset, dst, dst_offset, length):
+    data = os.pread(src, min(length, CHUNK), src_offset)
+    view = memoryview(data)
+    while view:
+        view = view[os.pwrite(dst, view, dst_offset + len(data) - len(view)):]
+    return len(data)
+
+
+STEPS = [step for step, available in ((_copy_file_range, hasattr(os, 'copy_file_range')),
+                                      (_sendfile, hasattr(os, 'sendfile')),
+                                      (_read_write, True)) if available]
+
+
+def copy_range(src, src_offset, dst, dst_offset, length):
+    # Copies `length` bytes of `src` at `src_offset` to `dst` at `dst_offset`.
+    # Returns how many were copied, fewer if `src` turned out shorter
+    done = 0
+    for step in STEPS:
+        try:
+            while done < length:
+                copied = step(src, src_offset + done, dst, dst_offset + done, length - done)
+                if copied == 0:
+                    return done
+                done += copied
+            return done
+        except OSError as e:
+            if e.errno not in UNSUPPORTED or step is _read_write:
+                raise
+    return done
+
+
+def copy_fd(src, dst, length):
+    # Copies the first `length` bytes of `src` to the same offsets in `dst`
+    return copy_range(src, 0, dst, 0, length)
+
+
+def clone_fd(src, dst):
+    # Makes `dst` share the blocks of `src` when both are on a filesystem
+    # that can (btrfs, XFS...); returns whether it did
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except OSError as e:
+        if e.errno in UNSUPPORTED or e.errno in (errno.ENOTTY, errno.EBADF):
+            return False
+        raise
+    return True
+
+
+def copy_file(src, dst):
+    # Copies the file `src` to the new path `dst`, with its mode and times
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(src_fd)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IMODE(st.st_mode))
+        try:
+            if not clone_fd(src_fd, dst_fd):
+                copy_fd(src_fd, dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return dst
+
+
+def move(src, dst):
+    # os.rename(src, dst), also between filesystems: on EXDEV a copy is made
+    # next to `dst` and renamed over it, then `src` is removed. Devices and
+    # other special files still fail with EXDEV
+    try:
+        return os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    st = os.lstat(src)
+    directory, name = os.path.split(dst)
+    tmp = os.path.join(directory, '.%s.%x.move' % (name, threading.get_ident()))
+    try:
+        if stat.S_ISDIR(st.st_mode):
+            shutil.copytree(src, tmp, symlinks=True, copy_function=copy_file)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), tmp)
+        elif stat.S_ISREG(st.st_mode):
+            copy_file(src, tmp)
+        else:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src)
+        # Same checks as the rename would have made: no directory over a
+        # file, no replacing a non-empty directory...
+        os.rename(tmp, dst)
+    except BaseException:
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        raise
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(src)
+    else:
+        os.unlink(src)
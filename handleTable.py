@@ -0,0 +1,191 @@
+"""
+Open file handles of the Passthrough classes.
+
+`open`/`create` resolve the path once and register a FileHandle holding the
+tier and a real fd; `read`/`write` then go straight to that fd with
+pread/pwrite. The fd number doubles as the FUSE fh.
+
+A BackendHandle stands for a file of a remote backend (see remoteBackend.py)
+and has no fd: its reads and writes are range requests, and the table gives
+it a FUSE fh above any fd number.
+
+With write-back, a timer thread of the table flushes the buffers of handles
+that stopped writing once their oldest pending write is `write_back_age`
+seconds old, so held-back data reaches the backing file within about
+1.25 * `write_back_age` even when no flush, fsync or release comes.
+"""
+
+import itertools
+import os
+import threading
+
+from writeBuffer import WriteBuffer
+
+
+class FileHandle:
+    def __init__(self, fd, path, tier, real_path, flags):
+        self.fd = fd
+        self.path = path
+        self.tier = tier
+        self.real_path = real_path
+        self.flags = flags
+        self.lock = threading.Lock()
+        # (size, mtime_ns) of a read-only remote-tier file served through the
+        # block cache
+        self.cache_key = None
+        # ReadAhead state of a read-only handle on a slow tier
+        self.readahead = None
+        # WriteBuffer of a writable handle when write-back is enabled
+        self.write_buffer = None
+        # writeStaging entry of a handle writing a staged remote-tier file
+        self.staged = None
+        # mappingCache Mapping of a read-only fallback-tier file
+        self.mapping = None
+
+    def pread(self, length, offset):
+        # The backing file, without pending writes
+        return os.pread(self.fd, length, offset)
+
+    def pwrite(self, buf, offset):
+        return os.pwrite(self.fd, buf, offset)
+
+    def ftruncate(self, length):
+        os.ftruncate(self.fd, length)
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, length, offset):
+        mapping = self.mapping
+        if mapping is not None:
+            try:
+                return mapping.read(offset, length, os.fstat(self.fd).st_size)
+            except ValueError:
+                # Unmapped meanwhile: see unmap
+                pass
+        if self.write_buffer is None:
+            return self.pread(length, offset)
+        with self.lock:
+            return self.write_buffer.overlay(self.pread(length, offset), offset, length)
+
+    def write(self, buf, offset):
+        if self.write_buffer is None:
+            return self.pwrite(buf, offset)
+        with self.lock:
+            self.write_buffer.add(offset, buf)
+            if self.write_buffer.should_flush():
+                self.write_buffer.flush(self.pwrite)
+        return len(buf)
+
+    def unmap(self):
+        # The mapping this handle read through, if any; it reads with pread
+        # from now on
+        with self.lock:
+            mapping, self.mapping = self.mapping, None
+        return mapping
+
+    def drain(self):
+        # Push pending writes to the backing file
+        if self.write_buffer is not None:
+            with self.lock:
+                self.write_buffer.flush(self.pwrite)
+
+    def truncate(self, length):
+        if self.write_buffer is not None:
+            with self.lock:
+                self.write_buffer.truncate(length)
+
+    def drain_expired(self, registered):
+        # The timer's flush; `registered()` is False once release took the
+        # handle out of the table, and release drains it itself. A failed
+        # write leaves the data pending, for flush or release to report
+        with self.lock:
+            if registered() and self.write_buffer.expired():
+                try:
+                    self.write_buffer.flush(self.pwrite)
+                except OSError:
+                    pass
+
+
+class BackendHandle(FileHandle):
+    def __init__(self, backend, path, tier, real_path, flags):
+        # `real_path` is the path on the backend; fd is set by the table
+        super().__init__(None, path, tier, real_path, flags)
+        self.backend = backend
+
+    def pread(self, length, offset):
+        return self.backend.read_range(self.real_path, offset, length)
+
+    def pwrite(self, buf, offset):
+        return self.backend.write_range(self.real_path, offset, buf)
+
+    def ftruncate(self, length):
+        self.backend.truncate(self.real_path, length)
+
+    def close(self):
+        pass
+
+
+class HandleTable:
+    def __init__(self, write_back=0, write_back_age=1.0):
+        self.handles = {}
+        self.lock = threading.Lock()
+        # Bytes a writable handle may hold back before flushing; 0 disables
+        # write-back
+        self.write_back = write_back
+        self.write_back_age = write_back_age
+        # FUSE fhs of handles without an fd, above any fd number
+        self.numbers = itertools.count(1 << 30)
+        self.stopping = threading.Event()
+        self.thread = None
+        if write_back:
+            self.thread = threading.Thread(target=self._flush_expired, name='write-back', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _flush_expired(self):
+        # Buffers of idle handles would otherwise wait for flush or release
+        while not self.stopping.wait(self.write_back_age / 4):
+            with self.lock:
+                handles = [h for h in self.handles.values() if h.write_buffer is not None]
+            for handle in handles:
+                handle.drain_expired(lambda: self.handles.get(handle.fd) is handle)
+
+    def register(self, handle):
+        if self.write_back and handle.flags & os.O_ACCMODE != os.O_RDONLY:
+            handle.write_buffer = WriteBuffer(self.write_back, self.write_back_age)
+        with self.lock:
+            if handle.fd is None:
+                handle.fd = next(self.numbers)
+            self.handles[handle.fd] = handle
+        return handle.fd
+
+    def get(self, fh):
+        return self.handles[fh]
+
+    def pop(self, fh):
+        with self.lock:
+            return self.handles.pop(fh)
+
+    def for_path(self, path):
+        with self.lock:
+            return [h for h in self.handles.values() if h.path == path]
+
+    def truncate(self, path, length):
+        # A truncate by path must also cut pending writes of open handles
+        if self.write_back:
+            for handle in self.for_path(path):
+                handle.truncate(length)
+
+    def visible_size(self, path, size):
+        # The size getattr reports while writes are still held back
+        if self.write_back:
+            for handle in self.for_path(path):
+                if handle.write_buffer is not None:
+                    size = max(size, handle.write_buffer.end())
+        return size
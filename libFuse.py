@@ -1,16 +1,43 @@
 import os
 import sys
 import errno
+import threading
 from libfuse import FUSE, FuseOSError, Operations
 import subprocess
 
+from attrCache import AttrCache, parse_ttls
+from dirListing import DirCache, tier_mtimes, union
+from handleTable import FileHandle, HandleTable
+from resolutionCache import ResolutionCache
+from tierChain import Tier, TierChain, attributes
+from units import parse_size
+
 class Passthrough(Operations):
-    def __init__(self, root, fallbackPath=None, remote_host=None, remote_directory=None, local_mount_point=None):
+    def __init__(self, root, fallbackPath=None, remote_host=None, remote_directory=None, local_mount_point=None, threads=1, write_back=0, attr_ttls=None):
         self.root = root
         self.fallbackPath = fallbackPath
         self.remote_host = remote_host
         self.remote_directory = remote_directory
         self.local_mount_point = local_mount_point
+        # The tiers in lookup order; paths on none are created on fallbackFS
+        remote = remote_host and remote_directory and local_mount_point
+        self.tiers = TierChain([
+            Tier('primary', root),
+            Tier('fallback', fallbackPath, write_target=True),
+            Tier('remote', local_mount_point if remote else None),
+        ])
+        self.resolution_cache = ResolutionCache()
+        # getattr results, kept for a per-tier TTL (see --attr-ttl)
+        self.attr_cache = AttrCache(attr_ttls)
+        # Merged readdir listings, reused while no tier's directory changed
+        self.dir_cache = DirCache()
+
+        # Writable handles hold back up to `write_back` bytes (see --write-back)
+        self.handles = HandleTable(write_back)
+
+        # FUSE may dispatch from several threads (see --threads): at most
+        # `threads` operations run at once
+        self.gate = threading.BoundedSemaphore(threads)
 
         if fallbackPath and remote_host and remote_directory and local_mount_point:
             # Mount the remote directory using SSHFS
@@ -25,49 +52,113 @@ class Passthrough(Operations):
             subprocess.run(unmount_command, check=True)
             print("Server unmounted")
 
+    def __call__(self, op, *args):
+        if op == 'readdir':
+            return self._gated(super().__call__(op, *args))
+        with self.gate:
+            return super().__call__(op, *args)
+
+    def _gated(self, listing):
+        # readdir is a generator: it does its work, remote scans included,
+        # while FUSE iterates it, and holds its slot of the gate until then
+        with self.gate:
+            yield from listing
+
     def _full_path(self, partial, useFallBack=False):
+        if useFallBack:
+            # Explicitly asked for the fallback path
+            if partial.startswith("/"):
+                partial = partial[1:]
+            return os.path.join(self.fallbackPath, partial)
+        return self._resolve(partial)[1]
+
+    def _resolve(self, partial):
+        # Returns (tier, real path) for a virtual path
+        return self._lookup(partial)[:2]
+
+    def _lookup(self, partial):
+        # Returns (tier, real path, stat) for a virtual path. The stat result
+        # is the lookup's own lstat, None for a cached resolution, False when
+        # the path is on no tier (it would be created on fallbackFS)
         if partial.startswith("/"):
             partial = partial[1:]
 
-        # Find out the real path. If it has been requested for a fallback path, use it.
-        path = primaryPath = os.path.join(self.root if not useFallBack else self.fallbackPath, partial)
-
-        # If the path does not exist and we haven't been asked for the fallback path, try to look in the fallback filesystem.
-        if not os.path.exists(primaryPath) and not useFallBack:
-            path = fallbackPath = os.path.join(self.fallbackPath, partial)
-
-            # If the path does not exist in the fallback filesystem, check if it exists in the remote filesystem.
-            if not os.path.exists(fallbackPath) and self.remote_host and self.remote_directory and self.local_mount_point:
-                remote_full_path = os.path.join(self.local_mount_point, partial)
-                if os.path.exists(remote_full_path):
-                    path = remote_full_path
-
-        return path
+        cached = self.resolution_cache.get(partial)
+        if cached is not None:
+            return cached + (None,)
+        generation = self.resolution_cache.generation
+
+        # primaryFS, then fallbackFS, then the remote filesystem
+        found = self.tiers.lookup(partial)
+        if found:
+            self.resolution_cache.put(partial, found[0], found[1], generation)
+            return found
+
+        return self.tiers.target(partial) + (False,)
+
+    def _invalidate(self, path, tree=False):
+        # Called after every operation of the mount that creates, removes or
+        # moves a path, so cached resolutions never point at the wrong tier
+        partial = path[1:] if path.startswith("/") else path
+        if tree:
+            self.resolution_cache.invalidate_tree(partial)
+            self.attr_cache.invalidate_tree(partial)
+        else:
+            self.resolution_cache.invalidate(partial)
+            self.attr_cache.invalidate(partial)
+        if tree:
+            self.dir_cache.invalidate_tree(partial)
+        # The parent's listing, mtime and link count changed too
+        self.attr_cache.invalidate(os.path.dirname(partial))
+        self.dir_cache.invalidate(os.path.dirname(partial))
+
+    def _touched(self, path):
+        # Called after the mount changed the data or metadata of `path`
+        self.attr_cache.invalidate(path[1:] if path.startswith("/") else path)
 
     def readdir(self, path, fh):
-        dirents = ['.', '..']
-        full_path = self._full_path(path)
-
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
-
-        if self.fallbackPath and self.fallbackPath not in full_path:
-            fallback_full_path = self._full_path(path, useFallBack=True)
-            if os.path.isdir(fallback_full_path):
-                dirents.extend(os.listdir(fallback_full_path))
-
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            if path == '/':
-                remote_full_path = self.local_mount_point
-            else:
-                remote_full_path = os.path.join(self.local_mount_point, path)
-            print(path)
-            print(remote_full_path)
-            if os.path.isdir(remote_full_path):
-                dirents.extend(os.listdir(remote_full_path))
-
-        for r in set(dirents):
-            yield r
+        partial = path[1:] if path.startswith("/") else path
+        generation = self.dir_cache.generation
+        dirs, mtimes = tier_mtimes(self._tier_dirs(partial))
+
+        yield '.'
+        yield '..'
+
+        names = self.dir_cache.get(partial, mtimes)
+        if names is not None:
+            for name in names:
+                yield name, self.attr_cache.get(os.path.join(partial, name)), 0
+            return
+
+        # Stream the union and remember it, unless it turns out too big.
+        # Every name goes out with its attributes, so `ls -l` does not
+        # follow up with a getattr (and a tier probe) per entry
+        seeds = (self.resolution_cache.generation, self.attr_cache.generation)
+        names = []
+        for tier, entry in union(dirs):
+            if names is not None:
+                names.append(entry.name)
+                if len(names) > self.dir_cache.max_names:
+                    names = None
+            yield entry.name, self._seed(partial, tier, entry, seeds), 0
+        if names is not None:
+            self.dir_cache.put(partial, mtimes, names, generation)
+
+    def _seed(self, partial, tier, entry, generations):
+        # Cache where `entry` lives and its attributes, as getattr would
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+        child = os.path.join(partial, entry.name)
+        attrs = attributes(st)
+        self.resolution_cache.put(child, tier, entry.path, generations[0])
+        self.attr_cache.put(child, tier, attrs, generations[1])
+        return attrs
+
+    def _tier_dirs(self, partial):
+        # The directory on every tier, highest priority first
+        return self.tiers.dirs(partial)
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -78,68 +169,122 @@ class Passthrough(Operations):
             return pathname
 
     def access(self, path, mode):
-        full_path = self._full_path(path)
+        tier, full_path, st = self._lookup(path)
+        if st is False:
+            raise FuseOSError(errno.ENOENT)
+        if mode == os.F_OK and st is not None:
+            # The lookup saw it
+            return
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
 
     def chmod(self, path, mode):
         full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        try:
+            return os.chmod(full_path, mode)
+        finally:
+            self._touched(path)
 
     def chown(self, path, uid, gid):
         full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        try:
+            return os.chown(full_path, uid, gid)
+        finally:
+            self._touched(path)
 
     def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                        'st_gid', 'st_mode', 'st_mtime',
-                                                        'st_nlink', 'st_size', 'st_uid'))
-
-    def readdir(self, path, fh):
-        full_path = self._full_path(path)
-        dirents = ['.', '..'] + os.listdir(full_path)
-        for r in dirents:
-            yield r
+        partial = path[1:] if path.startswith("/") else path
+        attrs = self.attr_cache.get(partial)
+        if attrs is None:
+            generation = self.attr_cache.generation
+            tier, full_path, st = self._lookup(path)
+            if st is False:
+                # What lstat'ing the path would have raised
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), full_path)
+            if st is None:
+                try:
+                    st = os.lstat(full_path)
+                except FileNotFoundError:
+                    # Only the resolution can be stale; the parent did not change
+                    self.resolution_cache.invalidate(partial)
+                    raise
+            # Otherwise the lookup's own lstat: one syscall per tier visited
+            attrs = attributes(st)
+            self.attr_cache.put(partial, tier, attrs, generation)
+        # Writes held back by open handles may have made the file longer
+        size = self.handles.visible_size(path, attrs['st_size'])
+        if size != attrs['st_size']:
+            attrs = dict(attrs, st_size=size)
+        return attrs
 
     def read(self, path, length, offset, fh):
-        full_path = self._full_path(path)
-        with open(full_path, 'rb') as f:
-            os.lseek(fh, offset, os.SEEK_SET)
-            return f.read(length)
+        return self.handles.get(fh).read(length, offset)
 
     def open(self, path, flags):
-        full_path = self._full_path(path)
-        return os.open(full_path, flags)
+        tier, full_path = self._resolve(path)
+        fd = os.open(full_path, flags)
+        return self.handles.register(FileHandle(fd, path, tier, full_path, flags))
 
     def create(self, path, mode, fi=None):
-        full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        tier, full_path = self._resolve(path)
+        flags = os.O_RDWR | os.O_CREAT
+        try:
+            fd = os.open(full_path, flags, mode)
+        finally:
+            self._invalidate(path)
+        return self.handles.register(FileHandle(fd, path, tier, full_path, flags))
 
     def write(self, path, buf, offset, fh):
-        full_path = self._full_path(path)
-        with open(full_path, 'rb+') as f:
-            os.lseek(fh, offset, os.SEEK_SET)
-            return f.write(buf)
+        written = self.handles.get(fh).write(buf, offset)
+        self._touched(path)
+        return written
 
     def truncate(self, path, length, fh=None):
-        full_path = self._full_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        try:
+            if fh is not None:
+                handle = self.handles.get(fh)
+                handle.truncate(length)
+                return os.ftruncate(handle.fd, length)
+            self.handles.truncate(path, length)
+            full_path = self._full_path(path)
+            with open(full_path, 'r+') as f:
+                f.truncate(length)
+        finally:
+            self._touched(path)
+
+    def flush(self, path, fh):
+        self.handles.get(fh).drain()
+
+    def fsync(self, path, fdatasync, fh):
+        self.handles.get(fh).drain()
+        return os.fsync(fh)
+
+    def release(self, path, fh):
+        handle = self.handles.pop(fh)
+        try:
+            handle.drain()
+        finally:
+            os.close(handle.fd)
+            self._touched(path)
 
     def unlink(self, path):
         full_path = self._full_path(path)
-        return os.unlink(full_path)
+        try:
+            return os.unlink(full_path)
+        finally:
+            self._invalidate(path)
 
     def utimens(self, path, times=None):
         full_path = self._full_path(path)
-        return os.utime(full_path, times)
+        try:
+            return os.utime(full_path, times)
+        finally:
+            self._touched(path)
 
 
 def main():
     if len(sys.argv) < 3:
-        print("Usage: python script.py <mountpoint> <root> [--fallback <fallbackPath> --remote <remote_host:remote_directory> --local <local_mount_point>]")
+        print("Usage: python script.py <mountpoint> <root> [--fallback <fallbackPath> --remote <remote_host:remote_directory> --local <local_mount_point>] [--threads N] [--write-back <bytes>] [--attr-ttl <tier=seconds,...>] [--attr-timeout S] [--entry-timeout S] [--negative-timeout S]")
         sys.exit(1)
 
     mountpoint = sys.argv[1]
@@ -149,6 +294,7 @@ def main():
     remote_host = None
     remote_directory = None
     local_mount_point = None
+    threads = 1
 
     # Check for optional arguments
     if "--fallback" in sys.argv:
@@ -158,13 +304,35 @@ def main():
         remote_host, remote_directory = remote.split(":")
     if "--local" in sys.argv:
         local_mount_point = sys.argv[sys.argv.index("--local") + 1]
+    if "--threads" in sys.argv:
+        threads = int(sys.argv[sys.argv.index("--threads") + 1])
+
+    # Bytes each writable handle may hold back in memory
+    write_back = 0
+    if "--write-back" in sys.argv:
+        write_back = parse_size(sys.argv[sys.argv.index("--write-back") + 1])
+
+    # getattr cache TTL per tier, e.g. primary=1,fallback=30,remote=300
+    attr_ttls = None
+    if "--attr-ttl" in sys.argv:
+        attr_ttls = parse_ttls(sys.argv[sys.argv.index("--attr-ttl") + 1])
+
+    # Kernel-side cache timeouts in seconds, handed to FUSE as -o options
+    fuse_options = {}
+    for option in ('attr_timeout', 'entry_timeout', 'negative_timeout'):
+        flag = '--' + option.replace('_', '-')
+        if flag in sys.argv:
+            fuse_options[option] = float(sys.argv[sys.argv.index(flag) + 1])
+
+    # With a single thread keep libfuse's own single-threaded loop
+    nothreads = threads <= 1
 
     if fallbackPath and remote_host and remote_directory and local_mount_point:
-        FUSE(Passthrough(root, fallbackPath, remote_host, remote_directory, local_mount_point), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, fallbackPath, remote_host, remote_directory, local_mount_point, threads=threads, write_back=write_back, attr_ttls=attr_ttls), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
     elif fallbackPath:
-        FUSE(Passthrough(root, fallbackPath), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, fallbackPath, threads=threads, write_back=write_back, attr_ttls=attr_ttls), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
     else:
-        FUSE(Passthrough(root), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, threads=threads, write_back=write_back, attr_ttls=attr_ttls), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+"""
+Locking helpers for serving the mount with several FUSE worker threads.
+
+Locks are striped: a key (a virtual path or a file handle) is hashed onto a
+fixed pool of locks, so the table never grows with the number of paths seen.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class StripedLocks:
+    def __init__(self, stripes=64):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def _index(self, key):
+        return hash(key) % len(self.locks)
+
+    def __call__(self, key):
+        return self.locks[self._index(key)]
+
+    @contextmanager
+    def many(self, *keys):
+        # Two keys can land on the same stripe, and two threads can ask for the
+        # same pair in opposite order: take each stripe once, in index order
+        indexes = sorted(set(self._index(key) for key in keys))
+        for i in indexes:
+            self.locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(indexes):
+                self.locks[i].release()
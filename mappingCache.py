@@ -0,0 +1,173 @@
+"""
+Memory-mapped reads of fallbackFS files.
+
+With --mmap-budget every fallback-tier file opened read-only is mapped once
+per (path, inode, mtime, size) and the mapping is shared by all the handles
+reading it. `read` then returns a ctypes array laid over the mapped pages
+rather than a fresh bytes object: fusepy memmoves it into the kernel's
+buffer straight from the page cache, with no allocation and no copy in
+between. (fusepy's memmove takes bytes or ctypes objects, not memoryviews;
+ctypes wants a writable buffer for that, hence ACCESS_COPY mappings, which
+are private and never written back.)
+
+Mappings are refcounted by the handles using them. Unused ones stay mapped,
+least recently opened first out, while the mapped total fits in `budget`
+bytes of address space; a file that does not fit is read the usual way.
+A mapping is replaced when its file changed by the next open, and unmapped
+once its last handle is released.
+
+Touching a mapped page past the end of a file that shrank kills the process
+(SIGBUS), so:
+
+- every read is clamped to the file's size at the time of the read.
+- before the mount itself changes a path (truncate, an open for writing,
+  create, rename, unlink) its handles `drop` their mapping and go back to
+  pread, and the next open maps the file afresh.
+
+Changes made to fallbackFS outside the mount are only caught by the
+clamping. A truncate that lands between a read and the kernel copying the
+returned pages can still fault, so fallbackFS should not be written behind
+the mount's back while --mmap-budget is on. Files changed in place without
+a new mtime or size are served from the old pages until remapped.
+"""
+
+import ctypes
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class Mapping:
+    def __init__(self, path, signature, size, mapped):
+        self.path = path
+        # (st_dev, st_ino, st_mtime_ns, st_size) of the file when mapped
+        self.signature = signature
+        self.size = size
+        self.map = mapped
+        self.refs = 1
+        # Replaced or evicted: unmapped as soon as nothing uses it
+        self.retired = False
+
+    def read(self, offset, length, size):
+        # `size` is the file's current one: pages past it fault
+        end = min(self.size, size)
+        if offset >= end:
+            return b''
+        length = min(length, end - offset)
+        return (ctypes.c_char * length).from_buffer(self.map, offset)
+
+
+class MappingCache:
+    def __init__(self, budget):
+        self.budget = budget
+        # real path -> Mapping, least recently opened first
+        self.mappings = OrderedDict()
+        # Address space of every open mapping, retired ones included
+        self.mapped = 0
+        # Mappings whose close waits for the last slice of them to go away
+        self.closing = []
+        self.hits = 0
+        self.misses = 0
+        self.refused = 0
+        self.evictions = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, real_path, fd):
+        # A Mapping of the file open at `fd`, or None to read it the usual
+        # way. Pair with release()
+        st = os.fstat(fd)
+        signature = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            mapping = self.mappings.get(real_path)
+            if mapping is not None:
+                if mapping.signature == signature:
+                    mapping.refs += 1
+                    self.mappings.move_to_end(real_path)
+                    self.hits += 1
+                    return mapping
+                # Changed since it was mapped
+                self._retire(mapping)
+            self.misses += 1
+            if st.st_size == 0:
+                # Nothing to map
+                return None
+            self._make_room(st.st_size)
+            if self.mapped + st.st_size > self.budget:
+                self.refused += 1
+                return None
+            try:
+                mapped = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_COPY)
+            except (OSError, ValueError) as e:
+                log.debug("Cannot map %s: %s", real_path, e)
+                self.refused += 1
+                return None
+            mapping = self.mappings[real_path] = Mapping(real_path, signature, st.st_size, mapped)
+            self.mapped += st.st_size
+            return mapping
+
+    def release(self, mapping):
+        with self.lock:
+            mapping.refs -= 1
+            if mapping.refs == 0 and mapping.retired:
+                self._close(mapping)
+
+    def drop(self, mapping):
+        # release() for a handle going back to pread before its file changes;
+        # the next open maps the file afresh
+        with self.lock:
+            if self.mappings.get(mapping.path) is mapping:
+                self._retire(mapping)
+                self.dropped += 1
+            mapping.refs -= 1
+            if mapping.refs == 0:
+                self._close(mapping)
+
+    def stop(self):
+        with self.lock:
+            for mapping in list(self.mappings.values()):
+                self._retire(mapping)
+
+    def _make_room(self, size):
+        for mapping in list(self.mappings.values()):
+            if self.mapped + size <= self.budget:
+                return
+            if mapping.refs == 0:
+                self._retire(mapping)
+                self.evictions += 1
+
+    def _retire(self, mapping):
+        del self.mappings[mapping.path]
+        mapping.retired = True
+        if mapping.refs == 0:
+            self._close(mapping)
+
+    def _close(self, mapping):
+        pending, self.closing = self.closing + [mapping], []
+        for mapping in pending:
+            try:
+                mapping.map.close()
+            except BufferError:
+                # A slice of it is still alive somewhere
+                self.closing.append(mapping)
+                continue
+            self.mapped -= mapping.size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'mappings': len(self.mappings),
+                'mapped_bytes': self.mapped,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'refused': self.refused,
+                'evictions': self.evictions,
+                'dropped': self.dropped,
+            }
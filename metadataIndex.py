@@ -0,0 +1,325 @@
+"""
+On-disk index of the read-mostly tiers (fallbackFS and the remote tree).
+
+A cold mount otherwise discovers those tiers one exists/lstat/listdir at a
+time. The index keeps, in SQLite, every entry of every directory of the
+indexed tiers with its attributes, and the mtime each directory had when it
+was listed.
+
+The rows of a directory are trusted once its mtime has been checked against
+the tier during this mount: by the refresh that walks the tiers in the
+background at startup, or by the first lookup in that directory (one stat of
+the directory instead of one probe per name). A directory whose mtime moved
+is listed again. Entries the mount itself changed are re-read in the
+background. A file rewritten in place from outside the mount leaves its
+directory's mtime alone, so its indexed attributes are only refreshed once
+the directory changes or the file is changed through the mount.
+
+Every stat and listing goes through the mount's `call(tier, fn, *args)`,
+so those of the remote tier are bounded by its per-op timeout and counted
+by its breaker.
+
+The schema version and the tier roots are stored with the data; an index
+built by another version or for other roots is dropped and rebuilt.
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import stat
+import threading
+
+INDEX_VERSION = 1
+
+FIELDS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
+          'st_nlink', 'st_size', 'st_uid', 'st_blocks')
+
+# lookup() result for a path that is on none of the indexed tiers
+MISSING = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs (
+    tier TEXT, path TEXT,
+    mtime_ns INTEGER,  -- NULL: the directory is not on this tier
+    PRIMARY KEY (tier, path)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+    tier TEXT, parent TEXT, name TEXT,
+    %s,
+    PRIMARY KEY (tier, parent, name)) WITHOUT ROWID;
+""" % ",\n    ".join(FIELDS)
+
+
+class MetadataIndex:
+    def __init__(self, db_path, tiers):
+        # tiers: [(tier, root)], highest priority first
+        self.tiers = list(tiers)
+        self.roots = dict(self.tiers)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        # (tier, directory) whose rows were checked during this mount
+        self.verified = set()
+        # Paths changed by the mount whose rows are being re-read
+        self.dirty = set()
+        self.generation = 0
+        self.hits = 0
+        self.missing = 0
+        self.unknown = 0
+        self.rescans = 0
+        self.refreshed = False
+        self.queue = queue.Queue()
+        self.thread = None
+        # available(tier) is False while a tier cannot be read, e.g. before
+        # the remote tier is mounted: its directories are left alone
+        self.available = None
+        self.call = None
+        self._open()
+
+    def _open(self):
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+            roots = json.dumps(self.tiers)
+            if meta.get('version') != str(INDEX_VERSION) or meta.get('roots') != roots:
+                self.db.execute('DELETE FROM dirs')
+                self.db.execute('DELETE FROM entries')
+                self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                    [('version', str(INDEX_VERSION)), ('roots', roots)])
+
+    def start(self, available=None, call=None):
+        self.available = available
+        self.call = call or (lambda tier, fn, *args: fn(*args))
+        self.thread = threading.Thread(target=self._run, name='metadata-index', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.db.close()
+
+    def real_path(self, tier, partial):
+        return os.path.join(self.roots[tier], partial)
+
+    def lookup(self, partial):
+        # (tier, attrs) of the first indexed tier holding `partial`, MISSING
+        # when none does, None when the index cannot tell
+        if not partial:
+            return None
+        parent, name = os.path.split(partial)
+        with self.lock:
+            if partial in self.dirty:
+                self.unknown += 1
+                return None
+        for tier, root in self.tiers:
+            if not self._verify(tier, parent):
+                with self.lock:
+                    self.unknown += 1
+                return None
+            with self.lock:
+                row = self.db.execute('SELECT %s FROM entries WHERE tier = ? AND parent = ? AND name = ?'
+                                      % ', '.join(FIELDS), (tier, parent, name)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    return tier, dict(zip(FIELDS, row))
+        with self.lock:
+            self.missing += 1
+        return MISSING
+
+    def listing(self, partial):
+        # [(tier, name, attrs or None)] of the merged directory, None when
+        # the index cannot tell
+        merged = []
+        seen = set()
+        for tier, root in self.tiers:
+            if not self._verify(tier, partial):
+                return None
+            with self.lock:
+                rows = self.db.execute('SELECT name, %s FROM entries WHERE tier = ? AND parent = ?'
+                                       % ', '.join(FIELDS), (tier, partial)).fetchall()
+                dirty = set(self.dirty)
+            for row in rows:
+                name = row[0]
+                if name in seen:
+                    continue
+                seen.add(name)
+                stale = os.path.join(partial, name) in dirty
+                merged.append((tier, name, None if stale else dict(zip(FIELDS, row[1:]))))
+        return merged
+
+    def invalidate(self, partial, tree=False):
+        # The mount created, removed or moved `partial`: its parent, and the
+        # directory itself, are checked against the tier again
+        parent = os.path.dirname(partial)
+        with self.lock:
+            self.generation += 1
+            for tier, root in self.tiers:
+                self.verified.discard((tier, parent))
+                self.verified.discard((tier, partial))
+            if tree:
+                prefix = partial + "/" if partial else ""
+                self.verified = set(k for k in self.verified if not k[1].startswith(prefix))
+
+    def touched(self, partial):
+        # The mount changed the data or metadata of `partial`
+        parent, name = os.path.split(partial)
+        with self.lock:
+            if partial in self.dirty:
+                return
+            indexed = self.db.execute('SELECT 1 FROM entries WHERE parent = ? AND name = ? LIMIT 1',
+                                      (parent, name)).fetchone()
+            if indexed is None:
+                return
+            self.dirty.add(partial)
+        self.queue.put(partial)
+
+    def _verify(self, tier, directory):
+        key = (tier, directory)
+        with self.lock:
+            if key in self.verified:
+                return True
+        if self.available and not self.available(tier):
+            return False
+        with self.lock:
+            generation = self.generation
+            row = self.db.execute('SELECT mtime_ns FROM dirs WHERE tier = ? AND path = ?', key).fetchone()
+        try:
+            st = self.call(tier, os.stat, os.path.join(self.roots[tier], directory))
+            mtime_ns = st.st_mtime_ns if stat.S_ISDIR(st.st_mode) else None
+        except (FileNotFoundError, NotADirectoryError):
+            mtime_ns = None
+        except OSError:
+            return False
+        if (row is None or row[0] != mtime_ns) and not self._rescan(tier, directory, mtime_ns):
+            return False
+        with self.lock:
+            if generation == self.generation:
+                self.verified.add(key)
+        return True
+
+    def _rescan(self, tier, directory, mtime_ns):
+        rows = []
+        if mtime_ns is not None:
+            try:
+                rows = self.call(tier, self._scan, tier, directory)
+            except OSError:
+                return False
+        with self.lock, self.db:
+            self.rescans += 1
+            self.db.execute('DELETE FROM entries WHERE tier = ? AND parent = ?', (tier, directory))
+            if mtime_ns is None:
+                # Gone from this tier, and so is everything below it
+                prefix = directory + "/" if directory else ""
+                self.db.execute('DELETE FROM entries WHERE tier = ? AND substr(parent, 1, ?) = ?',
+                                (tier, len(prefix), prefix))
+                self.db.execute('DELETE FROM dirs WHERE tier = ? AND substr(path, 1, ?) = ?',
+                                (tier, len(prefix), prefix))
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (%s)' % ', '.join('?' * (3 + len(FIELDS))), rows)
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (tier, directory, mtime_ns))
+        return True
+
+    def _scan(self, tier, directory):
+        # The rows of `directory` on `tier`
+        rows = []
+        with os.scandir(os.path.join(self.roots[tier], directory)) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                rows.append((tier, directory, entry.name) + tuple(getattr(st, key) for key in FIELDS))
+        return rows
+
+    def _reread(self, partial):
+        # Every tier's row of `partial` is kept, replaced or dropped on its
+        # own: a copy on a lower tier stays indexed while the one above it
+        # comes and goes
+        parent, name = os.path.split(partial)
+        with self.lock:
+            generation = self.generation
+        found = []
+        gone = []
+        unknown = []
+        for tier, root in self.tiers:
+            if self.available and not self.available(tier):
+                unknown.append(tier)
+                continue
+            try:
+                st = self.call(tier, os.lstat, os.path.join(root, partial))
+            except (FileNotFoundError, NotADirectoryError):
+                gone.append(tier)
+                continue
+            except OSError:
+                unknown.append(tier)
+                continue
+            found.append((tier, parent, name) + tuple(getattr(st, key) for key in FIELDS))
+        with self.lock, self.db:
+            if generation != self.generation:
+                # The mount changed something meanwhile: what was read may be
+                # stale already
+                unknown = [tier for tier, root in self.tiers]
+                gone, found = [], []
+            for tier in gone:
+                self.db.execute('DELETE FROM entries WHERE tier = ? AND parent = ? AND name = ?', (tier, parent, name))
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (%s)' % ', '.join('?' * (3 + len(FIELDS))), found)
+            for tier in unknown:
+                # The directory is listed again before its rows are trusted
+                self.db.execute('DELETE FROM dirs WHERE tier = ? AND path = ?', (tier, parent))
+                self.verified.discard((tier, parent))
+            self.dirty.discard(partial)
+
+    def _run(self):
+        # Walk every tier once, checking each directory, then serve re-reads
+        pending = [(tier, '') for tier, root in self.tiers]
+        while pending:
+            if not self._drain():
+                return
+            tier, directory = pending.pop()
+            if self.available and not self.available(tier):
+                # Come back to it once the tier is there
+                pending.insert(0, (tier, directory))
+                if not self._drain(0.5):
+                    return
+                continue
+            if not self._verify(tier, directory):
+                continue
+            with self.lock:
+                subdirs = self.db.execute('SELECT name FROM entries WHERE tier = ? AND parent = ? AND (st_mode & ?) = ?',
+                                          (tier, directory, stat.S_IFMT(0o170000), stat.S_IFDIR)).fetchall()
+            pending.extend((tier, os.path.join(directory, name)) for name, in subdirs)
+        self.refreshed = True
+        while True:
+            partial = self.queue.get()
+            if partial is None:
+                return
+            self._reread(partial)
+
+    def _drain(self, wait=0):
+        # Serves the re-reads queued so far, waiting up to `wait` seconds for
+        # the first; False once stop() was called
+        while True:
+            try:
+                partial = self.queue.get(timeout=wait) if wait else self.queue.get_nowait()
+            except queue.Empty:
+                return True
+            wait = 0
+            if partial is None:
+                return False
+            self._reread(partial)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.missing + self.unknown
+            return {
+                'verified_dirs': len(self.verified),
+                'hits': self.hits,
+                'missing': self.missing,
+                'unknown': self.unknown,
+                'answered_ratio': (self.hits + self.missing) / lookups if lookups else 0.0,
+                'rescans': self.rescans,
+                'refreshed': int(self.refreshed),
+            }
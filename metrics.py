@@ -0,0 +1,206 @@
+"""
+Per-operation counters and latency histograms, readable from inside the mount.
+
+`Metrics` records how long every FUSE operation took, split by the tier it
+ran against where that is known (read, write, open and create), the bytes
+moved per tier, and pulls the stats() of the caches registered with
+`add_source` when a snapshot is taken.
+
+`StatsFile` serves two read-only virtual files at the root of the mount:
+
+- /.fusestats       the snapshot as JSON
+- /.fusestats.prom  the same in the Prometheus text format
+
+They are not listed by readdir, so tools walking the mount never copy them.
+"""
+
+import errno
+import itertools
+import json
+import os
+import stat
+import threading
+import time
+
+from fuse import FuseOSError
+
+# Upper bounds of the latency buckets in seconds: 1us, 2us, 4us ... ~67s
+BUCKETS = tuple(1e-6 * (1 << i) for i in range(27))
+
+JSON_PATH = '/.fusestats'
+PROMETHEUS_PATH = '/.fusestats.prom'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds, failed):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if failed:
+            self.errors += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'sum_seconds': self.total,
+            'mean_us': self.total / self.count * 1e6 if self.count else 0.0,
+            'p50_us': self.quantile(0.5) * 1e6,
+            'p99_us': self.quantile(0.99) * 1e6,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        # (op, tier or '-') -> Histogram
+        self.latency = {}
+        # (tier, 'read' or 'write') -> bytes
+        self.transferred = {}
+        # name -> callable returning a dict of numbers
+        self.sources = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, op, seconds, tier=None, failed=False):
+        key = (op, tier or '-')
+        with self.lock:
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(seconds, failed)
+
+    def transfer(self, tier, direction, nbytes):
+        key = (tier, direction)
+        with self.lock:
+            self.transferred[key] = self.transferred.get(key, 0) + nbytes
+
+    def timed(self, op, listing, start):
+        # readdir is a generator: its time is spent while FUSE iterates it
+        failed = True
+        try:
+            yield from listing
+            failed = False
+        finally:
+            self.observe(op, time.perf_counter() - start, failed=failed)
+
+    def add_source(self, name, stats):
+        self.sources[name] = stats
+
+    def snapshot(self):
+        with self.lock:
+            ops = {}
+            for (op, tier), histogram in sorted(self.latency.items()):
+                ops.setdefault(op, {})[tier] = histogram.summary()
+            transferred = {}
+            for (tier, direction), nbytes in sorted(self.transferred.items()):
+                transferred.setdefault(tier, {})[direction] = nbytes
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'ops': ops,
+            'bytes': transferred,
+            'caches': dict((name, stats()) for name, stats in self.sources.items()),
+        }
+
+    def json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True) + "\n"
+
+    def prometheus(self):
+        lines = ['# TYPE fuse_op_seconds histogram']
+        with self.lock:
+            latency = sorted((key, list(h.counts), h.count, h.total) for key, h in self.latency.items())
+            errors = sorted((key, h.errors) for key, h in self.latency.items())
+            transferred = sorted(self.transferred.items())
+        for (op, tier), counts, count, total in latency:
+            labels = 'op="%s",tier="%s"' % (op, tier)
+            for bound, cumulative in zip(BUCKETS, itertools.accumulate(counts)):
+                lines.append('fuse_op_seconds_bucket{%s,le="%g"} %d' % (labels, bound, cumulative))
+            lines.append('fuse_op_seconds_bucket{%s,le="+Inf"} %d' % (labels, count))
+            lines.append('fuse_op_seconds_sum{%s} %.9f' % (labels, total))
+            lines.append('fuse_op_seconds_count{%s} %d' % (labels, count))
+        lines.append('# TYPE fuse_op_errors_total counter')
+        for (op, tier), n in errors:
+            lines.append('fuse_op_errors_total{op="%s",tier="%s"} %d' % (op, tier, n))
+        lines.append('# TYPE fuse_bytes_total counter')
+        for (tier, direction), nbytes in transferred:
+            lines.append('fuse_bytes_total{tier="%s",direction="%s"} %d' % (tier, direction, nbytes))
+        for name, stats in sorted(self.sources.items()):
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)):
+                    lines.append('fuse_cache_%s{cache="%s"} %s' % (key, name, value))
+        return "\n".join(lines) + "\n"
+
+
+class StatsFile:
+    # Renders are reused for `max_age` seconds, about the kernel's attribute
+    # timeout, so the size getattr reports matches what open then serves
+    def __init__(self, metrics, max_age=1.0):
+        self.renderers = {JSON_PATH: metrics.json, PROMETHEUS_PATH: metrics.prometheus}
+        self.max_age = max_age
+        # path -> (time of the render, bytes)
+        self.renders = {}
+        # fh -> bytes pinned at open; numbered far above any real fd
+        self.open_files = {}
+        self.next_fh = itertools.count(1 << 40)
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return path in self.renderers
+
+    def _render(self, path):
+        now = time.monotonic()
+        with self.lock:
+            rendered = self.renders.get(path)
+        if rendered is None or now - rendered[0] > self.max_age:
+            rendered = (now, self.renderers[path]().encode())
+            with self.lock:
+                self.renders[path] = rendered
+        return rendered[1]
+
+    def __call__(self, op, path, *args):
+        if op == 'getattr':
+            now = time.time()
+            return {'st_mode': stat.S_IFREG | 0o444, 'st_nlink': 1, 'st_size': len(self._render(path)),
+                    'st_atime': now, 'st_mtime': now, 'st_ctime': now, 'st_uid': 0, 'st_gid': 0}
+        if op == 'access':
+            if args[0] & os.W_OK:
+                raise FuseOSError(errno.EACCES)
+            return 0
+        if op == 'open':
+            if args[0] & os.O_ACCMODE != os.O_RDONLY:
+                raise FuseOSError(errno.EACCES)
+            fh = next(self.next_fh)
+            rendered = self._render(path)
+            with self.lock:
+                self.open_files[fh] = rendered
+            return fh
+        if op == 'read':
+            length, offset, fh = args
+            return self.open_files[fh][offset:offset + length]
+        if op == 'release':
+            with self.lock:
+                self.open_files.pop(args[0], None)
+            return 0
+        if op == 'flush':
+            return 0
+        if op in ('getxattr', 'listxattr'):
+            raise FuseOSError(errno.ENOTSUP)
+        raise FuseOSError(errno.EROFS)
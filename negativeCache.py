@@ -0,0 +1,184 @@
+"""
+Fast answers for paths that do not exist.
+
+Compilers, import systems and shells probe many paths that are on no tier.
+Without help each of those misses costs an `exists` on primary, fallback and
+the remote tier, and the remote one is a network round trip.
+
+- `NegativeCache` remembers, for a short TTL, the paths a lookup found on no
+  tier; a path below a missing directory is missing too.
+- `DirectoryNames` keeps the names of directories of one tier, read with a
+  single scandir and trusted for a TTL, so a name that is not in its
+  parent's listing is known absent without probing the tier.
+
+The mount invalidates both whenever it creates, removes or moves a path.
+`DirectoryNames` reads its listings through `call(fn, *args)`, e.g. bounded
+by the remote tier's per-op timeout; a listing that fails is not kept.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def _pop_with_parents(entries, partial):
+    path = partial
+    while True:
+        entries.pop(path, None)
+        if not path:
+            return
+        path = os.path.dirname(path)
+
+
+class NegativeCache:
+    def __init__(self, ttl=1.0, max_entries=65536):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # partial path -> expiry
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, partial):
+        # True when `partial`, or a directory above it, is known missing
+        if self.ttl <= 0:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            path = partial
+            while True:
+                expiry = self.entries.get(path)
+                if expiry is not None and expiry >= now:
+                    self.hits += 1
+                    return True
+                if not path:
+                    break
+                path = os.path.dirname(path)
+            self.misses += 1
+            return False
+
+    def put(self, partial, generation=None):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[partial] = time.monotonic() + self.ttl
+            self.entries.move_to_end(partial)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, partial):
+        with self.lock:
+            self.generation += 1
+            # Creating a/b/c also makes a and a/b exist
+            _pop_with_parents(self.entries, partial)
+
+    def invalidate_tree(self, partial):
+        with self.lock:
+            self.generation += 1
+            _pop_with_parents(self.entries, partial)
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class DirectoryNames:
+    def __init__(self, base, ttl, max_entries=1024, max_names=100000, call=None):
+        self.base = base
+        self.ttl = ttl
+        self.call = call or (lambda fn, *args: fn(*args))
+        self.max_entries = max_entries
+        # Bigger directories are not kept; their children are probed
+        self.max_names = max_names
+        # partial path of a directory -> (expiry, names or None if too big)
+        self.entries = OrderedDict()
+        self.avoided = 0
+        self.loads = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def absent(self, partial):
+        # True when the listing of the parent proves `partial` is not there
+        if self.ttl <= 0:
+            return False
+        parent, name = os.path.split(partial)
+        names = self._names(parent)
+        if names is None or name in names:
+            return False
+        with self.lock:
+            self.avoided += 1
+        return True
+
+    def _names(self, parent):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(parent)
+            if entry is not None and entry[0] >= now:
+                self.entries.move_to_end(parent)
+                return entry[1]
+            generation = self.generation
+            self.loads += 1
+
+        # One listing instead of one probe per missing child
+        try:
+            names = self.call(self._scan, os.path.join(self.base, parent))
+        except (FileNotFoundError, NotADirectoryError):
+            # Nothing below a missing directory
+            names = set()
+        except OSError:
+            return None
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[parent] = (now + self.ttl, names)
+                self.entries.move_to_end(parent)
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return names
+
+    def _scan(self, directory):
+        # The names in `directory`, None when there are too many
+        names = set()
+        with os.scandir(directory) as it:
+            for entry in it:
+                names.add(entry.name)
+                if len(names) > self.max_names:
+                    return None
+        return names
+
+    def invalidate(self, partial):
+        # `partial` was created or removed: the listing of its parent changed,
+        # and so did those above it if the mount created the parents too
+        with self.lock:
+            self.generation += 1
+            _pop_with_parents(self.entries, partial)
+
+    def invalidate_tree(self, partial):
+        with self.lock:
+            self.generation += 1
+            _pop_with_parents(self.entries, partial)
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'directories': len(self.entries),
+                'listings_loaded': self.loads,
+                'probes_avoided': self.avoided,
+            }
@@ -0,0 +1,350 @@
+"""
+Copies of hot fallback and remote files kept on primaryFS.
+
+Every read-only open of a file resolved on a slower tier is counted; once a
+file has been opened `promote_after` times without going quiet for `window`
+seconds, a background thread copies it into `root` at the same path. The
+copy is built in an unnamed O_TMPFILE and linked in place in one step, so the
+mount never shows a partial file, and the caller's `on_change` drops the
+cached resolution so the next lookup lands on primaryFS. Where primaryFS has
+no O_TMPFILE (or /proc is missing) copies are built in a named
+`.promote.*` file next to the target instead.
+
+A promoted copy is only a cache of its source:
+
+- it is checked against the source on every open and dropped when the
+  source changed or disappeared. The check goes through the mount's `call`,
+  so a remote source costs at most the remote tier's timeout; a source that
+  cannot be checked (its tier down or not answering) keeps its copy
+- the mount drops it (`demote`) before any operation that would modify the
+  path, so writes, renames and unlinks still reach the source
+- copies are evicted least recently opened first to stay within
+  `budget_bytes` of primaryFS
+
+With `state_file` the list of copies survives remounts; without it copies
+left behind by an earlier mount are indistinguishable from primary files.
+"""
+
+import errno
+import json
+import logging
+import os
+import queue
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+from fileCopy import copy_fd
+
+log = logging.getLogger(__name__)
+
+
+def _signature(path):
+    # What must not change between a source and its copy
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_mode]
+
+
+class Promoter:
+    def __init__(self, root, budget_bytes, promote_after=3, window=60.0, state_file=None, max_tracked=65536):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.promote_after = promote_after
+        self.window = window
+        self.state_file = state_file
+        self.max_tracked = max_tracked
+        # partial path -> (opens, time of the last one)
+        self.accesses = OrderedDict()
+        # partial path -> {'tier', 'source', 'size', 'source_sig', 'copy_sig'}, least
+        # recently opened first
+        self.promoted = OrderedDict()
+        # Directories of primaryFS created only to hold copies
+        self.created_dirs = set()
+        self.used_bytes = 0
+        self.promotions = 0
+        self.demotions = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.thread = None
+        # Whether copies are built in O_TMPFILE files
+        self.unnamed = True
+
+        if state_file:
+            self._load()
+
+    def start(self, path_locks, on_change, call=None):
+        # `path_locks` are the mount's; `on_change(partial)` invalidates its
+        # caches for a path whose tier changed; `call(tier, fn, *args)` runs
+        # the checks of a source on its tier, e.g. bounded by --remote-timeout
+        self.path_locks = path_locks
+        self.on_change = on_change
+        self.call = call or (lambda tier, fn, *args: fn(*args))
+        self.thread = threading.Thread(target=self._run, name='promotion', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def opened(self, partial, tier, real_path):
+        # Called on every read-only open. Returns True when a stale copy was
+        # dropped and the path has to be resolved again
+        with self.lock:
+            entry = self.promoted.get(partial)
+            if entry is not None:
+                self.promoted.move_to_end(partial)
+        if entry is not None:
+            if tier == 'primary':
+                try:
+                    if self._source_signature(entry) == entry['source_sig']:
+                        return False
+                except OSError:
+                    # Could not tell: the copy stays until the source answers
+                    return False
+            return self.demote(partial)
+        if tier == 'primary':
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            opens, last = self.accesses.pop(partial, (0, now))
+            opens = opens + 1 if now - last <= self.window else 1
+            if opens < self.promote_after or partial in self.queued:
+                self.accesses[partial] = (opens, now)
+                if len(self.accesses) > self.max_tracked:
+                    self.accesses.popitem(last=False)
+                return False
+            self.queued.add(partial)
+        self.queue.put((partial, tier, real_path))
+        return False
+
+    def _source_signature(self, entry):
+        # The signature of a copy's source, None when it is gone; OSError
+        # when its tier cannot say. Copies recorded before their tier was
+        # are checked as remote ones, the tier that can hang
+        try:
+            st = self.call(entry.get('tier', 'remote'), os.stat, entry['source'])
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return [st.st_size, st.st_mtime_ns, st.st_mode]
+
+    def demote(self, partial):
+        # Drops the copy of `partial`, if any. Returns True when one was removed
+        with self.lock:
+            if partial not in self.promoted:
+                return False
+        with self.path_locks('/' + partial):
+            with self.lock:
+                entry = self.promoted.pop(partial, None)
+                if entry is None:
+                    return False
+                self.used_bytes -= entry['size']
+                self.demotions += 1
+            target = os.path.join(self.root, partial)
+            # Only remove what is still our copy
+            if _signature(target) == entry['copy_sig']:
+                os.unlink(target)
+            self._remove_parents(partial)
+            self.on_change(partial)
+        self._save()
+        return True
+
+    def demote_tree(self, partial):
+        # Before a directory is renamed or removed
+        prefix = partial + "/" if partial else ""
+        with self.lock:
+            inside = [p for p in self.promoted if p == partial or p.startswith(prefix)]
+        for p in inside:
+            self.demote(p)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self._save()
+                return
+            partial, tier, source = item
+            try:
+                self._promote(partial, tier, source)
+            except OSError as e:
+                # The source went away or primaryFS is full: stay on the
+                # slow tier, another burst of opens will retry
+                log.warning("Cannot promote %s: %s", partial, e)
+            finally:
+                with self.lock:
+                    self.queued.discard(partial)
+                    self.accesses.pop(partial, None)
+
+    def _promote(self, partial, tier, source):
+        sig = _signature(source)
+        if sig is None or not stat.S_ISREG(sig[2]) or sig[0] > self.budget_bytes:
+            return
+        self._make_room(sig[0])
+
+        target = os.path.join(self.root, partial)
+        self._make_parents(partial, source)
+        src = os.open(source, os.O_RDONLY)
+        try:
+            if not self._copy(partial, tier, source, sig, src, target):
+                # The unnamed copy could not be linked: build a named one
+                self._copy(partial, tier, source, sig, src, target)
+        finally:
+            os.close(src)
+            with self.lock:
+                promoted = partial in self.promoted
+            if not promoted:
+                self._remove_parents(partial)
+
+    def _copy(self, partial, tier, source, sig, src, target):
+        # Copies the open source into place; False when an unnamed copy could
+        # not be linked
+        dst, tmp = self._open_tmp(os.path.dirname(target))
+        try:
+            copy_fd(src, dst, sig[0])
+            st = os.fstat(src)
+            os.fchmod(dst, stat.S_IMODE(st.st_mode))
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+            with self.path_locks('/' + partial):
+                # Linking never replaces a file created meanwhile, and a
+                # source changed during the copy is left alone
+                if _signature(source) == sig:
+                    if not self._link(dst, tmp, target):
+                        return False
+                    self._promoted(partial, tier, source, sig, target)
+            return True
+        finally:
+            os.close(dst)
+            if tmp:
+                try:
+                    os.unlink(tmp)
+                except FileNotFoundError:
+                    pass
+
+    def _promoted(self, partial, tier, source, sig, target):
+        with self.lock:
+            self.promoted[partial] = {
+                'tier': tier,
+                'source': source,
+                'size': sig[0],
+                'source_sig': sig,
+                'copy_sig': _signature(target),
+            }
+            self.used_bytes += sig[0]
+            self.promotions += 1
+        self.on_change(partial)
+        self._save()
+
+    def _make_room(self, size):
+        while True:
+            with self.lock:
+                if self.used_bytes + size <= self.budget_bytes or not self.promoted:
+                    return
+                coldest = next(iter(self.promoted))
+            self.demote(coldest)
+
+    def _make_parents(self, partial, source):
+        # Creates the missing parents of the copy with the mode of the source
+        # directories
+        missing = []
+        parent = os.path.dirname(partial)
+        while parent and not os.path.isdir(os.path.join(self.root, parent)):
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+        source_root = source[:len(source) - len(partial)]
+        for parent in reversed(missing):
+            directory = os.path.join(self.root, parent)
+            os.mkdir(directory)
+            os.chmod(directory, stat.S_IMODE(os.stat(os.path.join(source_root, parent)).st_mode))
+            with self.lock:
+                self.created_dirs.add(parent)
+
+    def _remove_parents(self, partial):
+        # Removes the directories created for copies once they are empty
+        parent = os.path.dirname(partial)
+        while True:
+            with self.lock:
+                if parent not in self.created_dirs:
+                    return
+            try:
+                os.rmdir(os.path.join(self.root, parent))
+            except OSError:
+                return
+            with self.lock:
+                self.created_dirs.discard(parent)
+            parent = os.path.dirname(parent)
+
+    def _open_tmp(self, directory):
+        # An unnamed file when the filesystem supports it, so nothing shows
+        # up in the mount while the copy runs
+        if self.unnamed:
+            try:
+                return os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o600), None
+            except (AttributeError, OSError):
+                self.unnamed = False
+        tmp = os.path.join(directory, '.promote.%d' % threading.get_ident())
+        return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), tmp
+
+    def _link(self, fd, tmp, target):
+        # False when an unnamed file cannot be linked at all
+        if tmp:
+            os.link(tmp, target)
+            return True
+        # A directory fd makes os.link call linkat, which follows the /proc
+        # symlink to the unnamed file with AT_SYMLINK_FOLLOW; link(2) does not
+        directory = os.open(os.path.dirname(target), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.link('/proc/self/fd/%d' % fd, os.path.basename(target),
+                    dst_dir_fd=directory, follow_symlinks=True)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise
+            # No /proc, or a filesystem that refuses: name the copies from
+            # now on
+            log.warning("Cannot link unnamed copies into %s (%s), using named ones", self.root, e)
+            self.unnamed = False
+            return False
+        finally:
+            os.close(directory)
+        return True
+
+    def _load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for partial, entry in state['promoted']:
+            if _signature(os.path.join(self.root, partial)) == entry['copy_sig']:
+                self.promoted[partial] = entry
+                self.used_bytes += entry['size']
+        self.created_dirs.update(d for d in state['dirs'] if os.path.isdir(os.path.join(self.root, d)))
+
+    def _save(self):
+        if not self.state_file:
+            return
+        with self.save_lock:
+            with self.lock:
+                # A list keeps the recency order
+                data = json.dumps({'promoted': list(self.promoted.items()), 'dirs': sorted(self.created_dirs)})
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.state_file)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'promoted': len(self.promoted),
+                'used_bytes': self.used_bytes,
+                'budget_bytes': self.budget_bytes,
+                'promotions': self.promotions,
+                'demotions': self.demotions,
+            }
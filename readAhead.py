@@ -0,0 +1,96 @@
+"""
+Sequential-read detection and background readahead for one open handle.
+
+Reads are assumed random until a few of them continue where the previous one
+ended. From then on the next `depth` windows past the read position are
+fetched on a shared thread pool, and later reads are sliced out of those
+buffers. The window doubles every time a read is served from a prefetched
+buffer, up to `max_window`. A read far from the expected position counts as
+a random seek and cancels everything in flight.
+"""
+
+import threading
+from concurrent.futures import CancelledError, wait
+
+SEQUENTIAL_AFTER = 2
+
+
+class ReadAhead:
+    def __init__(self, pool, fetch, size, window=128 << 10, max_window=8 << 20, depth=4):
+        # fetch(offset, length) reads from the slow tier
+        self.pool = pool
+        self.fetch = fetch
+        self.size = size
+        self.initial_window = window
+        self.window = window
+        self.max_window = max_window
+        self.depth = depth
+        self.next_offset = None
+        self.sequential = 0
+        # window start -> (length, future), in the order they were submitted
+        self.buffers = {}
+        self.prefetch_end = 0
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.next_offset is not None and abs(offset - self.next_offset) <= self.window:
+                self.sequential += 1
+            else:
+                self._reset()
+            self.next_offset = offset + length
+            buffered = self._take(offset)
+            if self.sequential >= SEQUENTIAL_AFTER:
+                self._schedule(offset + length)
+
+        if buffered is not None:
+            start, future = buffered
+            try:
+                data = future.result()
+            except (CancelledError, OSError):
+                data = b''
+            head = data[offset - start:offset - start + length]
+            if len(head) == length or start + len(data) >= self.size:
+                with self.lock:
+                    self.window = min(self.window * 2, self.max_window)
+                return head
+            # The window ends inside this read: fetch the rest directly
+            return head + self.fetch(offset + len(head), length - len(head))
+
+        return self.fetch(offset, length)
+
+    def _take(self, offset):
+        # Find the buffer covering `offset` and forget the ones behind it
+        found = None
+        for start in list(self.buffers):
+            window, future = self.buffers[start]
+            if start <= offset < start + window:
+                found = (start, future)
+            elif start + window <= offset:
+                del self.buffers[start]
+        return found
+
+    def _schedule(self, position):
+        self.prefetch_end = max(self.prefetch_end, position)
+        target = min(position + self.depth * self.window, self.size)
+        while self.prefetch_end < target:
+            start, window = self.prefetch_end, self.window
+            self.buffers[start] = (window, self.pool.submit(self.fetch, start, window))
+            self.prefetch_end = start + window
+
+    def _reset(self):
+        futures = [future for window, future in self.buffers.values()]
+        for future in futures:
+            future.cancel()
+        self.buffers.clear()
+        self.sequential = 0
+        self.window = self.initial_window
+        self.prefetch_end = 0
+        return futures
+
+    def cancel(self):
+        # On release: the fd is about to be closed, so also wait for the
+        # fetches that were already running
+        with self.lock:
+            futures = self._reset()
+        wait(futures)
@@ -0,0 +1,536 @@
+"""
+In-process client for the remote tier, and the server it talks to.
+
+Through sshfs every remote operation crosses FUSE twice (the mount, then
+sshfs) and waits for its own SFTP exchange. With --backend the mount talks
+to a `BackendServer` on the remote host directly, through `RemoteClient`:
+
+- the operations are those the mount needs of the remote tier: stat, list
+  (every entry with its attributes), read-range, write-range, rename, plus
+  create, truncate, unlink, mkdir, rmdir and fsync. Paths are relative to
+  the served directory.
+- the client keeps a pool of `connections` persistent TCP connections.
+  Requests carry an id and are pipelined: any number of them can be in
+  flight on one connection, the server runs them concurrently and answers
+  in whatever order they finish, so concurrent range reads from FUSE
+  threads overlap instead of queueing behind each other.
+- every request waits at most `timeout` seconds (ETIMEDOUT); a connection
+  that fails fails its pending requests with ECONNRESET and is replaced on
+  next use.
+
+The server is meant to run on the remote host
+(python3 remoteBackend.py <directory> [--port N]); on 127.0.0.1 it is also
+the stand-in the benchmarks use, with --delay to play a slow link. Traffic
+is plaintext, so the server binds to 127.0.0.1 and is reached through an
+SSH tunnel (ssh -L 7370:127.0.0.1:7370 <host>). It refuses any other
+address unless it is given a shared secret (--secret-file). With a secret,
+every connection opens with a challenge: the server sends a random nonce,
+and the client has to answer with its HMAC-SHA256 under the secret. Paths
+are resolved, symlinks included, and never leave the served directory.
+
+Frames: a request is REQUEST (id, op, path length, two integer arguments,
+data length) followed by the UTF-8 path and the data; a response is
+RESPONSE (id, errno, payload length) followed by the payload: raw bytes for
+reads, JSON for everything else.
+"""
+
+import errno
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+log = logging.getLogger(__name__)
+
+REQUEST = struct.Struct('!IBHqqI')
+RESPONSE = struct.Struct('!IiI')
+
+STAT, LIST, READ, WRITE, RENAME, CREATE, TRUNCATE, UNLINK, MKDIR, RMDIR, FSYNC = range(11)
+
+# What stat and list report per entry, as getattr does
+FIELDS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
+          'st_nlink', 'st_size', 'st_uid', 'st_blocks')
+
+DEFAULT_PORT = 7370
+
+# The server's challenge, and how long a client has to answer it
+NONCE_SIZE = 16
+HANDSHAKE_TIMEOUT = 10.0
+
+
+def _recv_exactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionResetError(errno.ECONNRESET, "connection closed")
+        view = view[received:]
+    return bytes(data)
+
+
+def _attrs(st):
+    return dict((key, getattr(st, key)) for key in FIELDS)
+
+
+def _answer(secret, nonce):
+    return hmac.new(secret, nonce, hashlib.sha256).digest()
+
+
+def _loopback(host):
+    # Whether every address `host` stands for is a loopback one
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback
+                   for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+
+def read_secret(path):
+    # The shared secret in `path`, for --secret-file and --backend-secret
+    with open(path, 'rb') as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError("%s holds no secret" % path)
+    return secret
+
+
+class _Connection:
+    # One socket, any number of requests in flight on it
+    def __init__(self, address, timeout, secret=None):
+        self.sock = socket.create_connection(address, timeout)
+        if secret is not None:
+            try:
+                nonce = _recv_exactly(self.sock, NONCE_SIZE)
+                self.sock.sendall(_answer(secret, nonce))
+            except OSError:
+                self.sock.close()
+                raise
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # request id -> Future
+        self.pending = {}
+        self.next_id = 0
+        self.broken = None
+        self.thread = threading.Thread(target=self._read_responses, name='backend-client', daemon=True)
+        self.thread.start()
+
+    def request(self, op, path, a, b, data):
+        future = Future()
+        with self.lock:
+            if self.broken:
+                raise self.broken
+            self.next_id = (self.next_id + 1) & 0xffffffff
+            request_id = self.next_id
+            self.pending[request_id] = future
+        encoded = path.encode()
+        header = REQUEST.pack(request_id, op, len(encoded), a, b, len(data))
+        try:
+            with self.send_lock:
+                self.sock.sendall(b''.join((header, encoded, data)))
+        except OSError as e:
+            self._fail(ConnectionResetError(errno.ECONNRESET, str(e)))
+        return future
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def _read_responses(self):
+        try:
+            while True:
+                request_id, error, length = RESPONSE.unpack(_recv_exactly(self.sock, RESPONSE.size))
+                payload = _recv_exactly(self.sock, length)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    # Its caller gave up on it
+                    continue
+                if error:
+                    future.set_exception(OSError(error, payload.decode() or os.strerror(error)))
+                else:
+                    future.set_result(payload)
+        except OSError as e:
+            self._fail(e if isinstance(e, ConnectionResetError) else ConnectionResetError(errno.ECONNRESET, str(e)))
+
+    def _fail(self, error):
+        with self.lock:
+            if self.broken is None:
+                self.broken = error
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def forget(self, future):
+        with self.lock:
+            for request_id, pending in list(self.pending.items()):
+                if pending is future:
+                    del self.pending[request_id]
+
+    def close(self):
+        self._fail(ConnectionResetError(errno.ECONNRESET, "connection closed"))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RemoteClient:
+    def __init__(self, address, connections=4, timeout=10.0, secret=None):
+        self.address = address
+        # Answers the server's challenge (see --backend-secret)
+        self.secret = secret
+        self.size = connections
+        self.timeout = timeout
+        self.connections = []
+        self.requests = 0
+        self.reconnects = 0
+        self.timeouts = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Opens the pool; raises OSError when the server does not answer
+        connections = [_Connection(self.address, self.timeout, self.secret) for _ in range(self.size)]
+        with self.lock:
+            old, self.connections = self.connections, connections
+        for connection in old:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            old, self.connections = self.connections, []
+        for connection in old:
+            connection.close()
+
+    def _connection(self):
+        # The least busy connection, replacing one that broke
+        with self.lock:
+            if not self.connections:
+                raise OSError(errno.ENOTCONN, "not connected")
+            connection = min(self.connections, key=_Connection.in_flight)
+            in_flight = connection.in_flight() + 1
+            self.max_in_flight = max(self.max_in_flight, in_flight)
+            self.requests += 1
+            broken = connection.broken
+        if broken is None:
+            return connection
+        fresh = _Connection(self.address, self.timeout, self.secret)
+        with self.lock:
+            if connection in self.connections:
+                self.connections[self.connections.index(connection)] = fresh
+                self.reconnects += 1
+            else:
+                fresh.close()
+                fresh = self.connections[0]
+        connection.close()
+        return fresh
+
+    def _call(self, op, path, a=0, b=0, data=b''):
+        connection = self._connection()
+        future = connection.request(op, path, a, b, data)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            connection.forget(future)
+            with self.lock:
+                self.timeouts += 1
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT), path)
+
+    def stat(self, path):
+        return json.loads(self._call(STAT, path))
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def list(self, path):
+        # {name: attrs} of the directory
+        return json.loads(self._call(LIST, path))
+
+    def read_range(self, path, offset, length):
+        data = self._call(READ, path, offset, length)
+        with self.lock:
+            self.bytes_read += len(data)
+        return data
+
+    def write_range(self, path, offset, data):
+        written = json.loads(self._call(WRITE, path, offset, 0, bytes(data)))
+        with self.lock:
+            self.bytes_written += written
+        return written
+
+    def rename(self, old, new):
+        self._call(RENAME, old + '\0' + new)
+
+    def create(self, path, mode):
+        # Creates the file, and the directories above it, without truncating
+        self._call(CREATE, path, mode)
+
+    def truncate(self, path, length):
+        self._call(TRUNCATE, path, length)
+
+    def unlink(self, path):
+        self._call(UNLINK, path)
+
+    def mkdir(self, path, mode):
+        self._call(MKDIR, path, mode)
+
+    def rmdir(self, path):
+        self._call(RMDIR, path)
+
+    def fsync(self, path):
+        self._call(FSYNC, path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connections': len(self.connections),
+                'requests': self.requests,
+                'max_in_flight': self.max_in_flight,
+                'reconnects': self.reconnects,
+                'timeouts': self.timeouts,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+            }
+
+
+class BackendServer:
+    def __init__(self, root, address=('127.0.0.1', DEFAULT_PORT), workers=16, delay=0.0, secret=None):
+        if secret is None and not _loopback(address[0]):
+            raise ValueError("serving beyond loopback needs a secret; tunnel through ssh instead")
+        self.root = os.path.realpath(root)
+        self.address = address
+        # Clients have to prove they know it before any request
+        self.secret = secret
+        # Seconds added to every request, as a slow link would
+        self.delay = delay
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.sock = None
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.handlers = {
+            STAT: self._stat, LIST: self._list, READ: self._read, WRITE: self._write,
+            RENAME: self._rename, CREATE: self._create, TRUNCATE: self._truncate,
+            UNLINK: self._unlink, MKDIR: self._mkdir, RMDIR: self._rmdir, FSYNC: self._fsync,
+        }
+
+    def start(self):
+        # Binds and serves in the background; `address` is then the real one
+        self.sock = socket.create_server(self.address)
+        self.address = self.sock.getsockname()[:2]
+        self.thread = threading.Thread(target=self._accept, name='backend-server', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            clients, self.clients = self.clients, set()
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        self.thread.join()
+        self.pool.shutdown(wait=True)
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.clients.add(client)
+            threading.Thread(target=self._serve, args=(client,), name='backend-connection', daemon=True).start()
+
+    def _serve(self, client):
+        send_lock = threading.Lock()
+        try:
+            if self.secret is not None and not self._challenge(client):
+                log.warning("Rejected a backend client that failed the challenge")
+                return
+            while True:
+                request_id, op, path_length, a, b, length = REQUEST.unpack(_recv_exactly(client, REQUEST.size))
+                path = _recv_exactly(client, path_length).decode()
+                data = _recv_exactly(client, length) if length else b''
+                self.pool.submit(self._handle, client, send_lock, request_id, op, path, a, b, data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.clients.discard(client)
+            client.close()
+
+    def _challenge(self, client):
+        nonce = os.urandom(NONCE_SIZE)
+        client.settimeout(HANDSHAKE_TIMEOUT)
+        client.sendall(nonce)
+        answer = _recv_exactly(client, hashlib.sha256().digest_size)
+        client.settimeout(None)
+        return hmac.compare_digest(answer, _answer(self.secret, nonce))
+
+    def _handle(self, client, send_lock, request_id, op, path, a, b, data):
+        if self.delay:
+            time.sleep(self.delay)
+        error, payload = errno.ENOSYS, b''
+        handler = self.handlers.get(op)
+        if handler:
+            try:
+                payload = handler(path, a, b, data)
+                error = 0
+            except OSError as e:
+                error = e.errno or errno.EIO
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        try:
+            with send_lock:
+                client.sendall(RESPONSE.pack(request_id, error, len(payload)) + payload)
+        except OSError:
+            pass
+
+    def _real(self, path, follow=True):
+        # Paths never leave the served directory, through symlinks either.
+        # Without `follow` a final symlink is the path itself (lstat,
+        # unlink, rename), and only its parent is resolved
+        path = os.path.join(self.root, path)
+        if follow:
+            real = os.path.realpath(path)
+        else:
+            head, name = os.path.split(os.path.normpath(path))
+            real = os.path.join(os.path.realpath(head), name)
+        if real != self.root and not real.startswith(self.root + os.sep):
+            raise PermissionError(errno.EACCES, "outside the served directory")
+        return real
+
+    def _stat(self, path, a, b, data):
+        return _attrs(os.lstat(self._real(path, follow=False)))
+
+    def _list(self, path, a, b, data):
+        listing = {}
+        with os.scandir(self._real(path)) as it:
+            for entry in it:
+                try:
+                    listing[entry.name] = _attrs(entry.stat(follow_symlinks=False))
+                except OSError:
+                    continue
+        return listing
+
+    def _read(self, path, offset, length, data):
+        fd = os.open(self._real(path), os.O_RDONLY)
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    def _write(self, path, offset, b, data):
+        fd = os.open(self._real(path), os.O_WRONLY)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.pwrite(fd, view, offset + len(data) - len(view)):]
+            return len(data)
+        finally:
+            os.close(fd)
+
+    def _rename(self, paths, a, b, data):
+        old, _, new = paths.partition('\0')
+        os.rename(self._real(old, follow=False), self._real(new, follow=False))
+        return None
+
+    def _create(self, path, mode, b, data):
+        real = self._real(path)
+        os.makedirs(os.path.dirname(real), 0o777, True)
+        os.close(os.open(real, os.O_WRONLY | os.O_CREAT, mode))
+        return None
+
+    def _truncate(self, path, length, b, data):
+        os.truncate(self._real(path), length)
+        return None
+
+    def _unlink(self, path, a, b, data):
+        os.unlink(self._real(path, follow=False))
+        return None
+
+    def _mkdir(self, path, mode, b, data):
+        os.mkdir(self._real(path, follow=False), mode)
+        return None
+
+    def _rmdir(self, path, a, b, data):
+        os.rmdir(self._real(path, follow=False))
+        return None
+
+    def _fsync(self, path, a, b, data):
+        fd = os.open(self._real(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return None
+
+
+def parse_address(text):
+    # "host:port" or "host", for --backend
+    host, _, port = text.rpartition(':')
+    if not host:
+        return text, DEFAULT_PORT
+    return host, int(port)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 remoteBackend.py <directory> [--port %d] [--delay S] [--host 127.0.0.1 [--secret-file <file>]]" % DEFAULT_PORT)
+        print("Traffic is plaintext: reach the server through an SSH tunnel. A --host other than")
+        print("a loopback address requires --secret-file, and the mount's --backend-secret")
+        sys.exit(1)
+    host = '127.0.0.1'
+    if "--host" in sys.argv:
+        host = sys.argv[sys.argv.index("--host") + 1]
+    port = DEFAULT_PORT
+    if "--port" in sys.argv:
+        port = int(sys.argv[sys.argv.index("--port") + 1])
+    delay = 0.0
+    if "--delay" in sys.argv:
+        delay = float(sys.argv[sys.argv.index("--delay") + 1])
+    secret = None
+    if "--secret-file" in sys.argv:
+        secret = read_secret(sys.argv[sys.argv.index("--secret-file") + 1])
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        server = BackendServer(sys.argv[1], (host, port), delay=delay, secret=secret)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    server.start()
+    log.info("Serving %s on %s:%d", server.root, *server.address)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
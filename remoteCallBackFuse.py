@@ -1,98 +1,728 @@
-import subprocess
 import os
 import sys
 import errno
+import stat
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from fuse import FUSE, FuseOSError, Operations
 
+from blockCache import BlockCache
+from attrCache import DEFAULT_TTLS, AttrCache, parse_ttls
+from dirListing import DirCache, tier_mtimes, union
+from durability import MODES, Durability
+from fileCopy import CHUNK, copy_fd, copy_range, move
+from handleTable import BackendHandle, FileHandle, HandleTable
+from locking import StripedLocks
+from mappingCache import MappingCache
+from metadataIndex import MISSING, MetadataIndex
+from metrics import Metrics, StatsFile
+from negativeCache import DirectoryNames, NegativeCache
+from promotion import Promoter
+from readAhead import ReadAhead
+from remoteBackend import RemoteClient, parse_address, read_secret
+from remotePrefetch import RemotePrefetcher
+from remoteTier import RemoteTier
+from resolutionCache import ResolutionCache
+from tierChain import GIVE_UP, MISS, STAT_FIELDS, Found, Tier, TierChain, attributes, parse_tiers
+from tierProbe import ABANDONED, POLICIES, TierProber
+from traceLog import TraceRecorder
+from units import parse_size
+from watcher import WATCHED_TTL, Watcher
+from writeStaging import WriteStager
+
+log = logging.getLogger(__name__)
+
+
 class Passthrough(Operations):
-    def __init__(self, root, fallbackPath=None, remote_host=None, remote_directory=None, local_mount_point=None):
+    def __init__(self, root, fallbackPath=None, remote_host=None, remote_directory=None, local_mount_point=None, threads=1, write_back=0, durability=None, attr_ttls=None, block_cache=None, readahead=0, promoter=None, miss_ttl=1.0, index=None, watcher=None, prober=None, remote=None, prefetcher=None, backend=None, recorder=None, stager=None, mappings=None, read_only=(), uncached=()):
         self.root = root
         self.fallbackPath = fallbackPath
         self.remote_host = remote_host
         self.remote_directory = remote_directory
         self.local_mount_point = local_mount_point
+        # The sshfs tier, mounted in the background and skipped while it
+        # does not answer (see --remote-timeout)
+        self.remote = remote
+        if remote is None and fallbackPath and remote_host and remote_directory and local_mount_point:
+            self.remote = RemoteTier(remote_host, remote_directory, local_mount_point)
+        # Serves the remote tier in place of sshfs, with range requests over
+        # pooled connections (see --backend); its paths are virtual ones
+        self.backend = backend
+        # The tiers in lookup order. Paths on none go to fallbackFS; the
+        # staging area and the remote tier are written to explicitly. Hooks
+        # stand in for the probes of the tiers something else answers for;
+        # the backend's paths are virtual, with no directory to list.
+        # `read_only` and `uncached` name tiers (see --read-only and
+        # --uncached)
+        remote_root = None
+        if self.remote:
+            remote_root = '' if backend else local_mount_point
+        self.tiers = TierChain([
+            Tier('primary', root),
+            Tier('staged', stager.data if stager and self.remote else None, find=self._find_staged),
+            Tier('fallback', fallbackPath, write_target=True, find=self._find_fallback),
+            Tier('remote', remote_root, listed=not backend, find=self._find_remote),
+        ], read_only, uncached)
+        self.resolution_cache = ResolutionCache(uncached=self.tiers.uncached)
+        # getattr results, kept for a per-tier TTL (see --attr-ttl)
+        self.attr_cache = AttrCache(attr_ttls, uncached=self.tiers.uncached)
+        # Merged readdir listings, reused while no tier's directory changed
+        self.dir_cache = DirCache()
+        # Paths found on no tier, for `miss_ttl` seconds (see --miss-ttl)
+        self.negative_cache = NegativeCache(miss_ttl)
+        # Listings of remote directories, trusted as long as remote attributes
+        # are, so misses there are answered without a round trip
+        self.remote_names = None
+        if local_mount_point and not prefetcher and not backend:
+            self.remote_names = DirectoryNames(local_mount_point, self.attr_cache.ttls.get('remote', 0),
+                                               call=lambda fn, *args: self._on('remote', fn, *args))
 
-        if fallbackPath and remote_host and remote_directory and local_mount_point:
-            # Mount the remote directory using SSHFS
-            mount_command = ['sshfs', f'{self.remote_host}:{self.remote_directory}', self.local_mount_point, '-o', 'nonempty,rw,sync_readdir']
-            subprocess.run(mount_command, check=True)
-            print("Server mounted")
+        # Writable handles hold back up to `write_back` bytes (see --write-back)
+        self.handles = HandleTable(write_back)
+        # Read-only fallback files served from shared mappings (see
+        # --mmap-budget)
+        self.mappings = mappings
+        # What flush and fsync cost (see --durability)
+        self.durability = durability or Durability()
+        # Optional local cache of remote-tier blocks (see --cache-dir)
+        self.block_cache = block_cache
+        # Background readahead of sequential reads from the fallback and
+        # remote tiers, `readahead` windows ahead (see --readahead)
+        self.readahead_depth = readahead
+        self.readahead_pool = ThreadPoolExecutor(max_workers=8) if readahead else None
+
+        # FUSE may dispatch from several threads (see --threads): at most
+        # `threads` operations run at once, and operations on the same path
+        # serialize on these locks
+        self.gate = threading.BoundedSemaphore(threads)
+        self.path_locks = StripedLocks()
+
+        # Copies hot fallback and remote files into primaryFS (see
+        # --promote-budget)
+        self.promoter = promoter
+        if promoter:
+            promoter.start(self.path_locks, self._invalidate, self._on)
+
+        # Entries of fallbackFS and the remote tree kept across mounts (see
+        # --index); started once the remote tree is mounted
+        self.index = index
+        # Notices changes made to the tiers outside the mount (see --watch);
+        # started with the index
+        self.watcher = watcher
+
+        # Latency and cache numbers, readable at /.fusestats
+        self.metrics = Metrics()
+        self.metrics.add_source('resolution', self.resolution_cache.stats)
+        self.metrics.add_source('attr', self.attr_cache.stats)
+        self.metrics.add_source('dir', self.dir_cache.stats)
+        self.metrics.add_source('negative', self.negative_cache.stats)
+        if self.remote_names:
+            self.metrics.add_source('remote_names', self.remote_names.stats)
+        if block_cache:
+            self.metrics.add_source('block', block_cache.stats)
+        if promoter:
+            self.metrics.add_source('promotion', promoter.stats)
+        if index:
+            self.metrics.add_source('index', index.stats)
+        if watcher:
+            self.metrics.add_source('watcher', watcher.stats)
+        if mappings:
+            self.metrics.add_source('mmap', mappings.stats)
+        self.stats_file = StatsFile(self.metrics)
+        # Times every tier probe into the metrics, and bounds the remote one
+        # by --remote-deadline, or else by --remote-timeout (see --hedge)
+        self.prober = prober or TierProber()
+        self.prober.start(self.metrics, {'remote': self.remote.record} if self.remote else None,
+                          {'remote': self._remote_exists} if backend else None,
+                          self.remote.timeout if self.remote else None)
+        self.metrics.add_source('probe', self.prober.stats)
+        if self.remote:
+            self.metrics.add_source('remote', self.remote.stats)
+        if backend:
+            self.metrics.add_source('backend', backend.stats)
+        # Whole remote listings with attributes, instead of a probe and an
+        # lstat per entry (see --prefetch)
+        self.prefetcher = prefetcher
+        if prefetcher:
+            prefetcher.start(self._seed_remote, lambda fn, *args: self._on('remote', fn, *args),
+                             backend.list if backend else None)
+            self.metrics.add_source('prefetch', prefetcher.stats)
+        # Remote-tier writes land on local disk and are uploaded in the
+        # background (see --stage-dir)
+        self.stager = stager if self.remote else None
+        if self.stager:
+            self.stager.start(self._upload, self._invalidate)
+            self.metrics.add_source('staging', self.stager.stats)
+        # Binary trace of every operation (see --trace)
+        self.recorder = recorder
+        if recorder:
+            recorder.start()
+            self.metrics.add_source('trace', recorder.stats)
+        # Checked before the debug logs of per-op paths, so they cost an
+        # attribute lookup when debug logging is off (see --log-level)
+        self.verbose = log.isEnabledFor(logging.DEBUG)
+
+        # Nothing waits for sshfs: the local tiers serve while it mounts
+        if self.remote:
+            self.remote.start(self._remote_came_up)
+        if index:
+            index.start(lambda tier: tier != 'remote' or self._remote_up(), self._on)
+        if watcher:
+            watcher.start(self._invalidate, self._touched, self._on)
 
     def __del__(self):
-        if self.fallbackPath and self.remote_host and self.remote_directory and self.local_mount_point:
-            # Unmount the remote directory
-            unmount_command = ['fusermount', '-u', self.local_mount_point]
-            subprocess.run(unmount_command, check=True)
-            print("Server unmounted")
+        # Unmount the remote directory
+        if getattr(self, 'remote', None):
+            self.remote.stop()
+
+    def __call__(self, op, *args):
+        if args and args[0] in self.stats_file:
+            return self.stats_file(op, *args)
+        with self.gate:
+            start = time.perf_counter()
+            try:
+                result = super().__call__(op, *args)
+            except OSError as e:
+                elapsed = time.perf_counter() - start
+                self.metrics.observe(op, elapsed, failed=True)
+                if self.recorder:
+                    self.recorder.record(op, args, None, start, elapsed, self._traced_tier(args), e.errno)
+                raise
+        if op == 'readdir':
+            result = self._gated(result)
+            if self.recorder:
+                result = self.recorder.listing(args, result, start)
+            return self.metrics.timed(op, result, start)
+        tier = None
+        if op in ('read', 'write'):
+            tier = self.handles.get(args[-1]).tier
+            self.metrics.transfer(tier, op, len(result) if op == 'read' else result)
+        elif op in ('open', 'create'):
+            tier = self.handles.get(result).tier
+        elapsed = time.perf_counter() - start
+        self.metrics.observe(op, elapsed, tier)
+        if self.recorder:
+            self.recorder.record(op, args, result, start, elapsed, tier or self._traced_tier(args))
+        return result
 
+    def _gated(self, listing):
+        # readdir is a generator: it does its work, remote scans included,
+        # while FUSE iterates it, and holds its slot of the gate until then
+        with self.gate:
+            yield from listing
 
-    def _full_path(self, partial, useFallBack=False):
+    def _traced_tier(self, args):
+        # The tier the path of a traced call resolves to, if known
+        if args and isinstance(args[0], str):
+            entry = self.resolution_cache.peek(args[0].lstrip("/"))
+            if entry is not None:
+                return entry[0]
+        return None
+
+    def _full_path(self, partial, useFallBack=False, write=False):
+        if useFallBack:
+            # Explicitly asked for the fallback path
+            if partial.startswith("/"):
+                partial = partial[1:]
+            return os.path.join(self.fallbackPath, partial)
+        tier, full_path = self._resolve(partial)
+        if write:
+            self._writable(tier)
+        if tier == 'remote' and self.backend:
+            # Served by the backend: there is no local path to hand to os
+            raise FuseOSError(errno.EOPNOTSUPP)
+        return full_path
+
+    def _resolve(self, partial):
+        # Returns (tier, real path) for a virtual path
+        return self._lookup(partial)[:2]
+
+    def _lookup(self, partial):
+        # Returns (tier, real path, stat) for a virtual path. The stat is what
+        # the lookup found the path with: a probe's stat result, or the
+        # attributes the index, a prefetched listing or the backend brought
+        # along; None when the resolution was cached or the tier gives
+        # neither; False when the path is on no tier, and tier and path say
+        # where it would be created
         if partial.startswith("/"):
             partial = partial[1:]
 
-        # Find out the real path. If it has been requested for a fallback path, use it.
-        path = primaryPath = os.path.join(self.root if not useFallBack else self.fallbackPath, partial)
+        cached = self.resolution_cache.get(partial)
+        if cached is not None:
+            return cached + (None,)
+        target, target_path = self.tiers.target(partial)
+        # Paths known to be on no tier skip the probes
+        if self.negative_cache.get(partial):
+            return target, target_path, False
+        generation = self.resolution_cache.generation
+        attr_generation = self.attr_cache.generation
+        missing = self.negative_cache.generation
+
+        found = self.tiers.lookup(partial, self.prober.probe)
+        if found is GIVE_UP:
+            # Not a miss to remember
+            return target, target_path, False
+        if found is None:
+            self.negative_cache.put(partial, missing)
+            return target, target_path, False
+        tier, full_path, st = found
+        self.resolution_cache.put(partial, tier, full_path, generation)
+        if isinstance(st, dict):
+            self.attr_cache.put(partial, tier, st, attr_generation)
+        elif not isinstance(st, os.stat_result):
+            st = None
+        return tier, full_path, st
+
+    def _find_staged(self, partial, path, state):
+        # Remote-tier files being written, or not uploaded yet
+        return self.stager.lookup(partial) is not None
+
+    def _find_fallback(self, partial, path, state):
+        # The index knows the lower tiers without probing them, attributes included
+        found = self.index.lookup(partial) if self.index else None
+        if found is MISSING:
+            return MISS
+        if found is not None:
+            tier, attrs = found
+            if self.watcher:
+                self.watcher.seen(tier, os.path.dirname(partial))
+            return Found(tier, self.index.real_path(tier, partial), attrs)
+
+        # With --hedge the remote probe runs while fallbackFS is probed
+        if self.prober.hedge and not self.prefetcher and self._remote_wanted(partial):
+            state['remote'] = self.prober.launch('remote', self._remote_path(partial))
+
+        # If the path does not exist, try to look in the fallback filesystem.
+        found = self.prober.probe('fallback', path)
+        if found:
+            self.prober.discard(state.get('remote'))
+        return found
+
+    def _find_remote(self, partial, path, state):
+        # If the path does not exist in the fallback filesystem, check if it exists in the remote filesystem.
+        if not self._remote_up():
+            # Still mounting, or fenced off: not a miss to remember
+            self.prober.unreachable('remote')
+            return GIVE_UP
+        if not self._remote_wanted(partial):
+            return None
+        # With --prefetch the listing of the parent answers for every entry
+        listing = self.prefetcher.listing(os.path.dirname(partial)) if self.prefetcher else None
+        if listing is not None:
+            found = listing.get(os.path.basename(partial))
+        else:
+            pending = state.get('remote')
+            if pending is None:
+                # Runs on the pool, bounded by --remote-deadline or
+                # --remote-timeout
+                pending = self.prober.launch('remote', path)
+            found = self.prober.settle('remote', path, pending)
+            if found is ABANDONED:
+                # Gave up on the remote tier: a miss, but not one to remember
+                return GIVE_UP
+        if found and self.watcher:
+            self.watcher.seen('remote', os.path.dirname(partial))
+        return found
+
+    def _remote_wanted(self, partial):
+        # Whether the remote tier is worth probing for `partial`: a cached
+        # listing of the remote parent saves the round trip for misses
+        return self._remote_up() and not (self.remote_names and self.remote_names.absent(partial))
+
+    def _writable(self, tier):
+        # Operations that change a path refuse a read-only tier (see
+        # --read-only)
+        if self.tiers.read_only(tier):
+            raise FuseOSError(errno.EROFS)
+
+    def _remote_up(self):
+        return self.remote is not None and self.remote.available()
+
+    def _remote_path(self, partial):
+        # The real path of `partial` on the remote tier
+        if self.backend:
+            return partial
+        return os.path.join(self.local_mount_point, partial)
+
+    def _remote_exists(self, partial):
+        # The remote probe when a backend serves the tier: the attributes,
+        # which spare getattr its own request, or None
+        try:
+            return self.backend.stat(partial)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _lstat(self, tier, full_path):
+        # getattr's fields of `full_path` on `tier`
+        if tier == 'remote' and self.backend:
+            return self._on(tier, self.backend.stat, full_path)
+        return attributes(self._on(tier, os.lstat, full_path))
+
+    def _remote_came_up(self):
+        # Misses and listings seen while the remote tier was away are stale
+        self.negative_cache.invalidate_tree('')
+        self.dir_cache.invalidate_tree('')
+        if self.remote_names:
+            self.remote_names.invalidate_tree('')
+        if self.prefetcher:
+            self.prefetcher.invalidate_tree('')
+        if self.stager:
+            self.stager.resume()
+
+    def _seed_remote(self, directory, entries):
+        # A remote listing came in: its entries that no higher tier shadows
+        # are resolved, with their attributes, before anyone asks
+        generations = (self.resolution_cache.generation, self.attr_cache.generation)
+        shadowed = set()
+        for tier, local in self._tier_dirs(directory):
+            if tier == 'remote':
+                continue
+            try:
+                shadowed.update(os.listdir(local))
+            except OSError:
+                pass
+        for name, attrs in entries.items():
+            if name in shadowed:
+                continue
+            child = os.path.join(directory, name)
+            self.resolution_cache.put(child, 'remote', self._remote_path(child), generations[0])
+            self.attr_cache.put(child, 'remote', attrs, generations[1])
+
+    def _download(self, partial, staged, truncate=False):
+        # Fills the staged copy of remote-tier `partial`: its mode, and its
+        # content unless it is about to be truncated
+        remote_path = self._remote_path(partial)
+        if self.backend:
+            attrs = self._on('remote', self.backend.stat, remote_path)
+            fd = os.open(staged, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(attrs['st_mode']))
+            try:
+                offset = 0
+                while not truncate:
+                    data = self._on('remote', self.backend.read_range, remote_path, offset, CHUNK)
+                    if not data:
+                        break
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+            finally:
+                os.close(fd)
+            return
+        src = self._on('remote', os.open, remote_path, os.O_RDONLY)
+        try:
+            st = os.fstat(src)
+            fd = os.open(staged, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(st.st_mode))
+            try:
+                if not truncate:
+                    copy_fd(src, fd, st.st_size)
+            finally:
+                os.close(fd)
+        finally:
+            os.close(src)
+
+    def _upload(self, partial, staged):
+        # Runs on the stager's threads: writes the staged copy of `partial`
+        # next to it on the remote tier, then renames it in place. Only the
+        # metadata calls are bounded by --remote-timeout; the copy takes as
+        # long as it takes
+        remote_path = self._remote_path(partial)
+        tmp = os.path.join(os.path.dirname(remote_path), '.%s.upload' % os.path.basename(remote_path))
+        src = os.open(staged, os.O_RDONLY)
+        try:
+            st = os.fstat(src)
+            if self.backend:
+                # Creates the directories above it too
+                self.remote.call(self.backend.create, tmp, stat.S_IMODE(st.st_mode))
+                self.remote.call(self.backend.truncate, tmp, 0)
+                offset = 0
+                while offset < st.st_size:
+                    data = os.pread(src, CHUNK, offset)
+                    if not data:
+                        break
+                    self.remote.call(self.backend.write_range, tmp, offset, data)
+                    offset += len(data)
+                self.remote.call(self.backend.rename, tmp, remote_path)
+                return
+            self.remote.call(os.makedirs, os.path.dirname(remote_path), 0o777, True)
+            dst = self.remote.call(os.open, tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(st.st_mode))
+            try:
+                copy_fd(src, dst, st.st_size)
+            finally:
+                os.close(dst)
+            self.remote.call(os.rename, tmp, remote_path)
+        finally:
+            os.close(src)
 
-        # If the path does not exist and we haven't been asked for the fallback path, try to look in the fallback filesystem.
-        if not os.path.exists(primaryPath) and not useFallBack:
-            path = fallbackPath = os.path.join(self.fallbackPath, partial)
+    def _open_staged(self, path, flags, fill, mode=0o644):
+        # A writable handle on the staged copy of a remote-tier file; `fill`
+        # brings its remote content over the first time (see --stage-dir)
+        partial = path.lstrip("/")
+        with self.path_locks(path):
+            entry = self.stager.stage(partial, fill)
+            staged = self.stager.real_path(partial)
+            try:
+                fd = os.open(staged, flags, mode)
+            except BaseException:
+                self.stager.released(partial, entry)
+                raise
+            finally:
+                # Now served from the staging area
+                self._invalidate(path)
+        handle = FileHandle(fd, path, 'staged', staged, flags)
+        handle.staged = entry
+        return self.handles.register(handle)
 
-            # If the path does not exist in the fallback filesystem, check if it exists in the remote filesystem.
-            if not os.path.exists(fallbackPath) and self.remote_host and self.remote_directory and self.local_mount_point:
-                remote_full_path = os.path.join(self.local_mount_point, partial)
-                if os.path.exists(remote_full_path):
-                    path = remote_full_path
+    def _on(self, tier, fn, *args):
+        # fn(*args), bounded by the per-op timeout when it reaches the remote
+        # tier (see --remote-timeout)
+        if tier == 'remote' and self.remote:
+            return self.remote.call(fn, *args)
+        return fn(*args)
 
-        return path
+    def _invalidate(self, path, tree=False):
+        # Called after every operation of the mount that creates, removes or
+        # moves a path, so cached resolutions never point at the wrong tier
+        partial = path[1:] if path.startswith("/") else path
+        if tree:
+            self.resolution_cache.invalidate_tree(partial)
+            self.attr_cache.invalidate_tree(partial)
+            self.negative_cache.invalidate_tree(partial)
+            if self.remote_names:
+                self.remote_names.invalidate_tree(partial)
+            if self.prefetcher:
+                self.prefetcher.invalidate_tree(partial)
+        else:
+            self.resolution_cache.invalidate(partial)
+            self.attr_cache.invalidate(partial)
+            self.negative_cache.invalidate(partial)
+            if self.remote_names:
+                self.remote_names.invalidate(partial)
+            if self.prefetcher:
+                self.prefetcher.invalidate(partial)
+        if self.index:
+            self.index.invalidate(partial, tree)
+        if tree:
+            self.dir_cache.invalidate_tree(partial)
+        # The parent's listing, mtime and link count changed too
+        self.attr_cache.invalidate(os.path.dirname(partial))
+        self.dir_cache.invalidate(os.path.dirname(partial))
+        if self.block_cache:
+            self.block_cache.drop(partial)
+
+    def _unpromote(self, path, tree=False):
+        # Called before an operation modifies `path`: a promoted copy must not
+        # take the change in place of its source
+        if self.promoter:
+            partial = path[1:] if path.startswith("/") else path
+            if tree:
+                self.promoter.demote_tree(partial)
+            else:
+                self.promoter.demote(partial)
+
+    def _unmap(self, path):
+        # Called before the mount changes the data of `path` or replaces it:
+        # handles reading it through a mapping go back to pread, so a file
+        # shrinking under them cannot fault (see mappingCache.py)
+        if self.mappings:
+            for handle in self.handles.for_path(path):
+                mapping = handle.unmap()
+                if mapping is not None:
+                    self.mappings.drop(mapping)
+
+    def _touched(self, path):
+        # Called after the mount changed the data or metadata of `path`
+        partial = path[1:] if path.startswith("/") else path
+        self.attr_cache.invalidate(partial)
+        if self.index:
+            self.index.touched(partial)
+        if self.prefetcher:
+            self.prefetcher.invalidate(partial)
 
     def access(self, path, mode):
-        full_path = self._full_path(path)
+        tier, full_path, st = self._lookup(path)
+        if st is False:
+            raise FuseOSError(errno.ENOENT)
+        if mode == os.F_OK and st is not None:
+            # The lookup saw it
+            return
+        if tier == 'remote' and self.backend:
+            # Existence only; the server checks permissions when the file is used
+            self._lstat(tier, full_path)
+            return
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
 
     def chmod(self, path, mode):
-        full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        self._unpromote(path)
+        full_path = self._full_path(path, write=True)
+        try:
+            return os.chmod(full_path, mode)
+        finally:
+            self._touched(path)
+            if self.stager:
+                # The upload carries the staged copy's mode
+                self.stager.changed(path.lstrip("/"))
 
     def chown(self, path, uid, gid):
-        full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        self._unpromote(path)
+        full_path = self._full_path(path, write=True)
+        try:
+            return os.chown(full_path, uid, gid)
+        finally:
+            self._touched(path)
 
     def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                        'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid', 'st_blocks'))
+        partial = path[1:] if path.startswith("/") else path
+        attrs = self.attr_cache.get(partial)
+        if attrs is None:
+            generation = self.attr_cache.generation
+            tier, full_path, st = self._lookup(path)
+            if st is False:
+                # What lstat'ing the path would have raised
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), full_path)
+            if st is not None:
+                # What the lookup found it with: one syscall per tier visited,
+                # or none when the index, a prefetched listing or the backend
+                # answered
+                attrs = st if isinstance(st, dict) else attributes(st)
+                self.attr_cache.put(partial, tier, attrs, generation)
+        if attrs is None:
+            try:
+                attrs = self._lstat(tier, full_path)
+            except FileNotFoundError:
+                # Only the resolution can be stale; the parent did not change
+                self.resolution_cache.invalidate(partial)
+                raise
+            self.attr_cache.put(partial, tier, attrs, generation)
+        # Writes held back by open handles may have made the file longer
+        size = self.handles.visible_size(path, attrs['st_size'])
+        if size != attrs['st_size']:
+            attrs = dict(attrs, st_size=size)
+        return attrs
 
     def readdir(self, path, fh):
-        dirents = ['.', '..']
-        full_path = self._full_path(path)
+        partial = path[1:] if path.startswith("/") else path
+        if self.watcher:
+            for tier, _ in self._tier_dirs(partial):
+                self.watcher.seen(tier, partial)
+        indexed = self.index.listing(partial) if self.index else None
+        if indexed is not None:
+            if self.verbose:
+                log.debug("readdir %s from the index", path)
+            yield from self._indexed_readdir(partial, indexed)
+            return
+        generation = self.dir_cache.generation
+        # Remote stats and scans are bounded by --remote-timeout
+        dirs, mtimes = tier_mtimes(self._tier_dirs(partial), self._on)
+        remote_dir = None
+        if self.backend and self._remote_up():
+            # The remote directory's mtime keys the listing like the local ones
+            try:
+                remote_dir = self._on('remote', self.backend.stat, partial)
+            except OSError:
+                pass
+            mtimes += (remote_dir and remote_dir['st_mtime'],)
+        if self.verbose:
+            log.debug("readdir %s on %s", path, ", ".join(tier for tier, _ in dirs) + (", backend" if remote_dir else ""))
 
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
+        yield '.'
+        yield '..'
 
-        if self.fallbackPath and self.fallbackPath not in full_path:
-            fallback_full_path = self._full_path(path, useFallBack=True)
-            if os.path.isdir(fallback_full_path):
-                dirents.extend(os.listdir(fallback_full_path))
+        names = self.dir_cache.get(partial, mtimes)
+        if names is not None:
+            for name in names:
+                yield name, self.attr_cache.get(os.path.join(partial, name)), 0
+            return
 
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            if path == '/':
-                remote_full_path = self.local_mount_point
-            else:
-                remote_full_path = os.path.join(self.local_mount_point, path)
-            print(path)
-            print(remote_full_path)
-            if os.path.isdir(remote_full_path):
-                # Fetch file listings directly from the server
-                with os.scandir(remote_full_path) as it:
-                    for entry in it:
-                        if entry.is_file() or entry.is_dir():
-                            dirents.append(entry.name)
-
-        for r in set(dirents):
-            yield r
+        # Stream the union and remember it, unless it turns out too big.
+        # Every name goes out with its attributes, so `ls -l` does not
+        # follow up with a getattr (and a tier probe) per entry
+        seeds = (self.resolution_cache.generation, self.attr_cache.generation)
+        names = []
+        # The remote part is a listing the prefetcher can reuse
+        remote_entries = {} if self.prefetcher and dirs and dirs[-1][0] == 'remote' else None
+        # Local names hide the backend's
+        shadowed = set() if remote_dir else None
+        for tier, entry in union(dirs, self._on, lstat=True):
+            if names is not None:
+                names.append(entry.name)
+                if len(names) > self.dir_cache.max_names:
+                    names = None
+            if shadowed is not None:
+                shadowed.add(entry.name)
+            attrs = self._seed(partial, tier, entry, seeds)
+            if remote_entries is not None and tier == 'remote' and attrs is not None:
+                remote_entries[entry.name] = attrs
+                if len(remote_entries) > self.prefetcher.max_names:
+                    remote_entries = None
+            yield entry.name, attrs, 0
+        if remote_dir:
+            try:
+                listing = self._on('remote', self.backend.list, partial)
+            except OSError as e:
+                log.warning("readdir %s: backend listing failed (%s)", path, e)
+                listing, names = None, None
+            remote_entries = {} if self.prefetcher and listing is not None else None
+            for name, attrs in (listing or {}).items():
+                if name in shadowed:
+                    continue
+                if names is not None:
+                    names.append(name)
+                    if len(names) > self.dir_cache.max_names:
+                        names = None
+                child = os.path.join(partial, name)
+                self.resolution_cache.put(child, 'remote', child, seeds[0])
+                self.attr_cache.put(child, 'remote', attrs, seeds[1])
+                if remote_entries is not None:
+                    remote_entries[name] = attrs
+                yield name, attrs, 0
+        if names is not None:
+            self.dir_cache.put(partial, mtimes, names, generation)
+        if remote_entries is not None:
+            # Names a higher tier shadows are left out; they only matter once
+            # removed there, and that invalidates this listing
+            self.prefetcher.store(partial, remote_entries)
+
+    def _seed(self, partial, tier, entry, generations):
+        # Cache where `entry` lives and its attributes, as getattr would. For
+        # the remote tier union took the lstat already, under --remote-timeout
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+        child = os.path.join(partial, entry.name)
+        attrs = attributes(st)
+        self.resolution_cache.put(child, tier, entry.path, generations[0])
+        self.attr_cache.put(child, tier, attrs, generations[1])
+        return attrs
+
+    def _indexed_readdir(self, partial, indexed):
+        # primaryFS and the staging area are listed, the rest comes from the
+        # index
+        yield '.'
+        yield '..'
+        seeds = (self.resolution_cache.generation, self.attr_cache.generation)
+        seen = set()
+        local = [(tier, directory) for tier, directory in self._tier_dirs(partial) if tier in ('primary', 'staged')]
+        for tier, entry in union(local):
+            seen.add(entry.name)
+            yield entry.name, self._seed(partial, tier, entry, seeds), 0
+        for tier, name, attrs in indexed:
+            if name in seen:
+                continue
+            child = os.path.join(partial, name)
+            self.resolution_cache.put(child, tier, self.index.real_path(tier, child), seeds[0])
+            if attrs is not None:
+                self.attr_cache.put(child, tier, attrs, seeds[1])
+            yield name, attrs, 0
+
+    def _tier_dirs(self, partial):
+        # The directory on every tier, highest priority first
+        dirs = self.tiers.dirs(partial)
+        if not self._remote_up():
+            dirs = [(tier, directory) for tier, directory in dirs if tier != 'remote']
+        return dirs
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -102,13 +732,31 @@ class Passthrough(Operations):
         else:
             return pathname
 
-    def mknod(self, path, mode, dev): return os.mknod(self._full_path(path), mode, dev)
+    def mknod(self, path, mode, dev):
+        try:
+            return os.mknod(self._full_path(path, write=True), mode, dev)
+        finally:
+            self._invalidate(path)
 
     def rmdir(self, path):
-        full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        self._unpromote(path, tree=True)
+        if self.stager and self.stager.holds(path.lstrip("/")):
+            # Files in it are still waiting for their upload
+            raise FuseOSError(errno.ENOTEMPTY)
+        tier, full_path = self._resolve(path)
+        self._writable(tier)
+        try:
+            if tier == 'remote' and self.backend:
+                return self._on(tier, self.backend.rmdir, full_path)
+            return os.rmdir(full_path)
+        finally:
+            self._invalidate(path, tree=True)
 
-    def mkdir(self, path, mode): return os.mkdir(self._full_path(path), mode)
+    def mkdir(self, path, mode):
+        try:
+            return os.mkdir(self._full_path(path, write=True), mode)
+        finally:
+            self._invalidate(path)
 
     def statfs(self, path):
         full_path = self._full_path(path)
@@ -117,100 +765,310 @@ class Passthrough(Operations):
                                                          'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
                                                          'f_frsize', 'f_namemax'))
 
-    def unlink(self, path): return os.unlink(self._full_path(path))
+    def unlink(self, path):
+        self._unpromote(path)
+        self._unmap(path)
+        try:
+            staged = False
+            if self.stager:
+                with self.path_locks(path):
+                    staged = self.stager.discard(path.lstrip("/"))
+            if staged:
+                # Its remote copy, if an earlier upload made one, goes too
+                try:
+                    self._on('remote', self.backend.unlink if self.backend else os.unlink,
+                             self._remote_path(path.lstrip("/")))
+                except FileNotFoundError:
+                    pass
+                return
+            tier, full_path = self._resolve(path)
+            self._writable(tier)
+            if tier == 'remote' and self.backend:
+                return self._on(tier, self.backend.unlink, full_path)
+            return os.unlink(full_path)
+        finally:
+            self._invalidate(path)
 
-    def symlink(self, name, target): return os.symlink(name, self._full_path(target))
+    def symlink(self, name, target):
+        try:
+            return os.symlink(name, self._full_path(target, write=True))
+        finally:
+            self._invalidate(target)
 
-    def rename(self, old, new): return os.rename(self._full_path(old), self._full_path(new))
+    def rename(self, old, new):
+        self._unpromote(old, tree=True)
+        self._unpromote(new, tree=True)
+        self._unmap(old)
+        self._unmap(new)
+        if self.stager:
+            # Staged files go up first, and the rename happens on the remote tier
+            self.stager.settle_tree(old.lstrip("/"))
+            self.stager.settle_tree(new.lstrip("/"))
+        with self.path_locks.many(old, new):
+            try:
+                old_tier, old_path = self._resolve(old)
+                new_tier, new_path = self._resolve(new)
+                self._writable(old_tier)
+                self._writable(new_tier)
+                if self.backend and 'remote' in (old_tier, new_tier):
+                    # Within the backend only, as a rename between sshfs and a
+                    # local file system would be
+                    if old_tier != 'remote' or (new_tier != 'remote' and os.path.lexists(new_path)):
+                        raise FuseOSError(errno.EXDEV)
+                    return self._on('remote', self.backend.rename, old_path, self._remote_path(new.lstrip("/")))
+                # Copies in the kernel when the two ends are on different tiers
+                return move(old_path, new_path)
+            finally:
+                self._invalidate(old, tree=True)
+                self._invalidate(new, tree=True)
 
-    def link(self, target, name): return os.link(self._full_path(target), self._full_path(name))
+    def link(self, target, name):
+        self._unpromote(target)
+        try:
+            return os.link(self._full_path(target, write=True), self._full_path(name, write=True))
+        finally:
+            self._invalidate(target)
+            self._invalidate(name)
 
-    def utimens(self, path, times=None): return os.utime(self._full_path(path), times)
+    def utimens(self, path, times=None):
+        self._unpromote(path)
+        try:
+            return os.utime(self._full_path(path, write=True), times)
+        finally:
+            self._touched(path)
 
     # File methods
     # ============
 
     def open(self, path, flags):
-        print("Opening files")
-        full_path = self._full_path(path)
-
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            remote_full_path = os.path.join(self.local_mount_point, path)
-            print("Trying to open a file in the remote path")
-            print(remote_full_path)
-            if os.path.exists(remote_full_path):
-                print("Open successful")
-                return os.open(remote_full_path, flags)
+        writing = flags & os.O_ACCMODE != os.O_RDONLY or flags & os.O_TRUNC
+        if writing:
+            self._unpromote(path)
+            self._unmap(path)
+        tier, full_path = self._resolve(path)
+        if writing:
+            self._writable(tier)
+        if writing and self.stager and tier in ('remote', 'staged'):
+            partial = path.lstrip("/")
+            return self._open_staged(path, flags, lambda staged: self._download(partial, staged, flags & os.O_TRUNC))
+        backend = tier == 'remote' and self.backend
+        if self.promoter and not writing and not backend and tier != 'staged' and self.promoter.opened(path.lstrip("/"), tier, full_path):
+            tier, full_path = self._resolve(path)
+        if self.verbose:
+            log.debug("open %s on %s: %s", path, tier, full_path)
 
-        return os.open(full_path, flags)
+        if backend:
+            # No fd: reads and writes become range requests. The kernel looked
+            # the path up just before, so its attributes are usually cached
+            attrs = self.attr_cache.get(path.lstrip("/")) or self._on(tier, self.backend.stat, full_path)
+            if flags & os.O_TRUNC:
+                self._on(tier, self.backend.truncate, full_path, 0)
+                self._touched(path)
+            handle = BackendHandle(self.backend, path, tier, full_path, flags)
+            size, mtime_ns = attrs['st_size'], int(attrs['st_mtime'] * 1e9)
+        else:
+            fd = self._on(tier, os.open, full_path, flags)
+            handle = FileHandle(fd, path, tier, full_path, flags)
+            if self.mappings and tier == 'fallback' and not writing:
+                handle.mapping = self.mappings.acquire(full_path, fd)
+            if tier not in ('primary', 'staged') and not writing:
+                st = self._on(tier, os.fstat, fd)
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+        if tier not in ('primary', 'staged') and not writing:
+            if tier == 'remote' and self.block_cache:
+                handle.cache_key = (size, mtime_ns)
+                self.block_cache.validate(path.lstrip("/"), *handle.cache_key)
+            if self.readahead_pool and not handle.mapping:
+                handle.readahead = ReadAhead(self.readahead_pool, lambda o, n: self._fetch(handle, o, n),
+                                             size, depth=self.readahead_depth)
+        return self.handles.register(handle)
 
     def create(self, path, mode, fi=None):
-        full_path = self._full_path(path)
+        self._unpromote(path)
+        self._unmap(path)
+        flags = os.O_RDWR | os.O_CREAT
+        # New files go to the remote tier unless it is read-only
+        remote = self.remote and not self.tiers.read_only('remote')
+
+        if self.stager and remote:
+            # On local disk until uploaded. create follows a failed lookup, so
+            # there is no remote content to bring over
+            return self._open_staged(path, flags, None, mode)
 
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            remote_full_path = os.path.join(self.local_mount_point, path)
+        if remote:
+            remote_full_path = self._remote_path(path.lstrip("/"))
             remote_dir = os.path.dirname(remote_full_path)
 
-            # Create the directory in the remote file system
-            if not os.path.exists(remote_dir):
-                os.makedirs(remote_dir)
+            # Fails fast while the remote tier is down rather than creating
+            # the file somewhere else
+            with self.path_locks(path):
+                if self.backend:
+                    # Creates the directories above it too
+                    try:
+                        self.remote.call(self.backend.create, remote_full_path, mode)
+                    finally:
+                        self._invalidate(path)
+                    return self.handles.register(BackendHandle(self.backend, path, 'remote', remote_full_path, flags))
 
-            return os.open(remote_full_path, os.O_WRONLY | os.O_CREAT, mode)
+                # Create the directory in the remote file system
+                self.remote.call(os.makedirs, remote_dir, 0o777, True)
 
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+                try:
+                    fd = self.remote.call(os.open, remote_full_path, flags, mode)
+                finally:
+                    self._invalidate(path)
+            return self.handles.register(FileHandle(fd, path, 'remote', remote_full_path, flags))
 
-    def read(self, path, length, offset, fh):
-        print("Reading function")
-        os.lseek(fh, offset, os.SEEK_SET)
+        tier, full_path = self._resolve(path)
+        self._writable(tier)
+        try:
+            fd = os.open(full_path, flags, mode)
+        finally:
+            self._invalidate(path)
+        return self.handles.register(FileHandle(fd, path, tier, full_path, flags))
 
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            remote_full_path = os.path.join(self.local_mount_point, path)
-            print("Remote accessing file")
-            print(remote_full_path)
-            if os.path.exists(remote_full_path):
-                with open(remote_full_path, 'rb') as f:
-                    f.seek(offset)
-                    return f.read(length)
+    def read(self, path, length, offset, fh):
+        handle = self.handles.get(fh)
+        if self.verbose:
+            log.debug("read %d bytes at %d on %s: %s", length, offset, handle.tier, handle.real_path)
+        if handle.readahead:
+            return handle.readahead.read(offset, length)
+        return self._fetch(handle, offset, length)
 
-        return os.read(fh, length)
+    def _fetch(self, handle, offset, length):
+        if handle.cache_key:
+            return self.block_cache.read(handle.path.lstrip("/"), *handle.cache_key, offset, length,
+                                         lambda o, n: self._on(handle.tier, handle.pread, n, o))
+        return self._on(handle.tier, handle.read, length, offset)
 
     def write(self, path, buf, offset, fh):
-        full_path = self._full_path(path)
+        handle = self.handles.get(fh)
+        if self.verbose:
+            log.debug("write %d bytes at %d on %s: %s", len(buf), offset, handle.tier, handle.real_path)
+        written = self._on(handle.tier, handle.write, buf, offset)
+        self._touched(path)
+        return written
 
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            print("Trying to write a file in the remote path")
-            remote_full_path = os.path.join(self.local_mount_point, path)
-            print(remote_full_path)
-            if os.path.exists(remote_full_path):
-                with open(remote_full_path, 'rb+') as f:
-                    f.seek(offset)
-                    return f.write(buf)
+    def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out, offset_out, length, flags):
+        # What `cp` asks of libfuse3 bindings instead of reads and writes; the
+        # bytes stay in the kernel, reflinked or copied server-side where the
+        # backing filesystems can (see fileCopy.py)
+        if flags:
+            raise FuseOSError(errno.EINVAL)
+        src = self.handles.get(fh_in)
+        dst = self.handles.get(fh_out)
+        src.drain()
+        dst.drain()
+        tier = 'remote' if 'remote' in (src.tier, dst.tier) else dst.tier
+        try:
+            if isinstance(src, BackendHandle) or isinstance(dst, BackendHandle):
+                # No fd on the backend side: range requests it is
+                return self._on(tier, self._copy_handles, src, offset_in, dst, offset_out, length)
+            return self._on(tier, copy_range, src.fd, offset_in, dst.fd, offset_out, length)
+        finally:
+            self._touched(path_out)
 
-        with open(full_path, 'rb+') as f:
-            f.seek(offset)
-            return f.write(buf)
+    def _copy_handles(self, src, src_offset, dst, dst_offset, length):
+        done = 0
+        while done < length:
+            data = src.pread(min(length - done, CHUNK), src_offset + done)
+            if not data:
+                break
+            view = memoryview(data)
+            while view:
+                view = view[dst.pwrite(view, dst_offset + done + len(data) - len(view)):]
+            done += len(data)
+        return done
 
     def truncate(self, path, length, fh=None):
-        full_path = self._full_path(path)
+        self._unmap(path)
+        try:
+            if fh is not None:
+                handle = self.handles.get(fh)
+                handle.truncate(length)
+                self._on(handle.tier, handle.ftruncate, length)
+                return 0
 
-        if self.remote_host and self.remote_directory and self.local_mount_point:
-            remote_full_path = os.path.join(self.local_mount_point, path)
-            with open(remote_full_path, 'r+') as f:
+            self.handles.truncate(path, length)
+            self._unpromote(path)
+            tier, full_path = self._resolve(path)
+            self._writable(tier)
+            if self.stager and tier in ('remote', 'staged'):
+                partial = path.lstrip("/")
+                with self.path_locks(path):
+                    entry = self.stager.stage(partial, lambda staged: self._download(partial, staged, length == 0))
+                try:
+                    os.truncate(self.stager.real_path(partial), length)
+                finally:
+                    self.stager.released(partial, entry)
+                    self._invalidate(path)
+                return 0
+            if tier == 'remote' and self.backend:
+                self._on(tier, self.backend.truncate, full_path, length)
+                return 0
+            with open(full_path, 'r+') as f:
                 f.truncate(length)
             return 0
-
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
-        return 0
+        finally:
+            self._touched(path)
 
     def flush(self, path, fh):
-        return os.fsync(fh)
+        handle = self.handles.get(fh)
+        handle.drain()
+        if isinstance(handle, BackendHandle):
+            # Written through to the server; only fsync syncs it there
+            return 0
+        return self.durability.flush(fh)
 
     def release(self, path, fh):
-        return os.close(fh)
+        handle = self.handles.pop(fh)
+        if handle.readahead:
+            handle.readahead.cancel()
+        try:
+            handle.drain()
+        finally:
+            handle.close()
+            mapping = handle.unmap()
+            if mapping is not None:
+                self.mappings.release(mapping)
+            self._touched(path)
+            if handle.staged:
+                # The last writer queues the upload
+                self.stager.released(path.lstrip("/"), handle.staged)
 
     def fsync(self, path, fdatasync, fh):
-        return self.flush(path, fh)
+        handle = self.handles.get(fh)
+        handle.drain()
+        if isinstance(handle, BackendHandle):
+            return self._on(handle.tier, self.backend.fsync, handle.real_path)
+        return self.durability.fsync(fh, bool(fdatasync))
+
+    def destroy(self, path):
+        self.durability.stop()
+        self.handles.stop()
+        if self.promoter:
+            self.promoter.stop()
+            stats = self.promoter.stats()
+            log.info("Promotion: %d files, %d bytes on primary", stats['promoted'], stats['used_bytes'])
+        if self.block_cache:
+            stats = self.block_cache.stats()
+            log.info("Block cache: hit ratio %.2f, %d bytes saved", stats['hit_ratio'], stats['bytes_saved'])
+        self.prober.stop()
+        if self.watcher:
+            self.watcher.stop()
+        if self.index:
+            self.index.stop()
+        if self.mappings:
+            self.mappings.stop()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        if self.stager:
+            # Pending uploads stay in the journal for the next mount
+            self.stager.stop()
+        if self.remote:
+            self.remote.stop()
+        if self.recorder:
+            self.recorder.stop()
     
 
 # python3 remoteCallBackFuse.py ./mountPoint ./primaryFS --fallback ./fallbackFS --remote 188.40.23.247:/root/sshfs --local ./remote
@@ -220,7 +1078,7 @@ import sys
 
 def main():
     if len(sys.argv) < 3:
-        print("Usage: python script.py <mountpoint> <root> [--fallback <fallbackPath> --remote <remote_host:remote_directory> --local <local_mount_point>]")
+        print("Usage: python script.py <mountpoint> <root> [--fallback <fallbackPath> --remote <remote_host:remote_directory> --local <local_mount_point>] [--threads N] [--write-back <bytes>] [--attr-ttl <tier=seconds,...>] [--miss-ttl S] [--attr-timeout S] [--entry-timeout S] [--negative-timeout S] [--durability <mode> [--group-commit-ms N]] [--cache-dir <dir> [--cache-size <bytes>]] [--readahead <windows>] [--promote-budget <bytes> [--promote-after N] [--promote-state <file>]] [--index <file>] [--watch [--poll-interval S]] [--hedge] [--remote-deadline S [--deadline-policy miss|enoent]] [--remote-timeout S] [--breaker-failures N] [--health-interval S] [--prefetch [--prefetch-fanout N]] [--backend <host[:port]> [--backend-connections N] [--backend-secret <file>]] [--trace <file>] [--stage-dir <dir> [--upload-workers N]] [--mmap-budget <bytes>] [--read-only <tier,...>] [--uncached <tier,...>] [--log-level <level>]")
         sys.exit(1)
 
     mountpoint = sys.argv[1]
@@ -230,6 +1088,7 @@ def main():
     remote_host = None
     remote_directory = None
     local_mount_point = None
+    threads = 1
 
     # Check for optional arguments
     if "--fallback" in sys.argv:
@@ -239,13 +1098,201 @@ def main():
         remote_host, remote_directory = remote.split(":")
     if "--local" in sys.argv:
         local_mount_point = sys.argv[sys.argv.index("--local") + 1]
+    if "--threads" in sys.argv:
+        threads = int(sys.argv[sys.argv.index("--threads") + 1])
+
+    # debug logs every open, read, write and readdir; see /.fusestats for numbers
+    log_level = 'INFO'
+    if "--log-level" in sys.argv:
+        log_level = sys.argv[sys.argv.index("--log-level") + 1].upper()
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    # Bytes each writable handle may hold back in memory
+    write_back = 0
+    if "--write-back" in sys.argv:
+        write_back = parse_size(sys.argv[sys.argv.index("--write-back") + 1])
+
+    # strict, fsync-only or group-commit; see durability.py
+    mode = 'strict'
+    if "--durability" in sys.argv:
+        mode = sys.argv[sys.argv.index("--durability") + 1]
+    interval = 0.005
+    if "--group-commit-ms" in sys.argv:
+        interval = float(sys.argv[sys.argv.index("--group-commit-ms") + 1]) / 1000
+    if mode not in MODES:
+        print("--durability must be one of " + ", ".join(MODES))
+        sys.exit(1)
+    durability = Durability(mode, interval)
+
+    # getattr cache TTL per tier, e.g. primary=1,fallback=30,remote=300
+    attr_ttls = None
+    if "--attr-ttl" in sys.argv:
+        attr_ttls = parse_ttls(sys.argv[sys.argv.index("--attr-ttl") + 1])
+
+    # How long a path found on no tier is answered without probing again
+    miss_ttl = 1.0
+    if "--miss-ttl" in sys.argv:
+        miss_ttl = float(sys.argv[sys.argv.index("--miss-ttl") + 1])
+
+    # Kernel-side cache timeouts in seconds, handed to FUSE as -o options
+    fuse_options = {}
+    for option in ('attr_timeout', 'entry_timeout', 'negative_timeout'):
+        flag = '--' + option.replace('_', '-')
+        if flag in sys.argv:
+            fuse_options[option] = float(sys.argv[sys.argv.index(flag) + 1])
+
+    # Local block cache of the remote tier
+    block_cache = None
+    if "--cache-dir" in sys.argv:
+        cache_dir = sys.argv[sys.argv.index("--cache-dir") + 1]
+        cache_size = 1 << 30
+        if "--cache-size" in sys.argv:
+            cache_size = parse_size(sys.argv[sys.argv.index("--cache-size") + 1])
+        block_cache = BlockCache(cache_dir, cache_size)
+
+    # Windows to prefetch ahead of sequential reads from the slow tiers
+    readahead = 0
+    if "--readahead" in sys.argv:
+        readahead = int(sys.argv[sys.argv.index("--readahead") + 1])
+
+    # Room on primaryFS for copies of hot fallback and remote files; see
+    # promotion.py
+    promoter = None
+    if "--promote-budget" in sys.argv and fallbackPath:
+        promote_after = 3
+        if "--promote-after" in sys.argv:
+            promote_after = int(sys.argv[sys.argv.index("--promote-after") + 1])
+        promote_state = None
+        if "--promote-state" in sys.argv:
+            promote_state = sys.argv[sys.argv.index("--promote-state") + 1]
+        promoter = Promoter(root, parse_size(sys.argv[sys.argv.index("--promote-budget") + 1]), promote_after, state_file=promote_state)
+
+    # SQLite file holding the entries of fallbackFS and the remote tree; see
+    # metadataIndex.py
+    index = None
+    if "--index" in sys.argv and fallbackPath:
+        tiers = [('fallback', os.path.abspath(fallbackPath))]
+        if remote_host and remote_directory and local_mount_point:
+            tiers.append(('remote', os.path.abspath(local_mount_point)))
+        index = MetadataIndex(sys.argv[sys.argv.index("--index") + 1], tiers)
+
+    # Follow changes made outside the mount: inotify on the local tiers,
+    # polling on the remote one; see watcher.py
+    watcher = None
+    if "--watch" in sys.argv:
+        watched = [('primary', os.path.abspath(root))]
+        if fallbackPath:
+            watched.append(('fallback', os.path.abspath(fallbackPath)))
+        polled = []
+        if fallbackPath and remote_host and remote_directory and local_mount_point:
+            polled.append(('remote', os.path.abspath(local_mount_point)))
+        interval = 5.0
+        if "--poll-interval" in sys.argv:
+            interval = float(sys.argv[sys.argv.index("--poll-interval") + 1])
+        watcher = Watcher(watched, polled, interval)
+        # Changes are pushed, so the local tiers need no short TTL; the remote
+        # one is only polled where the mount looked, and keeps its own
+        if attr_ttls is None:
+            attr_ttls = dict(DEFAULT_TTLS, **dict((tier, WATCHED_TTL) for tier, _ in watched))
+
+    # Remote probes started early and/or abandoned after a deadline; see
+    # tierProbe.py
+    deadline = None
+    if "--remote-deadline" in sys.argv:
+        deadline = float(sys.argv[sys.argv.index("--remote-deadline") + 1])
+    policy = 'miss'
+    if "--deadline-policy" in sys.argv:
+        policy = sys.argv[sys.argv.index("--deadline-policy") + 1]
+    if policy not in POLICIES:
+        print("--deadline-policy must be one of " + ", ".join(POLICIES))
+        sys.exit(1)
+    prober = TierProber("--hedge" in sys.argv, deadline, policy)
+
+    # A remoteBackend.py server serving the remote directory, talked to
+    # in-process instead of through sshfs
+    backend_address = None
+    if "--backend" in sys.argv and fallbackPath:
+        backend_address = parse_address(sys.argv[sys.argv.index("--backend") + 1])
+    backend = None
+
+    # sshfs is mounted in the background and health-checked; see remoteTier.py
+    remote_tier = None
+    if fallbackPath and (backend_address or (remote_host and remote_directory and local_mount_point)):
+        timeout = 10.0
+        if "--remote-timeout" in sys.argv:
+            timeout = float(sys.argv[sys.argv.index("--remote-timeout") + 1])
+        failures = 3
+        if "--breaker-failures" in sys.argv:
+            failures = int(sys.argv[sys.argv.index("--breaker-failures") + 1])
+        health_interval = 5.0
+        if "--health-interval" in sys.argv:
+            health_interval = float(sys.argv[sys.argv.index("--health-interval") + 1])
+        if backend_address:
+            connections = 4
+            if "--backend-connections" in sys.argv:
+                connections = int(sys.argv[sys.argv.index("--backend-connections") + 1])
+            # The server's --secret-file, when it is not only on loopback
+            secret = None
+            if "--backend-secret" in sys.argv:
+                secret = read_secret(sys.argv[sys.argv.index("--backend-secret") + 1])
+            backend = RemoteClient(backend_address, connections, timeout, secret)
+        remote_tier = RemoteTier(remote_host, remote_directory, local_mount_point, timeout=timeout,
+                                 failures=failures, interval=health_interval, backend=backend)
+
+    # Whole remote listings with attributes instead of per-entry probes;
+    # see remotePrefetch.py
+    prefetcher = None
+    if "--prefetch" in sys.argv and remote_tier:
+        fanout = 16
+        if "--prefetch-fanout" in sys.argv:
+            fanout = int(sys.argv[sys.argv.index("--prefetch-fanout") + 1])
+        remote_ttl = (attr_ttls or DEFAULT_TTLS).get('remote', 0)
+        prefetcher = RemotePrefetcher(local_mount_point, remote_ttl, STAT_FIELDS, fanout=fanout)
+
+    # Binary trace of every operation, for benchmarks/replay.py; see
+    # traceLog.py
+    recorder = None
+    if "--trace" in sys.argv:
+        recorder = TraceRecorder(sys.argv[sys.argv.index("--trace") + 1])
+
+    # Remote-tier writes staged on local disk and uploaded in the background;
+    # see writeStaging.py
+    stager = None
+    if "--stage-dir" in sys.argv and remote_tier:
+        workers = 2
+        if "--upload-workers" in sys.argv:
+            workers = int(sys.argv[sys.argv.index("--upload-workers") + 1])
+        stager = WriteStager(sys.argv[sys.argv.index("--stage-dir") + 1], workers)
+
+    # Address space for mappings of fallbackFS files; see mappingCache.py
+    mappings = None
+    if "--mmap-budget" in sys.argv and fallbackPath:
+        mappings = MappingCache(parse_size(sys.argv[sys.argv.index("--mmap-budget") + 1]))
+
+    # Tiers the mount never changes, and tiers left out of the caches; see
+    # tierChain.py
+    tier_flags = {}
+    for flag in ('--read-only', '--uncached'):
+        tier_flags[flag] = ()
+        if flag in sys.argv:
+            try:
+                tier_flags[flag] = parse_tiers(sys.argv[sys.argv.index(flag) + 1], ('primary', 'fallback', 'remote'))
+            except ValueError as e:
+                print(flag + ": " + str(e))
+                sys.exit(1)
+    read_only, uncached = tier_flags['--read-only'], tier_flags['--uncached']
+
+    # With a single thread keep libfuse's own single-threaded loop
+    nothreads = threads <= 1
 
     if fallbackPath and remote_host and remote_directory and local_mount_point:
-        FUSE(Passthrough(root, fallbackPath, remote_host, remote_directory, local_mount_point), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, fallbackPath, remote_host, remote_directory, local_mount_point, threads=threads, write_back=write_back, attr_ttls=attr_ttls, durability=durability, block_cache=block_cache, readahead=readahead, promoter=promoter, miss_ttl=miss_ttl, index=index, watcher=watcher, prober=prober, remote=remote_tier, prefetcher=prefetcher, backend=backend, recorder=recorder, stager=stager, mappings=mappings, read_only=read_only, uncached=uncached), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
+    elif fallbackPath and backend:
+        FUSE(Passthrough(root, fallbackPath, threads=threads, write_back=write_back, attr_ttls=attr_ttls, durability=durability, block_cache=block_cache, readahead=readahead, promoter=promoter, miss_ttl=miss_ttl, index=index, watcher=watcher, prober=prober, remote=remote_tier, prefetcher=prefetcher, backend=backend, recorder=recorder, stager=stager, mappings=mappings, read_only=read_only, uncached=uncached), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
     elif fallbackPath:
-        FUSE(Passthrough(root, fallbackPath), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, fallbackPath, threads=threads, write_back=write_back, attr_ttls=attr_ttls, durability=durability, readahead=readahead, promoter=promoter, miss_ttl=miss_ttl, index=index, watcher=watcher, prober=prober, recorder=recorder, mappings=mappings, read_only=read_only, uncached=uncached), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
     else:
-        FUSE(Passthrough(root), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, threads=threads, write_back=write_back, attr_ttls=attr_ttls, durability=durability, miss_ttl=miss_ttl, watcher=watcher, prober=prober, recorder=recorder), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
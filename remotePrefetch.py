@@ -0,0 +1,180 @@
+"""
+Bulk metadata prefetch for directories of the remote tier.
+
+Walking a remote directory costs an `exists` and an `lstat` per entry, each
+one SFTP round trip. `RemotePrefetcher` replaces them with one os.scandir of
+the directory: sshfs answers a readdir with every entry's attributes, so the
+whole listing, attributes included, comes back at the price of a single
+request.
+
+- `listing(directory)` returns {name: attrs} of a remote directory, read
+  once and trusted for `ttl` seconds (the remote attribute TTL). The mount
+  answers lookups below it from there: a name that is listed is on the
+  remote tier with those attributes, a name that is not is a miss.
+- every listing is handed to `on_listing(directory, entries)`, which seeds
+  the mount's lookup and attribute caches.
+- the subdirectories of a listed directory are likely to be walked next: up
+  to `fanout` of them are listed in the background, `depth` levels down.
+"""
+
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RemotePrefetcher:
+    def __init__(self, base, ttl, fields, fanout=16, depth=1, workers=2, max_entries=1024, max_names=100000):
+        self.base = base
+        self.ttl = ttl
+        # The stat fields kept per entry, as getattr reports them
+        self.fields = fields
+        self.fanout = fanout
+        self.depth = depth
+        self.max_entries = max_entries
+        # Bigger directories are not kept; their children are probed
+        self.max_names = max_names
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # partial path of a directory -> (expiry, {name: attrs})
+        self.entries = OrderedDict()
+        # Directories being listed in the background -> set when done
+        self.pending = {}
+        self.on_listing = None
+        self.run = None
+        self.scan = self._scan
+        self.hits = 0
+        self.loads = 0
+        self.background = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def start(self, on_listing, run=None, scan=None):
+        # run(fn, *args) makes the remote calls, e.g. with a timeout;
+        # scan(directory) lists one when the tier is not a local path
+        self.on_listing = on_listing
+        self.run = run or (lambda fn, *args: fn(*args))
+        if scan:
+            self.scan = scan
+
+    def stop(self):
+        self.pool.shutdown(wait=False)
+
+    def listing(self, directory):
+        # {name: attrs} of the remote directory, None when too big or unreadable
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is not None and entry[0] >= now:
+                self.entries.move_to_end(directory)
+                self.hits += 1
+                return entry[1]
+            done = self.pending.get(directory)
+        if done is not None:
+            # Already on its way: wait for it rather than list it twice
+            done.wait()
+            with self.lock:
+                entry = self.entries.get(directory)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+        return self._load(directory, self.depth)
+
+    def store(self, directory, entries):
+        # A listing the mount read anyway (readdir); saves the scandir
+        with self.lock:
+            generation = self.generation
+        self._keep(directory, entries, generation)
+        self._ahead(directory, entries, self.depth)
+
+    def _load(self, directory, depth):
+        with self.lock:
+            generation = self.generation
+            self.loads += 1
+        try:
+            entries = self.run(self.scan, directory)
+        except (FileNotFoundError, NotADirectoryError):
+            # Nothing below a missing directory
+            entries = {}
+        except OSError:
+            return None
+        if entries is None or len(entries) > self.max_names:
+            return None
+        self._keep(directory, entries, generation)
+        self.on_listing(directory, entries)
+        self._ahead(directory, entries, depth)
+        return entries
+
+    def _scan(self, directory):
+        entries = {}
+        with os.scandir(os.path.join(self.base, directory)) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entries[entry.name] = dict((key, getattr(st, key)) for key in self.fields)
+                if len(entries) > self.max_names:
+                    return None
+        return entries
+
+    def _keep(self, directory, entries, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[directory] = (time.monotonic() + self.ttl, entries)
+            self.entries.move_to_end(directory)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _ahead(self, directory, entries, depth):
+        if depth <= 0:
+            return
+        subdirs = [name for name, attrs in entries.items() if stat.S_ISDIR(attrs['st_mode'])]
+        now = time.monotonic()
+        for name in subdirs[:self.fanout]:
+            child = os.path.join(directory, name)
+            with self.lock:
+                entry = self.entries.get(child)
+                if (entry is not None and entry[0] >= now) or child in self.pending:
+                    continue
+                self.pending[child] = threading.Event()
+                self.background += 1
+            self.pool.submit(self._prefetch, child, depth - 1)
+
+    def _prefetch(self, directory, depth):
+        try:
+            self._load(directory, depth)
+        finally:
+            with self.lock:
+                done = self.pending.pop(directory)
+            done.set()
+
+    def invalidate(self, partial):
+        # `partial` was created or removed: its parent's listing changed, and
+        # so did those above it if the mount created the parents too
+        with self.lock:
+            self.generation += 1
+            path = partial
+            while True:
+                self.entries.pop(path, None)
+                if not path:
+                    return
+                path = os.path.dirname(path)
+
+    def invalidate_tree(self, partial):
+        self.invalidate(partial)
+        with self.lock:
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'directories': len(self.entries),
+                'hits': self.hits,
+                'listings_loaded': self.loads,
+                'prefetched': self.background,
+            }
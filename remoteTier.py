@@ -0,0 +1,227 @@
+"""
+The sshfs tier: mounted in the background, health-checked, and fenced off
+when it misbehaves.
+
+`RemoteTier` owns the sshfs mount of the remote directory:
+
+- `start()` returns at once; sshfs runs on a background thread, retried with
+  backoff, so the local tiers serve from the first request while the
+  network comes up. Until it is mounted the remote tier is unavailable.
+- a health probe (a stat of the mount point, bounded by `slow`) runs every
+  `interval` seconds, and remounts when sshfs went away.
+- a circuit breaker opens after `failures` consecutive failed or slow
+  calls: the mount then skips the remote tier (see --deadline-policy) until
+  a health probe succeeds again.
+- `call()` runs one remote-dependent syscall on a small pool and gives up
+  with ETIMEDOUT after `timeout` seconds, so a hung link costs a bounded
+  wait instead of a stuck FUSE thread.
+
+With a `backend` (a remoteBackend.RemoteClient, see --backend) there is no
+sshfs: "mounting" connects the client, the health probe stats the served
+directory, and `call()` runs inline since the client bounds every request
+by its own timeout.
+"""
+
+import errno
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from fuse import FuseOSError
+
+log = logging.getLogger(__name__)
+
+SSHFS_OPTIONS = 'nonempty,rw,sync_readdir,reconnect,ServerAliveInterval=15,ServerAliveCountMax=3'
+
+# Errors that say something about the link rather than about the file
+LINK_ERRORS = {errno.EIO, errno.ENOTCONN, errno.ETIMEDOUT, errno.ECONNABORTED, errno.ECONNRESET, errno.ECONNREFUSED,
+               errno.EHOSTDOWN}
+
+
+class RemoteTier:
+    def __init__(self, host, directory, mount_point, mount=True, timeout=10.0, slow=2.0,
+                 failures=3, interval=5.0, workers=8, backend=None):
+        self.host = host
+        self.directory = directory
+        self.mount_point = mount_point
+        # False when something else already provides the tree at mount_point
+        self.mount = mount
+        self.backend = backend
+        self.timeout = timeout
+        self.slow = slow
+        self.failures = failures
+        self.interval = interval
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # 'mounting', 'up' or 'open' (breaker tripped)
+        self.state = 'mounting' if mount or backend else 'up'
+        self.mounted = False
+        self.consecutive = 0
+        self.trips = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.on_up = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, on_up=None):
+        # on_up() runs every time the tier becomes available
+        if on_up:
+            self.on_up.append(on_up)
+        self.thread = threading.Thread(target=self._run, name='remote-tier', daemon=True)
+        self.thread.start()
+        if self.state == 'up':
+            self._came_up()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.pool.shutdown(wait=False)
+        if self.backend:
+            self.backend.close()
+        if self.mounted:
+            self.mounted = False
+            subprocess.run(['fusermount', '-u', self.mount_point])
+            log.info("Unmounted %s", self.mount_point)
+
+    def available(self):
+        return self.state == 'up'
+
+    def call(self, fn, *args):
+        # fn(*args) with the per-op timeout, counted by the breaker
+        if self.state != 'up':
+            with self.lock:
+                self.rejected += 1
+            raise FuseOSError(errno.EHOSTDOWN)
+        start = time.monotonic()
+        try:
+            if self.backend:
+                result = fn(*args)
+            else:
+                result = self.pool.submit(fn, *args).result(self.timeout)
+        except TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            self.record(False, self.timeout)
+            raise FuseOSError(errno.ETIMEDOUT)
+        except OSError as e:
+            self.record(e.errno not in LINK_ERRORS, time.monotonic() - start)
+            raise
+        self.record(True, time.monotonic() - start)
+        return result
+
+    def record(self, ok, seconds):
+        # One remote call went through (ok) or not; slow ones count as failed
+        tripped = False
+        with self.lock:
+            if ok and seconds <= self.slow:
+                self.consecutive = 0
+                return
+            self.consecutive += 1
+            if self.consecutive >= self.failures and self.state == 'up':
+                self.state = 'open'
+                self.trips += 1
+                tripped = True
+        if tripped:
+            log.warning("Remote tier failing, skipping it until it answers again")
+
+    def _came_up(self):
+        for callback in self.on_up:
+            callback()
+
+    def _run(self):
+        backoff = 1.0
+        while not self.stopping.is_set():
+            if self.state == 'mounting':
+                if self.backend and self._connect():
+                    backoff = 1.0
+                    self._set_up("Connected to the backend at %s:%d", *self.backend.address)
+                    continue
+                if not self.backend and self._mount():
+                    backoff = 1.0
+                    self._set_up("Mounted %s:%s on %s", self.host, self.directory, self.mount_point)
+                    continue
+                if self.stopping.wait(backoff):
+                    return
+                backoff = min(backoff * 2, 60.0)
+                continue
+            if self.stopping.wait(self.interval):
+                return
+            healthy = self._probe()
+            if healthy is None and self.backend:
+                log.warning("Backend connection lost, connecting again")
+                with self.lock:
+                    self.state = 'mounting'
+            elif healthy is None:
+                # sshfs itself went away
+                log.warning("%s is no longer mounted, mounting again", self.mount_point)
+                with self.lock:
+                    self.state = 'mounting'
+                    self.mounted = False
+            elif healthy and self.state == 'open':
+                self._set_up("Remote tier answering again")
+            else:
+                self.record(healthy, 0 if healthy else self.slow)
+
+    def _set_up(self, message, *args):
+        with self.lock:
+            self.state = 'up'
+            self.consecutive = 0
+        log.info(message, *args)
+        self._came_up()
+
+    def _mount(self):
+        command = ['sshfs', '%s:%s' % (self.host, self.directory), self.mount_point, '-o', SSHFS_OPTIONS]
+        try:
+            subprocess.run(command, check=True, timeout=max(self.timeout, 30.0))
+        except (OSError, subprocess.SubprocessError) as e:
+            log.warning("Mounting %s:%s failed (%s), retrying", self.host, self.directory, e)
+            return False
+        self.mounted = True
+        return True
+
+    def _connect(self):
+        try:
+            self.backend.connect()
+        except OSError as e:
+            log.warning("Connecting to the backend at %s:%d failed (%s), retrying", *self.backend.address, e)
+            return False
+        return True
+
+    def _probe(self):
+        # True, False when slow or failing, None when no longer mounted
+        # (connected)
+        if self.backend:
+            check = self.backend.stat
+            target = ''
+        else:
+            check = os.path.ismount if self.mount else os.path.isdir
+            target = self.mount_point
+        future = self.pool.submit(check, target)
+        try:
+            present = future.result(self.slow)
+        except TimeoutError:
+            return False
+        except OSError as e:
+            if self.backend and e.errno in (errno.ECONNRESET, errno.ENOTCONN, errno.ECONNREFUSED):
+                return None
+            return False
+        if not present:
+            return None if self.mount else False
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'up': int(self.state == 'up'),
+                'breaker_open': int(self.state == 'open'),
+                'trips': self.trips,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'consecutive_failures': self.consecutive,
+            }
@@ -0,0 +1,79 @@
+"""
+Bounded LRU cache of path resolutions for the Passthrough classes.
+
+Maps a virtual path (relative to the mount, without the leading "/") to the
+tier it was found in and the real path on that tier, so a repeated lookup
+costs one dict hit instead of one `exists` per tier.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResolutionCache:
+    def __init__(self, max_entries=65536, uncached=()):
+        self.max_entries = max_entries
+        # Tiers whose resolutions are never kept (see tierChain.py)
+        self.uncached = uncached
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation. A lookup that probed the tiers while a
+        # mutation was running must not store what it saw (see put())
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, partial):
+        with self.lock:
+            entry = self.entries.get(partial)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(partial)
+            self.hits += 1
+            return entry
+
+    def peek(self, partial):
+        # Like get(), without counting or refreshing the entry
+        with self.lock:
+            return self.entries.get(partial)
+
+    def put(self, partial, tier, path, generation=None):
+        if tier in self.uncached:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[partial] = (tier, path)
+            self.entries.move_to_end(partial)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, partial):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+
+    def invalidate_tree(self, partial):
+        # A directory went away or moved: drop it and everything below it
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(partial, None)
+            prefix = partial + "/" if partial else ""
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -7,6 +7,40 @@ Commands:
 python3 ./sampleFuse.py ./primaryFS/ ./fallbackFS/ ./mountPoint/
 ./fallbackFS/
 
+Add `--threads N` to let up to N FUSE requests run concurrently, and
+`--write-back BYTES` to merge small writes in memory before they reach disk.
+`--durability strict|fsync-only|group-commit` picks what close() and fsync()
+cost (see durability.py). `--attr-ttl primary=1,fallback=30` sets how long
+getattr results are cached per tier, `--miss-ttl S` how long a path found on
+no tier is reported missing without probing again (1s, 0 disables), and
+`--attr-timeout`, `--entry-timeout` and `--negative-timeout` set the kernel's
+own cache timeouts.
+`--promote-budget BYTES` lets files opened `--promote-after N` times (3 by
+default) be copied from fallbackFS into primaryFS, up to BYTES in total;
+`--promote-state FILE` remembers those copies across mounts.
+`--index FILE` keeps the entries of fallbackFS in a SQLite index, so lookups
+and listings of a fresh mount do not probe it name by name (see
+metadataIndex.py).
+`--watch` follows changes made to primaryFS and fallbackFS outside the mount
+with inotify, so their getattr results can be cached for 300s instead (see
+watcher.py).
+`--mmap-budget BYTES` serves reads of fallbackFS files from shared memory
+mappings, up to BYTES of address space (see mappingCache.py).
+`--read-only fallback` keeps the mount from changing fallbackFS (EROFS;
+misses are created on primaryFS), and `--uncached primary` keeps the
+resolutions and attributes of primaryFS out of the caches, for a tier
+changed outside the mount without --watch (see tierChain.py).
+`--trace FILE` records every operation into a binary trace that
+benchmarks/replay.py can run again (see traceLog.py).
+A rename from primaryFS to fallbackFS, or back, on different filesystems
+copies the data in the kernel instead of failing with EXDEV, and with a
+libfuse3 binding `cp` goes through copy_file_range instead of reads and
+writes (see fileCopy.py).
+
+Per-operation latency and cache hit ratios can be read from the mount itself:
+`cat mountPoint/.fusestats` (JSON) or `mountPoint/.fusestats.prom`
+(Prometheus text format).
+
 Usage: with another terminal as root you can list the directory
 """
 
@@ -15,85 +49,378 @@ Usage: with another terminal as root you can list the directory
 import os
 import sys
 import errno
+import threading
+import time
 
 from fuse import FUSE, FuseOSError, Operations
 
+from attrCache import DEFAULT_TTLS, AttrCache, parse_ttls
+from dirListing import DirCache, tier_mtimes, union
+from durability import MODES, Durability
+from fileCopy import copy_range, move
+from handleTable import FileHandle, HandleTable
+from locking import StripedLocks
+from mappingCache import MappingCache
+from metadataIndex import MISSING, MetadataIndex
+from metrics import Metrics, StatsFile
+from negativeCache import NegativeCache
+from promotion import Promoter
+from resolutionCache import ResolutionCache
+from tierChain import MISS, Found, Tier, TierChain, attributes, lstat, parse_tiers
+from traceLog import TraceRecorder
+from units import parse_size
+from watcher import WATCHED_TTL, Watcher
+
 
 class Passthrough(Operations):
-    def __init__(self, root, fallbackPath=None):
+    def __init__(self, root, fallbackPath=None, threads=1, write_back=0, durability=None, attr_ttls=None, promoter=None, miss_ttl=1.0, index=None, watcher=None, recorder=None, mappings=None, read_only=(), uncached=()):
         self.root = root
         self.fallbackPath = fallbackPath
+        # The tiers in lookup order; a path on neither is created on the one
+        # holding its parent directory. `read_only` and `uncached` name tiers
+        # (see --read-only and --uncached)
+        self.tiers = TierChain([
+            Tier('primary', root, write_target=True),
+            Tier('fallback', fallbackPath, write_target=True, find=self._find_fallback),
+        ], read_only, uncached)
+        self.resolution_cache = ResolutionCache(uncached=self.tiers.uncached)
+        # getattr results, kept for a per-tier TTL (see --attr-ttl)
+        self.attr_cache = AttrCache(attr_ttls, uncached=self.tiers.uncached)
+        # Merged readdir listings, reused while no tier's directory changed
+        self.dir_cache = DirCache()
+        # Paths found on no tier, for `miss_ttl` seconds (see --miss-ttl)
+        self.negative_cache = NegativeCache(miss_ttl)
+
+        # Writable handles hold back up to `write_back` bytes (see --write-back)
+        self.handles = HandleTable(write_back)
+        # Read-only fallback files served from shared mappings (see
+        # --mmap-budget)
+        self.mappings = mappings
+        # What flush and fsync cost (see --durability)
+        self.durability = durability or Durability()
+
+        # FUSE may dispatch from several threads (see --threads): at most
+        # `threads` operations run at once, and operations on the same path
+        # serialize on these locks
+        self.gate = threading.BoundedSemaphore(threads)
+        self.path_locks = StripedLocks()
+
+        # Copies hot fallback files into primaryFS (see --promote-budget)
+        self.promoter = promoter
+        if promoter:
+            promoter.start(self.path_locks, self._invalidate)
+
+        # Entries of fallbackFS kept across mounts (see --index)
+        self.index = index
+        if index:
+            index.start()
+
+        # Notices changes made to the tiers outside the mount (see --watch)
+        self.watcher = watcher
+        if watcher:
+            watcher.start(self._invalidate, self._touched)
+
+        # Latency and cache numbers, readable at /.fusestats
+        self.metrics = Metrics()
+        self.metrics.add_source('resolution', self.resolution_cache.stats)
+        self.metrics.add_source('attr', self.attr_cache.stats)
+        self.metrics.add_source('dir', self.dir_cache.stats)
+        self.metrics.add_source('negative', self.negative_cache.stats)
+        if promoter:
+            self.metrics.add_source('promotion', promoter.stats)
+        if index:
+            self.metrics.add_source('index', index.stats)
+        if watcher:
+            self.metrics.add_source('watcher', watcher.stats)
+        if mappings:
+            self.metrics.add_source('mmap', mappings.stats)
+        # Binary trace of every operation (see --trace)
+        self.recorder = recorder
+        if recorder:
+            recorder.start()
+            self.metrics.add_source('trace', recorder.stats)
+        self.stats_file = StatsFile(self.metrics)
+
+    def __call__(self, op, *args):
+        if args and args[0] in self.stats_file:
+            return self.stats_file(op, *args)
+        with self.gate:
+            start = time.perf_counter()
+            try:
+                result = super().__call__(op, *args)
+            except OSError as e:
+                elapsed = time.perf_counter() - start
+                self.metrics.observe(op, elapsed, failed=True)
+                if self.recorder:
+                    self.recorder.record(op, args, None, start, elapsed, self._traced_tier(args), e.errno)
+                raise
+        if op == 'readdir':
+            result = self._gated(result)
+            if self.recorder:
+                result = self.recorder.listing(args, result, start)
+            return self.metrics.timed(op, result, start)
+        tier = None
+        if op in ('read', 'write'):
+            tier = self.handles.get(args[-1]).tier
+            self.metrics.transfer(tier, op, len(result) if op == 'read' else result)
+        elif op in ('open', 'create'):
+            tier = self.handles.get(result).tier
+        elapsed = time.perf_counter() - start
+        self.metrics.observe(op, elapsed, tier)
+        if self.recorder:
+            self.recorder.record(op, args, result, start, elapsed, tier or self._traced_tier(args))
+        return result
+
+    def _gated(self, listing):
+        # readdir is a generator: it does its work, remote scans included,
+        # while FUSE iterates it, and holds its slot of the gate until then
+        with self.gate:
+            yield from listing
+
+    def _traced_tier(self, args):
+        # The tier the path of a traced call resolves to, if known
+        if args and isinstance(args[0], str):
+            entry = self.resolution_cache.peek(args[0].lstrip("/"))
+            if entry is not None:
+                return entry[0]
+        return None
 
     # Helpers
     # =======
 
-    def _full_path(self, partial, useFallBack=False):
+    def _full_path(self, partial, useFallBack=False, write=False):
+        if useFallBack:
+            # Explicitly asked for the fallback path
             if partial.startswith("/"):
                 partial = partial[1:]
-
-            # Find out the real path. If has been requesetd for a fallback path,
-            # use it
-            path = primaryPath = os.path.join(
-                self.fallbackPath if useFallBack else self.root, partial)
-
-            # If the pah does not exists and we haven't been asked for the fallback path
-            # try to look on the fallback filessytem
-            if not os.path.exists(primaryPath) and not useFallBack:
-                path = fallbackPath = os.path.join(self.fallbackPath, partial)
-
-                # If the path does not exists neither in the fallback fielsysem
-                # it's likely to be a write operation, so use the primary
-                # filesystem... unless the path to get the file exists in the
-                # fallbackFS!
-                if not os.path.exists(fallbackPath):
-                    # This is probabily a write operation, so prefer to use the
-                    # primary path either if the directory of the path exists in the
-                    # primary FS or not exists in the fallback FS
-
-                    primaryDir = os.path.dirname(primaryPath)
-                    fallbackDir = os.path.dirname(fallbackPath)
-
-                    if os.path.exists(primaryDir) or not os.path.exists(fallbackDir):
-                        path = primaryPath
-
-            return path
+            return os.path.join(self.fallbackPath, partial)
+        tier, full_path = self._resolve(partial)
+        if write:
+            self._writable(tier)
+        return full_path
+
+    def _resolve(self, partial):
+        # Returns (tier, real path) for a virtual path
+        return self._lookup(partial)[:2]
+
+    def _lookup(self, partial):
+        # Returns (tier, real path, stat) for a virtual path. The stat is what
+        # the lookup found the path with: its lstat, or the attributes the
+        # index holds; None when the resolution was cached; False when the
+        # path is on no tier, and tier and path say where it would be created
+        if partial.startswith("/"):
+            partial = partial[1:]
+
+        cached = self.resolution_cache.get(partial)
+        if cached is not None:
+            return cached + (None,)
+        generation = self.resolution_cache.generation
+        attr_generation = self.attr_cache.generation
+        missing = self.negative_cache.generation
+
+        # Paths known to be on no tier skip the probes
+        if not self.negative_cache.get(partial):
+            found = self.tiers.lookup(partial)
+            if found is not None:
+                tier, full_path, st = found
+                self.resolution_cache.put(partial, tier, full_path, generation)
+                if isinstance(st, dict):
+                    self.attr_cache.put(partial, tier, st, attr_generation)
+                return found
+            self.negative_cache.put(partial, missing)
+
+        # If the path does not exists neither in the fallback fielsysem
+        # it's likely to be a write operation, so prefer to use the
+        # primary path either if the directory of the path exists in the
+        # primary FS or not exists in the fallback FS
+        return self.tiers.target(partial) + (False,)
+
+    def _find_fallback(self, partial, path, state):
+        # The index knows fallbackFS without probing it, attributes included
+        indexed = self.index.lookup(partial) if self.index else None
+        if indexed is MISSING:
+            return MISS
+        if indexed is not None:
+            return Found('fallback', path, indexed[1])
+        # If the pah does not exists try to look on the fallback filessytem
+        return lstat(path)
+
+    def _writable(self, tier):
+        # Operations that change a path refuse a read-only tier (see
+        # --read-only)
+        if self.tiers.read_only(tier):
+            raise FuseOSError(errno.EROFS)
+
+    def _invalidate(self, path, tree=False):
+        # Called after every operation of the mount that creates, removes or
+        # moves a path, so cached resolutions never point at the wrong tier
+        partial = path[1:] if path.startswith("/") else path
+        if tree:
+            self.resolution_cache.invalidate_tree(partial)
+            self.attr_cache.invalidate_tree(partial)
+            self.negative_cache.invalidate_tree(partial)
+        else:
+            self.resolution_cache.invalidate(partial)
+            self.attr_cache.invalidate(partial)
+            self.negative_cache.invalidate(partial)
+        if self.index:
+            self.index.invalidate(partial, tree)
+        if tree:
+            self.dir_cache.invalidate_tree(partial)
+        # The parent's listing, mtime and link count changed too
+        self.attr_cache.invalidate(os.path.dirname(partial))
+        self.dir_cache.invalidate(os.path.dirname(partial))
+
+    def _unpromote(self, path, tree=False):
+        # Called before an operation modifies `path`: a promoted copy must not
+        # take the change in place of its source
+        if self.promoter:
+            partial = path[1:] if path.startswith("/") else path
+            if tree:
+                self.promoter.demote_tree(partial)
+            else:
+                self.promoter.demote(partial)
+
+    def _unmap(self, path):
+        # Called before the mount changes the data of `path` or replaces it:
+        # handles reading it through a mapping go back to pread, so a file
+        # shrinking under them cannot fault (see mappingCache.py)
+        if self.mappings:
+            for handle in self.handles.for_path(path):
+                mapping = handle.unmap()
+                if mapping is not None:
+                    self.mappings.drop(mapping)
+
+    def _touched(self, path):
+        # Called after the mount changed the data or metadata of `path`
+        partial = path[1:] if path.startswith("/") else path
+        self.attr_cache.invalidate(partial)
+        if self.index:
+            self.index.touched(partial)
 
     # Filesystem methods
     # ==================
 
     def access(self, path, mode):
-        full_path = self._full_path(path)
+        tier, full_path, st = self._lookup(path)
+        if st is False:
+            raise FuseOSError(errno.ENOENT)
+        if mode == os.F_OK and st is not None:
+            # The lookup saw it
+            return
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
 
     def chmod(self, path, mode):
-        full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        self._unpromote(path)
+        full_path = self._full_path(path, write=True)
+        try:
+            return os.chmod(full_path, mode)
+        finally:
+            self._touched(path)
 
     def chown(self, path, uid, gid):
-        full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        self._unpromote(path)
+        full_path = self._full_path(path, write=True)
+        try:
+            return os.chown(full_path, uid, gid)
+        finally:
+            self._touched(path)
 
     def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                        'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid', 'st_blocks'))
+        partial = path[1:] if path.startswith("/") else path
+        attrs = self.attr_cache.get(partial)
+        if attrs is None:
+            generation = self.attr_cache.generation
+            tier, full_path, st = self._lookup(path)
+            if st is False:
+                # What lstat'ing the path would have raised
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), full_path)
+            if st is None:
+                try:
+                    st = os.lstat(full_path)
+                except FileNotFoundError:
+                    # Only the resolution can be stale; the parent did not change
+                    self.resolution_cache.invalidate(partial)
+                    raise
+            # Otherwise what the lookup found it with: one syscall per tier
+            # visited, or none when the index answered
+            attrs = st if isinstance(st, dict) else attributes(st)
+            self.attr_cache.put(partial, tier, attrs, generation)
+        # Writes held back by open handles may have made the file longer
+        size = self.handles.visible_size(path, attrs['st_size'])
+        if size != attrs['st_size']:
+            attrs = dict(attrs, st_size=size)
+        return attrs
 
     def readdir(self, path, fh):
-            dirents = ['.', '..']
-            full_path = self._full_path(path)
-            # print("listing " + full_path)
-            if os.path.isdir(full_path):
-                dirents.extend(os.listdir(full_path))
-            if self.fallbackPath not in full_path:
-                full_path = self._full_path(path, useFallBack=True)
-                # print("listing_ext " + full_path)
-                if os.path.isdir(full_path):
-                    dirents.extend(os.listdir(full_path))
-            for r in list(set(dirents)):
-                yield r
-
+        partial = path[1:] if path.startswith("/") else path
+        if self.watcher:
+            for tier, _ in self._tier_dirs(partial):
+                self.watcher.seen(tier, partial)
+        indexed = self.index.listing(partial) if self.index else None
+        if indexed is not None:
+            yield from self._indexed_readdir(partial, indexed)
+            return
+        generation = self.dir_cache.generation
+        dirs, mtimes = tier_mtimes(self._tier_dirs(partial))
+
+        yield '.'
+        yield '..'
+
+        names = self.dir_cache.get(partial, mtimes)
+        if names is not None:
+            for name in names:
+                yield name, self.attr_cache.get(os.path.join(partial, name)), 0
+            return
+
+        # Stream the union and remember it, unless it turns out too big.
+        # Every name goes out with its attributes, so `ls -l` does not
+        # follow up with a getattr (and a tier probe) per entry
+        seeds = (self.resolution_cache.generation, self.attr_cache.generation)
+        names = []
+        for tier, entry in union(dirs):
+            if names is not None:
+                names.append(entry.name)
+                if len(names) > self.dir_cache.max_names:
+                    names = None
+            yield entry.name, self._seed(partial, tier, entry, seeds), 0
+        if names is not None:
+            self.dir_cache.put(partial, mtimes, names, generation)
+
+    def _seed(self, partial, tier, entry, generations):
+        # Cache where `entry` lives and its attributes, as getattr would
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+        child = os.path.join(partial, entry.name)
+        attrs = attributes(st)
+        self.resolution_cache.put(child, tier, entry.path, generations[0])
+        self.attr_cache.put(child, tier, attrs, generations[1])
+        return attrs
+
+    def _indexed_readdir(self, partial, indexed):
+        # primaryFS is listed, the rest comes from the index
+        yield '.'
+        yield '..'
+        seeds = (self.resolution_cache.generation, self.attr_cache.generation)
+        seen = set()
+        for tier, entry in union(self._tier_dirs(partial)[:1]):
+            seen.add(entry.name)
+            yield entry.name, self._seed(partial, tier, entry, seeds), 0
+        for tier, name, attrs in indexed:
+            if name in seen:
+                continue
+            child = os.path.join(partial, name)
+            self.resolution_cache.put(child, tier, self.index.real_path(tier, child), seeds[0])
+            if attrs is not None:
+                self.attr_cache.put(child, tier, attrs, seeds[1])
+            yield name, attrs, 0
+
+    def _tier_dirs(self, partial):
+        # The directory on every tier, highest priority first
+        return self.tiers.dirs(partial)
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -104,14 +431,24 @@ class Passthrough(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        return os.mknod(self._full_path(path), mode, dev)
+        try:
+            return os.mknod(self._full_path(path, write=True), mode, dev)
+        finally:
+            self._invalidate(path)
 
     def rmdir(self, path):
-        full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        self._unpromote(path, tree=True)
+        full_path = self._full_path(path, write=True)
+        try:
+            return os.rmdir(full_path)
+        finally:
+            self._invalidate(path, tree=True)
 
     def mkdir(self, path, mode):
-        return os.mkdir(self._full_path(path), mode)
+        try:
+            return os.mkdir(self._full_path(path, write=True), mode)
+        finally:
+            self._invalidate(path)
 
     def statfs(self, path):
         full_path = self._full_path(path)
@@ -121,68 +458,289 @@ class Passthrough(Operations):
                                                          'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        return os.unlink(self._full_path(path))
+        self._unpromote(path)
+        self._unmap(path)
+        try:
+            return os.unlink(self._full_path(path, write=True))
+        finally:
+            self._invalidate(path)
 
     def symlink(self, name, target):
-        return os.symlink(name, self._full_path(target))
+        try:
+            return os.symlink(name, self._full_path(target, write=True))
+        finally:
+            self._invalidate(target)
 
     def rename(self, old, new):
-        return os.rename(self._full_path(old), self._full_path(new))
+        self._unpromote(old, tree=True)
+        self._unpromote(new, tree=True)
+        self._unmap(old)
+        self._unmap(new)
+        with self.path_locks.many(old, new):
+            try:
+                # Copies in the kernel when the two ends are on different tiers
+                return move(self._full_path(old, write=True), self._full_path(new, write=True))
+            finally:
+                self._invalidate(old, tree=True)
+                self._invalidate(new, tree=True)
 
     def link(self, target, name):
-        return os.link(self._full_path(target), self._full_path(name))
+        self._unpromote(target)
+        try:
+            return os.link(self._full_path(target, write=True), self._full_path(name, write=True))
+        finally:
+            self._invalidate(target)
+            self._invalidate(name)
 
     def utimens(self, path, times=None):
-        return os.utime(self._full_path(path), times)
+        self._unpromote(path)
+        try:
+            return os.utime(self._full_path(path, write=True), times)
+        finally:
+            self._touched(path)
 
     # File methods
     # ============
 
     def open(self, path, flags):
-        full_path = self._full_path(path)
-        return os.open(full_path, flags)
+        writing = flags & os.O_ACCMODE != os.O_RDONLY or flags & os.O_TRUNC
+        if writing:
+            self._unpromote(path)
+            self._unmap(path)
+        tier, full_path = self._resolve(path)
+        if writing:
+            self._writable(tier)
+        if self.promoter and not writing and self.promoter.opened(path.lstrip("/"), tier, full_path):
+            tier, full_path = self._resolve(path)
+        fd = os.open(full_path, flags)
+        handle = FileHandle(fd, path, tier, full_path, flags)
+        if self.mappings and tier == 'fallback' and not writing:
+            handle.mapping = self.mappings.acquire(full_path, fd)
+        return self.handles.register(handle)
 
     def create(self, path, mode, fi=None):
-        full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        self._unpromote(path)
+        self._unmap(path)
+        tier, full_path = self._resolve(path)
+        self._writable(tier)
+        flags = os.O_RDWR | os.O_CREAT
+        try:
+            fd = os.open(full_path, flags, mode)
+        finally:
+            self._invalidate(path)
+        return self.handles.register(FileHandle(fd, path, tier, full_path, flags))
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        return self.handles.get(fh).read(length, offset)
 
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        written = self.handles.get(fh).write(buf, offset)
+        self._touched(path)
+        return written
+
+    def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out, offset_out, length, flags):
+        # What `cp` asks of libfuse3 bindings instead of reads and writes; the
+        # bytes stay in the kernel, reflinked or copied server-side where the
+        # backing filesystems can (see fileCopy.py)
+        if flags:
+            raise FuseOSError(errno.EINVAL)
+        src = self.handles.get(fh_in)
+        dst = self.handles.get(fh_out)
+        src.drain()
+        dst.drain()
+        try:
+            return copy_range(src.fd, offset_in, dst.fd, offset_out, length)
+        finally:
+            self._touched(path_out)
 
     def truncate(self, path, length, fh=None):
-        full_path = self._full_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        self._unmap(path)
+        try:
+            if fh is not None:
+                handle = self.handles.get(fh)
+                handle.truncate(length)
+                return os.ftruncate(handle.fd, length)
+            self.handles.truncate(path, length)
+            self._unpromote(path)
+            full_path = self._full_path(path, write=True)
+            with open(full_path, 'r+') as f:
+                f.truncate(length)
+        finally:
+            self._touched(path)
 
     def flush(self, path, fh):
-        return os.fsync(fh)
+        self.handles.get(fh).drain()
+        return self.durability.flush(fh)
 
     def release(self, path, fh):
-        return os.close(fh)
+        handle = self.handles.pop(fh)
+        try:
+            handle.drain()
+        finally:
+            os.close(handle.fd)
+            mapping = handle.unmap()
+            if mapping is not None:
+                self.mappings.release(mapping)
+            self._touched(path)
 
     def fsync(self, path, fdatasync, fh):
-        return self.flush(path, fh)
-
-
-def main(mountpoint, root, fallbackPath=None):
+        self.handles.get(fh).drain()
+        return self.durability.fsync(fh, bool(fdatasync))
+
+    def destroy(self, path):
+        self.durability.stop()
+        self.handles.stop()
+        if self.promoter:
+            self.promoter.stop()
+        if self.watcher:
+            self.watcher.stop()
+        if self.index:
+            self.index.stop()
+        if self.mappings:
+            self.mappings.stop()
+        if self.recorder:
+            self.recorder.stop()
+
+
+def main(mountpoint, root, fallbackPath=None, threads=1, write_back=0, durability=None, attr_ttls=None, promoter=None, miss_ttl=1.0, index=None, watcher=None, recorder=None, mappings=None, read_only=(), uncached=(), **fuse_options):
+    # With a single thread keep libfuse's own single-threaded loop
+    nothreads = threads <= 1
     if fallbackPath:
-        FUSE(Passthrough(root, fallbackPath), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, fallbackPath, threads=threads, write_back=write_back, durability=durability, attr_ttls=attr_ttls, promoter=promoter, miss_ttl=miss_ttl, index=index, watcher=watcher, recorder=recorder, mappings=mappings, read_only=read_only, uncached=uncached), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
     else:
-        FUSE(Passthrough(root), mountpoint, nothreads=True, foreground=True)
+        FUSE(Passthrough(root, threads=threads, write_back=write_back, durability=durability, attr_ttls=attr_ttls, miss_ttl=miss_ttl, watcher=watcher, recorder=recorder, read_only=read_only, uncached=uncached), mountpoint, nothreads=nothreads, foreground=True, **fuse_options)
 
 
 if __name__ == '__main__':
+    threads = 1
+    if "--threads" in sys.argv:
+        i = sys.argv.index("--threads")
+        threads = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # Bytes each writable handle may hold back in memory
+    write_back = 0
+    if "--write-back" in sys.argv:
+        i = sys.argv.index("--write-back")
+        write_back = parse_size(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # strict, fsync-only or group-commit; see durability.py
+    mode = 'strict'
+    if "--durability" in sys.argv:
+        i = sys.argv.index("--durability")
+        mode = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+    interval = 0.005
+    if "--group-commit-ms" in sys.argv:
+        i = sys.argv.index("--group-commit-ms")
+        interval = float(sys.argv[i + 1]) / 1000
+        del sys.argv[i:i + 2]
+    if mode not in MODES:
+        print("--durability must be one of " + ", ".join(MODES))
+        sys.exit(1)
+
+    # getattr cache TTL per tier, e.g. primary=1,fallback=30
+    attr_ttls = None
+    if "--attr-ttl" in sys.argv:
+        i = sys.argv.index("--attr-ttl")
+        attr_ttls = parse_ttls(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # How long a path found on no tier is answered without probing again
+    miss_ttl = 1.0
+    if "--miss-ttl" in sys.argv:
+        i = sys.argv.index("--miss-ttl")
+        miss_ttl = float(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # Kernel-side cache timeouts in seconds, handed to FUSE as -o options
+    fuse_options = {}
+    for option in ('attr_timeout', 'entry_timeout', 'negative_timeout'):
+        flag = '--' + option.replace('_', '-')
+        if flag in sys.argv:
+            i = sys.argv.index(flag)
+            fuse_options[option] = float(sys.argv[i + 1])
+            del sys.argv[i:i + 2]
+
+    # Room on primaryFS for copies of hot fallback files; see promotion.py
+    promote_budget = 0
+    if "--promote-budget" in sys.argv:
+        i = sys.argv.index("--promote-budget")
+        promote_budget = parse_size(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    promote_after = 3
+    if "--promote-after" in sys.argv:
+        i = sys.argv.index("--promote-after")
+        promote_after = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    promote_state = None
+    if "--promote-state" in sys.argv:
+        i = sys.argv.index("--promote-state")
+        promote_state = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+
+    # SQLite file holding the entries of fallbackFS; see metadataIndex.py
+    index_file = None
+    if "--index" in sys.argv:
+        i = sys.argv.index("--index")
+        index_file = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+
+    # Follow changes made outside the mount; see watcher.py
+    watch = "--watch" in sys.argv
+    if watch:
+        sys.argv.remove("--watch")
+
+    # Address space for mappings of fallbackFS files; see mappingCache.py
+    mappings = None
+    if "--mmap-budget" in sys.argv:
+        i = sys.argv.index("--mmap-budget")
+        mappings = MappingCache(parse_size(sys.argv[i + 1]))
+        del sys.argv[i:i + 2]
+
+    # Tiers the mount never changes, and tiers left out of the caches; see
+    # tierChain.py
+    tier_flags = {}
+    for flag in ('--read-only', '--uncached'):
+        tier_flags[flag] = ()
+        if flag in sys.argv:
+            i = sys.argv.index(flag)
+            try:
+                tier_flags[flag] = parse_tiers(sys.argv[i + 1], ('primary', 'fallback'))
+            except ValueError as e:
+                print(flag + ": " + str(e))
+                sys.exit(1)
+            del sys.argv[i:i + 2]
+
+    # Binary trace of every operation; see traceLog.py
+    recorder = None
+    if "--trace" in sys.argv:
+        i = sys.argv.index("--trace")
+        recorder = TraceRecorder(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
     if len(sys.argv) < 3 or len(sys.argv) > 4:
-        print("Usage: python dfs.py primary_fs_root [fallback_fs_root] mount_point")
+        print("Usage: python dfs.py [--threads N] [--write-back BYTES] [--durability MODE [--group-commit-ms N]] [--attr-ttl TIER=SECONDS,...] [--miss-ttl S] [--attr-timeout S] [--entry-timeout S] [--negative-timeout S] [--promote-budget BYTES [--promote-after N] [--promote-state FILE]] [--index FILE] [--watch] [--mmap-budget BYTES] [--read-only TIER,...] [--uncached TIER,...] [--trace FILE] primary_fs_root [fallback_fs_root] mount_point")
         sys.exit(1)
 
     primary_fs_root = sys.argv[1]
     fallback_fs_root = sys.argv[2] if len(sys.argv) == 4 else None
     mount_point = sys.argv[-1]
     print(fallback_fs_root)
-    main(mount_point, primary_fs_root, fallback_fs_root)
+    promoter = None
+    if promote_budget and fallback_fs_root:
+        promoter = Promoter(primary_fs_root, promote_budget, promote_after, state_file=promote_state)
+    index = None
+    if index_file and fallback_fs_root:
+        index = MetadataIndex(index_file, [('fallback', os.path.abspath(fallback_fs_root))])
+    watcher = None
+    if watch:
+        watched = [('primary', os.path.abspath(primary_fs_root))]
+        if fallback_fs_root:
+            watched.append(('fallback', os.path.abspath(fallback_fs_root)))
+        watcher = Watcher(watched)
+        # Changes are pushed, so the watched tiers need no short TTL
+        if attr_ttls is None:
+            attr_ttls = dict(DEFAULT_TTLS, **dict((tier, WATCHED_TTL) for tier, _ in watched))
+    main(mount_point, primary_fs_root, fallback_fs_root, threads, write_back, Durability(mode, interval), attr_ttls, promoter, miss_ttl, index, watcher, recorder, mappings, tier_flags['--read-only'], tier_flags['--uncached'], **fuse_options)
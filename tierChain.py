@@ -0,0 +1,146 @@
+"""
+The ordered tiers a virtual path is looked up in.
+
+Every Passthrough class describes its tiers as a TierChain, highest
+priority first, and resolves paths through it:
+
+- `lookup` visits the tiers in order and returns the first one holding the
+  path together with what found it there: by default one lstat per tier,
+  whose stat result getattr (and access, and the attribute caches) reuse
+  instead of stat'ing the path a second time.
+- a tier's `find(partial, path, state)` hook stands in for that lstat when
+  the tier is not a plain directory, or something else answers for it (the
+  staging area, the metadata index, the remote tier). It returns something
+  false when the path is not on the tier and anything else when it is (a
+  stat result, getattr's attributes, or True); a `Found` for a path it
+  located on a tier further down; MISS when the path is on none of the
+  tiers left, and GIVE_UP to end the lookup without an answer. `state` is
+  shared by the hooks of one lookup.
+- `target` is where a path found on no tier gets created: the write target
+  holding its parent directory, the first write target when none does.
+- `dirs` is the directory of a path on every listed tier, for listings.
+
+A tier is flagged `read_only` (the mount refuses to change anything on it
+with EROFS, and never creates there), `write_target` (misses are created
+there), `cacheable` (its resolutions and attributes may be cached; the
+caches skip the tiers in `uncached`) and `listed` (its directories are
+local ones readdir can scan). The names given to TierChain as `read_only`
+and `uncached` (see --read-only and --uncached) override the tiers' own
+flags. Lookups go by lstat, so a dangling symlink is found on the tier
+holding it, as readdir and getattr already saw it.
+
+`attributes` turns a stat result into getattr's dict using the fixed
+STAT_FIELDS list.
+"""
+
+import operator
+import os
+
+# What getattr reports, and readdir along with every name
+STAT_FIELDS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
+               'st_nlink', 'st_size', 'st_uid', 'st_blocks')
+
+_stat_values = operator.attrgetter(*STAT_FIELDS)
+
+# What a `find` hook returns to end the lookup: on no tier, or unknown
+MISS = object()
+GIVE_UP = object()
+
+
+def attributes(st):
+    # getattr's dict of an os.stat_result
+    return dict(zip(STAT_FIELDS, _stat_values(st)))
+
+
+def parse_tiers(text, names):
+    # "fallback,remote", for --read-only and --uncached; ValueError on a tier
+    # not in `names`
+    tiers = tuple(name.strip() for name in text.split(',') if name.strip())
+    unknown = [name for name in tiers if name not in names]
+    if unknown:
+        raise ValueError("unknown tier %s, expected one of %s" % (", ".join(unknown), ", ".join(names)))
+    return tiers
+
+
+def lstat(path):
+    # os.lstat, or None where os.path.exists would have said False
+    try:
+        return os.lstat(path)
+    except (OSError, ValueError):
+        return None
+
+
+class Found:
+    # What a `find` hook returns for a path it located on another tier
+    def __init__(self, tier, path, value):
+        self.tier = tier
+        self.path = path
+        self.value = value
+
+
+class Tier:
+    def __init__(self, name, root, read_only=False, write_target=False, cacheable=True, listed=True, find=None):
+        self.name = name
+        self.root = root
+        self.read_only = read_only
+        self.write_target = write_target
+        self.cacheable = cacheable
+        self.listed = listed
+        self.find = find
+
+
+class TierChain:
+    def __init__(self, tiers, read_only=(), uncached=()):
+        self.tiers = [tier for tier in tiers if tier.root is not None]
+        for tier in self.tiers:
+            tier.read_only = tier.read_only or tier.name in read_only
+            tier.cacheable = tier.cacheable and tier.name not in uncached
+        self.by_name = dict((tier.name, tier) for tier in self.tiers)
+        self.targets = [tier for tier in self.tiers if tier.write_target and not tier.read_only]
+        # Tiers whose resolutions and attributes the caches leave out
+        self.uncached = frozenset(tier.name for tier in self.tiers if not tier.cacheable)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def path(self, name, partial):
+        return os.path.join(self.by_name[name].root, partial)
+
+    def read_only(self, name):
+        tier = self.by_name.get(name)
+        return tier is not None and tier.read_only
+
+    def lookup(self, partial, probe=None):
+        # (tier name, real path, what found it) of the first tier holding
+        # `partial`; None when it is on no tier, GIVE_UP when a tier could not
+        # tell. `probe(name, path)` replaces lstat, e.g. to time it
+        state = {}
+        for tier in self.tiers:
+            path = os.path.join(tier.root, partial)
+            if tier.find is not None:
+                found = tier.find(partial, path, state)
+            else:
+                found = probe(tier.name, path) if probe else lstat(path)
+            if found is MISS:
+                return None
+            if found is GIVE_UP:
+                return GIVE_UP
+            if isinstance(found, Found):
+                return found.tier, found.path, found.value
+            if found:
+                return tier.name, path, found
+        return None
+
+    def target(self, partial):
+        # (tier name, real path) where `partial`, on no tier, gets created
+        if len(self.targets) > 1:
+            parent = os.path.dirname(partial)
+            for tier in self.targets:
+                if os.path.isdir(os.path.join(tier.root, parent)):
+                    return tier.name, os.path.join(tier.root, partial)
+        tier = self.targets[0] if self.targets else self.tiers[0]
+        return tier.name, os.path.join(tier.root, partial)
+
+    def dirs(self, partial):
+        # [(tier name, directory)] of `partial` on every listed tier, in order
+        return [(tier.name, os.path.join(tier.root, partial)) for tier in self.tiers if tier.listed]
@@ -0,0 +1,147 @@
+"""
+Tier probes with latency accounting, a remote deadline and optional hedging.
+
+`_resolve` asks primary, then fallback, then the remote tier whether a path
+exists. A probe is an lstat by default, and its stat result goes back to
+the lookup (see tierChain.py). Every probe is timed into the mount's
+metrics as the `probe` op, split by tier, so /.fusestats shows what each
+tier costs per lookup.
+
+The remote probe runs on a small thread pool whenever the mount has a remote
+tier, so it is never waited on for longer than the tier's --remote-timeout
+even without a deadline of its own:
+
+- with a deadline (`deadline`, or else the tier's timeout), a probe still
+  running after it is abandoned (its thread finishes in the background) and the lookup goes on
+  according to `policy`: 'miss' answers as if the path were on no tier,
+  without remembering the miss; 'enoent' fails the operation with ENOENT
+  right away, so nothing is created locally over a remote file that may
+  well exist. A tier that is down or fenced off by its breaker (see
+  remoteTier.py) is skipped under the same policy.
+- hedged, the remote probe is launched as soon as primaryFS (and the index)
+  missed, and runs while fallbackFS is probed. A fallback hit still wins,
+  and the remote answer is dropped. The price is a remote probe for lookups
+  fallbackFS answers, once per path thanks to the resolution cache.
+"""
+
+import errno
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from fuse import FuseOSError
+
+from tierChain import lstat
+
+POLICIES = ('miss', 'enoent')
+
+# What settle returns for a probe abandoned at its deadline
+ABANDONED = object()
+
+
+class TierProber:
+    def __init__(self, hedge=False, deadline=None, policy='miss', workers=8):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of " + ", ".join(POLICIES))
+        self.metrics = None
+        self.hedge = hedge
+        self.deadline = deadline
+        self.policy = policy
+        self.workers = workers
+        # Remote probes stuck on a dead link hold a worker each; later ones
+        # queue, and their deadline runs from launch all the same
+        self.pool = ThreadPoolExecutor(max_workers=workers) if hedge or deadline else None
+        # The deadline of probes without one (see start)
+        self.timeout = None
+        # tier -> record(ok, seconds), told how each probe went
+        self.observers = {}
+        # tier -> probe(path), for tiers that are not local paths; anything
+        # true means the path is there
+        self.checks = {}
+        self.launched = 0
+        self.abandoned = 0
+        self.wasted = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def start(self, metrics, observers=None, checks=None, timeout=None):
+        # `timeout` bounds the probes launched on the pool when there is no
+        # `deadline`: the remote tier's per-op timeout
+        self.metrics = metrics
+        self.observers = observers or {}
+        self.checks = checks or {}
+        self.timeout = timeout
+        if timeout is not None and not self.pool:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def probe(self, tier, path):
+        start = time.perf_counter()
+        ok = True
+        try:
+            return self.checks.get(tier, lstat)(path)
+        except OSError:
+            ok = False
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe('probe', elapsed, tier, failed=not ok)
+            if tier in self.observers:
+                self.observers[tier](ok, elapsed)
+
+    def launch(self, tier, path):
+        # The probe running on the pool, or None when probes run inline
+        if not self.pool:
+            return None
+        with self.lock:
+            self.launched += 1
+        future = self.pool.submit(self.probe, tier, path)
+        future.launched = time.monotonic()
+        return future
+
+    def settle(self, tier, path, future):
+        # The probe's answer (a stat result or None by default), ABANDONED
+        # when the deadline passed under policy 'miss'
+        if future is None:
+            return self.probe(tier, path)
+        deadline = self.deadline if self.deadline is not None else self.timeout
+        timeout = None
+        if deadline is not None:
+            timeout = max(future.launched + deadline - time.monotonic(), 0)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            with self.lock:
+                self.abandoned += 1
+            self.metrics.observe('probe', deadline, tier, failed=True)
+            if tier in self.observers:
+                self.observers[tier](False, deadline)
+            if self.policy == 'enoent':
+                raise FuseOSError(errno.ENOENT)
+            return ABANDONED
+
+    def unreachable(self, tier):
+        # `tier` is not probed at all right now (down, or its breaker open);
+        # the lookup goes on as after a deadline
+        with self.lock:
+            self.skipped += 1
+        if self.policy == 'enoent':
+            raise FuseOSError(errno.ENOENT)
+
+    def discard(self, future):
+        # A higher tier answered; the launched probe is not needed
+        if future is not None:
+            with self.lock:
+                self.wasted += 1
+
+    def stop(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'launched': self.launched,
+                'abandoned': self.abandoned,
+                'wasted': self.wasted,
+                'skipped': self.skipped,
+            }
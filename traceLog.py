@@ -0,0 +1,208 @@
+"""
+Binary traces of the operations a mount serves.
+
+With --trace FILE every operation that reaches the Passthrough classes is
+appended to FILE as one fixed-size record: when it started, how long it
+took, the op, the path, the tier it was served from, the errno it failed
+with, and up to three integers describing it (offset and length of reads
+and writes, open flags, the FUSE fh...). Paths are written once, the first
+time they show up, and referred to by id after that. Records are packed
+into a buffer under a lock and written out in 256 KiB pieces, so tracing
+costs a struct.pack per operation.
+
+`read_trace` gives the records back with their paths;
+benchmarks/replay.py regenerates a tree from a trace and runs it again.
+
+File layout: MAGIC, then a stream of entries, each starting with one byte:
+b'P' followed by PATH (id, length) and the UTF-8 path, or b'O' followed by
+RECORD.
+"""
+
+import struct
+import threading
+import time
+
+MAGIC = b'FUSETRC1'
+
+PATH = struct.Struct('<IH')
+# start, latency, path id, op, tier, errno, offset, length, fh
+RECORD = struct.Struct('<dfIBBHqqQ')
+
+OPS = ('getattr', 'readdir', 'open', 'create', 'read', 'write', 'release', 'flush', 'fsync', 'truncate',
+       'access', 'readlink', 'mknod', 'mkdir', 'rmdir', 'unlink', 'symlink', 'rename', 'link', 'chmod',
+       'chown', 'utimens', 'statfs', 'opendir', 'releasedir', 'fsyncdir', 'getxattr', 'listxattr',
+       'setxattr', 'removexattr', 'init', 'destroy', 'other')
+OP_CODES = dict((op, code) for code, op in enumerate(OPS))
+TIERS = (None, 'primary', 'fallback', 'remote', 'staged')
+TIER_CODES = dict((tier, code) for code, tier in enumerate(TIERS))
+
+# Second path of rename, link and symlink, in the offset field
+SECOND_PATH = ('rename', 'link', 'symlink')
+NO_FH = (1 << 64) - 1
+
+
+def _fields(op, args, result):
+    # (offset, length, fh) describing one call; args start after the path
+    if op == 'read':
+        length, offset, fh = args
+        return offset, length, fh
+    if op == 'write':
+        buf, offset, fh = args
+        return offset, len(buf), fh
+    if op in ('open', 'create'):
+        return args[0], 0, result
+    if op in ('release', 'flush', 'releasedir'):
+        return 0, 0, args[0]
+    if op in ('fsync', 'fsyncdir'):
+        return int(bool(args[0])), 0, args[1]
+    if op == 'truncate':
+        fh = args[1] if len(args) > 1 else None
+        return 0, args[0], fh
+    if op in ('mkdir', 'chmod', 'access'):
+        return args[0], 0, None
+    if op == 'mknod':
+        return args[0], args[1], None
+    if op == 'chown':
+        return args[0], args[1], None
+    return 0, 0, None
+
+
+class TraceRecorder:
+    def __init__(self, path, buffer_size=256 << 10):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.file = None
+        self.buffer = bytearray()
+        # path -> id
+        self.ids = {}
+        self.started = None
+        self.records = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(MAGIC)
+        self.started = time.perf_counter()
+
+    def stop(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self._write()
+            self.file.close()
+            self.file = None
+
+    def record(self, op, args, result, start, latency, tier=None, error=0):
+        # One finished call; `start` is its time.perf_counter() at entry
+        path = args[0] if args and isinstance(args[0], str) else ''
+        try:
+            offset, length, fh = _fields(op, args[1:], result)
+        except (TypeError, ValueError, IndexError):
+            offset, length, fh = 0, 0, None
+        second = args[1] if op in SECOND_PATH and len(args) > 1 else None
+        self._append(op, path, start, latency, tier, error, offset, length, fh, second)
+
+    def _append(self, op, path, start, latency, tier, error, offset, length, fh, second=None):
+        with self.lock:
+            if self.file is None:
+                return
+            path_id = self._path_id(path)
+            if second is not None:
+                offset = self._path_id(second)
+            self.buffer += b'O'
+            self.buffer += RECORD.pack(start - self.started, latency, path_id, OP_CODES.get(op, OP_CODES['other']),
+                                       TIER_CODES.get(tier, 0), error or 0, int(offset or 0), int(length or 0),
+                                       NO_FH if fh is None else fh)
+            self.records += 1
+            if len(self.buffer) >= self.buffer_size:
+                self._write()
+
+    def listing(self, args, entries, start):
+        # readdir is a generator: recorded once FUSE is done with it, with
+        # the number of entries as its length
+        count = 0
+        error = 0
+        try:
+            for entry in entries:
+                count += 1
+                yield entry
+        except OSError as e:
+            error = e.errno
+            raise
+        finally:
+            self._append('readdir', args[0], start, time.perf_counter() - start, None, error, 0, count, None)
+
+    def _path_id(self, path):
+        path_id = self.ids.get(path)
+        if path_id is None:
+            path_id = self.ids[path] = len(self.ids)
+            encoded = path.encode('utf-8', 'surrogateescape')
+            self.buffer += b'P'
+            self.buffer += PATH.pack(path_id, len(encoded))
+            self.buffer += encoded
+        return path_id
+
+    def _write(self):
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.written += len(self.buffer)
+        self.buffer = bytearray()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'records': self.records,
+                'paths': len(self.ids),
+                'bytes_written': self.written,
+                'buffered': len(self.buffer),
+            }
+
+
+class Record:
+    __slots__ = ('start', 'latency', 'op', 'path', 'tier', 'errno', 'offset', 'length', 'fh', 'second')
+
+    def __init__(self, start, latency, op, path, tier, error, offset, length, fh, second=None):
+        self.start = start
+        self.latency = latency
+        self.op = op
+        self.path = path
+        self.tier = tier
+        self.errno = error
+        self.offset = offset
+        self.length = length
+        self.fh = None if fh == NO_FH else fh
+        # The other path of rename, link and symlink
+        self.second = second
+
+
+def read_trace(path):
+    # The records of a trace file, in the order they were written
+    paths = {}
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a trace file" % path)
+    offset = len(MAGIC)
+    while offset < len(data):
+        kind = data[offset:offset + 1]
+        offset += 1
+        if kind == b'P':
+            path_id, length = PATH.unpack_from(data, offset)
+            offset += PATH.size
+            paths[path_id] = data[offset:offset + length].decode('utf-8', 'surrogateescape')
+            offset += length
+        elif kind == b'O':
+            if offset + RECORD.size > len(data):
+                # Cut short by a crash
+                break
+            start, latency, path_id, op, tier, error, arg, length, fh = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            op = OPS[op] if op < len(OPS) else 'other'
+            second = paths.get(arg) if op in SECOND_PATH else None
+            records.append(Record(start, latency, op, paths.get(path_id, ''), TIERS[tier] if tier < len(TIERS) else None,
+                                  error, arg, length, fh, second))
+        else:
+            raise ValueError("%s: corrupt entry at byte %d" % (path, offset - 1))
+    return records
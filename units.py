@@ -0,0 +1,12 @@
+"""
+Parsing of human-friendly sizes given on the command line.
+"""
+
+
+def parse_size(text):
+    # "1073741824", "512M", "2G"...
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
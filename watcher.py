@@ -0,0 +1,352 @@
+"""
+Invalidation of the mount's caches for changes made outside the mount.
+
+The resolution, attribute, listing and negative caches are kept coherent by
+the mount's own write paths. `Watcher` covers everything else:
+
+- local tiers (primaryFS, fallbackFS) are watched with inotify, through
+  ctypes, one watch per directory. Creations, removals and moves invalidate
+  the path like the mount's own mkdir/unlink/rename would; content and
+  attribute changes invalidate its attributes.
+- the sshfs tier has no inotify, so the directories the mount has looked at
+  are polled: each is listed every `interval` seconds and the names, sizes
+  and mtimes compared with the previous listing. All listings, the first
+  one included, are taken by the poll thread through the mount's `call`
+  (bounded by --remote-timeout for the remote tier), never on a FUSE
+  thread.
+
+Changes on a watched tier then reach the caches within milliseconds, so
+their TTLs can be long (WATCHED_TTL by default). The kernel's own entry and
+attribute caches are not reached from here; keep --attr-timeout and
+--entry-timeout short. When fs.inotify.max_user_watches runs out, the
+directories past the limit are polled like the remote ones.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Attribute TTL of the tiers a Watcher covers, unless --attr-ttl says otherwise
+WATCHED_TTL = 300.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+EVENT = struct.Struct('iIII')
+
+# What a polled directory holds until the poll thread first lists it
+UNLISTED = object()
+
+
+class Inotify:
+    # The three inotify calls, straight from libc
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        # [(wd, mask, name)] of the events queued so far
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    def __init__(self, watched=(), polled=(), interval=5.0, max_polled=256):
+        # watched: [(tier, root)] for inotify, polled: [(tier, root)]
+        self.watched = list(watched)
+        self.polled = dict(polled)
+        self.interval = interval
+        self.max_polled = max_polled
+        self.inotify = None
+        # wd -> (tier, directory)
+        self.wds = {}
+        # (tier, directory) -> {name: (mode, size, mtime_ns, ctime_ns)}, None
+        # when it is not there or UNLISTED; LRU
+        self.listings = OrderedDict()
+        self.on_change = None
+        self.on_touch = None
+        self.events = 0
+        self.polls = 0
+        self.invalidations = 0
+        self.overflows = 0
+        self.watch_limit_hit = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Set when a directory is waiting for its first listing
+        self.fresh = threading.Event()
+        self.call = None
+        self.wakeup = None
+        self.threads = []
+
+    def start(self, on_change, on_touch, call=None):
+        # on_change(partial, tree) for creations, removals and moves,
+        # on_touch(partial) for data and attribute changes; call(tier, fn,
+        # *args) runs the listing of a polled directory on its tier
+        self.on_change = on_change
+        self.on_touch = on_touch
+        self.call = call or (lambda tier, fn, *args: fn(*args))
+        if self.watched:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                log.warning("inotify unavailable (%s), polling the local tiers", e)
+                self.polled.update(self.watched)
+                self.watched = []
+        if self.inotify:
+            for tier, root in self.watched:
+                self._watch_tree(tier, root, '')
+            self.wakeup = os.pipe()
+            self.threads.append(threading.Thread(target=self._read_events, name='watcher-inotify', daemon=True))
+        # Also started for inotify alone: directories past the watch limit
+        # end up polled
+        self.threads.append(threading.Thread(target=self._poll, name='watcher-poll', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.fresh.set()
+        if self.wakeup:
+            os.write(self.wakeup[1], b'x')
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.inotify:
+            self.inotify.close()
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+            self.inotify = None
+
+    def seen(self, tier, directory):
+        # The mount looked into `directory` of a polled tier: keep an eye on
+        # it. The poll thread takes its first listing, so the lookup or
+        # readdir that got here does not pay for a scan
+        if tier not in self.polled:
+            return
+        key = (tier, directory)
+        with self.lock:
+            if key in self.listings:
+                self.listings.move_to_end(key)
+                return
+            self.listings[key] = UNLISTED
+            if len(self.listings) > self.max_polled:
+                self.listings.popitem(last=False)
+        self.fresh.set()
+
+    def _change(self, partial, tree):
+        self.invalidations += 1
+        self.on_change(partial, tree)
+
+    def _touch(self, partial):
+        self.invalidations += 1
+        self.on_touch(partial)
+
+    # inotify
+    # =======
+
+    def _watch_tree(self, tier, root, directory):
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(root, directory), WATCH_MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if not self.watch_limit_hit:
+                        log.warning("Out of inotify watches (fs.inotify.max_user_watches), polling the rest")
+                    self.watch_limit_hit = True
+                    self.polled.setdefault(tier, root)
+                    self.seen(tier, directory)
+                continue
+            with self.lock:
+                self.wds[wd] = (tier, directory)
+            try:
+                with os.scandir(os.path.join(root, directory)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(os.path.join(directory, entry.name))
+            except OSError:
+                continue
+
+    def _unwatch_tree(self, tier, directory):
+        prefix = directory + "/"
+        with self.lock:
+            gone = [wd for wd, (t, d) in self.wds.items()
+                    if t == tier and (d == directory or d.startswith(prefix))]
+            for wd in gone:
+                del self.wds[wd]
+        for wd in gone:
+            self.inotify.rm_watch(wd)
+
+    def _read_events(self):
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+        poller.register(self.wakeup[0], select.POLLIN)
+        while not self.stopping.is_set():
+            poller.poll()
+            if self.stopping.is_set():
+                return
+            # Let a burst (a copy, an unpacked archive) land before handling it
+            time.sleep(0.01)
+            self._handle(self.inotify.read())
+
+    def _handle(self, events):
+        changed = OrderedDict()
+        touched = OrderedDict()
+        roots = dict(self.watched)
+        for wd, mask, name in events:
+            self.events += 1
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: nothing cached can be trusted
+                self.overflows += 1
+                changed[''] = True
+                continue
+            with self.lock:
+                watched = self.wds.get(wd)
+                if mask & IN_IGNORED:
+                    self.wds.pop(wd, None)
+            if watched is None or not name:
+                continue
+            tier, directory = watched
+            partial = os.path.join(directory, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                changed[partial] = changed.get(partial, False) or is_dir
+                if is_dir and mask & IN_MOVED_FROM:
+                    self._unwatch_tree(tier, partial)
+                if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(tier, roots[tier], partial)
+            elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE):
+                touched[partial] = True
+        for partial, tree in changed.items():
+            self._change(partial, tree)
+        for partial in touched:
+            if partial not in changed:
+                self._touch(partial)
+
+    # Polling
+    # =======
+
+    def _list(self, root, directory):
+        # None when the directory is not there; OSError when the tier does
+        # not answer
+        listing = {}
+        try:
+            with os.scandir(os.path.join(root, directory)) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    listing[entry.name] = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return listing
+
+    def _poll(self):
+        # Every `interval` seconds all polled directories are listed again;
+        # in between, the new ones get their first listing as they come
+        due = time.monotonic() + self.interval
+        while True:
+            self.fresh.wait(max(due - time.monotonic(), 0))
+            self.fresh.clear()
+            if self.stopping.is_set():
+                return
+            everything = time.monotonic() >= due
+            if everything:
+                due = time.monotonic() + self.interval
+            with self.lock:
+                keys = [key for key, listing in self.listings.items() if everything or listing is UNLISTED]
+            for key in keys:
+                if self.stopping.is_set():
+                    return
+                tier, directory = key
+                self.polls += 1
+                try:
+                    listing = self.call(tier, self._list, self.polled[tier], directory)
+                except OSError:
+                    # The tier did not answer: the next round tries again
+                    continue
+                with self.lock:
+                    if key not in self.listings:
+                        # Dropped meanwhile: nothing to compare with
+                        continue
+                    before = self.listings[key]
+                    self.listings[key] = listing
+                if before is UNLISTED or before == listing:
+                    continue
+                if listing is None:
+                    self._change(directory, True)
+                    continue
+                before = before or {}
+                for name in set(before) | set(listing):
+                    old, new = before.get(name), listing.get(name)
+                    if old == new:
+                        continue
+                    partial = os.path.join(directory, name)
+                    if old is None or new is None or stat.S_IFMT(old[0]) != stat.S_IFMT(new[0]):
+                        self._change(partial, stat.S_ISDIR((old or new)[0]))
+                    else:
+                        self._touch(partial)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'watches': len(self.wds),
+                'polled_dirs': len(self.listings),
+                'events': self.events,
+                'polls': self.polls,
+                'invalidations': self.invalidations,
+                'overflows': self.overflows,
+                'watch_limit_hit': int(self.watch_limit_hit),
+            }
@@ -0,0 +1,104 @@
+"""
+Write-back buffer of an open handle.
+
+Writes are merged in memory into sorted, non-overlapping extents (adjacent
+and overlapping writes become one extent, later data wins) and reach the
+backing file as one pwrite per extent when the handle is flushed, fsynced or
+released, or once `max_bytes` are pending or the oldest pending write is
+`max_age` seconds old: checked on every write, and for idle handles by the
+handle table's timer (see handleTable.py). Reads on the same handle overlay
+the pending extents.
+"""
+
+import time
+
+
+class WriteBuffer:
+    def __init__(self, max_bytes=4 << 20, max_age=1.0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # [offset, bytearray], sorted by offset, never touching each other
+        self.extents = []
+        self.pending = 0
+        self.first_write = None
+
+    def add(self, offset, buf):
+        end = offset + len(buf)
+        keep = []
+        merged = []
+        for extent in self.extents:
+            start, data = extent
+            if start + len(data) < offset or start > end:
+                keep.append(extent)
+            else:
+                merged.append(extent)
+
+        if merged:
+            start = min(merged[0][0], offset)
+            stop = max(max(s + len(d) for s, d in merged), end)
+            data = bytearray(stop - start)
+            for s, d in merged:
+                data[s - start:s - start + len(d)] = d
+            data[offset - start:end - start] = buf
+        else:
+            start, data = offset, bytearray(buf)
+
+        keep.append([start, data])
+        keep.sort(key=lambda extent: extent[0])
+        self.extents = keep
+        self.pending = sum(len(d) for s, d in keep)
+        if self.first_write is None:
+            self.first_write = time.monotonic()
+
+    def should_flush(self):
+        return self.pending >= self.max_bytes or self.expired()
+
+    def expired(self):
+        # The oldest pending write is `max_age` seconds old
+        return self.first_write is not None and time.monotonic() - self.first_write >= self.max_age
+
+    def flush(self, pwrite):
+        # pwrite(data, offset) writes to the backing file, e.g. the handle's
+        while self.extents:
+            start, data = self.extents[0]
+            view = memoryview(data)
+            while view:
+                written = pwrite(view, start)
+                view = view[written:]
+                start += written
+            self.extents.pop(0)
+        self.pending = 0
+        self.first_write = None
+
+    def end(self):
+        if not self.extents:
+            return 0
+        start, data = self.extents[-1]
+        return start + len(data)
+
+    def truncate(self, length):
+        # Pending data past the new end of file must not come back on flush
+        keep = []
+        for start, data in self.extents:
+            if start < length:
+                keep.append([start, data[:length - start]])
+        self.extents = keep
+        self.pending = sum(len(d) for s, d in keep)
+
+    def overlay(self, data, offset, length):
+        # `data` is what the backing file returned for (offset, length)
+        stop = offset + length
+        covering = [(s, d) for s, d in self.extents if s < stop and s + len(d) > offset]
+        # Pending data past the end of the file on disk makes the file longer,
+        # with a hole of zeros up to it
+        visible = min(stop, self.end()) - offset
+        if not covering and len(data) >= visible:
+            return data
+        data = bytearray(data)
+        if visible > len(data):
+            data.extend(bytes(visible - len(data)))
+        for start, extent in covering:
+            lo = max(start, offset)
+            hi = min(start + len(extent), stop)
+            data[lo - offset:hi - offset] = extent[lo - start:hi - start]
+        return bytes(data)
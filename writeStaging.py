@@ -0,0 +1,339 @@
+"""
+Writes to the remote tier staged on local disk and uploaded in the background.
+
+With --stage-dir the mount does not write remote-tier files over the
+network. A file created there, or a remote file opened for writing, is
+staged: it lives under `root`/data at its virtual path, the writes land on
+local disk, and lookups, reads and listings see the staged copy. Once its
+last writer released it, the file is queued for upload:
+
+- `workers` threads upload queued files with the mount's `upload(partial,
+  staged_path)`, which writes a temporary remote file and renames it in
+  place, so the remote tier never shows half a file.
+- a failed upload is retried `retries` times with exponential backoff, then
+  left pending until the file is written again or the next mount.
+- a file written again while its upload ran is uploaded again; the staged
+  copy goes away, and `on_committed(partial)` sends lookups back to the
+  remote tier, only once the upload matches it.
+- every staged file is recorded in `root`/journal (JSON lines, fsynced)
+  before it is written, and marked done once uploaded, so the uploads
+  pending at a crash are picked up by the next mount.
+
+Renaming a staged file first uploads it (in the caller's thread), then
+renames it on the remote tier; it fails with EBUSY while the file is still
+open for writing. Unlinking one drops it from the queue.
+"""
+
+import errno
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class _Staged:
+    def __init__(self):
+        # Bumped whenever the staged copy may have changed
+        self.version = 0
+        self.writers = 0
+        self.uploading = False
+        self.attempts = 0
+
+
+class WriteStager:
+    def __init__(self, root, workers=2, retries=5, backoff=1.0):
+        self.root = root
+        self.data = os.path.join(root, 'data')
+        self.journal_path = os.path.join(root, 'journal')
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        # partial path -> _Staged
+        self.entries = {}
+        self.ready = deque()
+        # [(due, partial)] of uploads waiting to be retried
+        self.delayed = []
+        self.journal = None
+        self.upload = None
+        self.on_committed = None
+        self.uploads = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.journal_lock = threading.Lock()
+        self.threads = []
+
+    def start(self, upload, on_committed):
+        self.upload = upload
+        self.on_committed = on_committed
+        os.makedirs(self.data, exist_ok=True)
+        pending = self._recover()
+        for partial in pending:
+            self.entries[partial] = _Staged()
+            self.ready.append(partial)
+        if pending:
+            log.info("%d staged files left to upload", len(pending))
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='upload-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Uploads still queued stay in the journal for the next mount
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.journal_lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def real_path(self, partial):
+        return os.path.join(self.data, partial)
+
+    def lookup(self, partial):
+        # The staged copy of `partial`, or None
+        with self.cond:
+            if partial in self.entries:
+                return self.real_path(partial)
+        return None
+
+    def stage(self, partial, fill=None):
+        # Opens `partial` for writing in the staging area; `fill(staged_path)`
+        # writes its current content the first time. Returns the entry to
+        # hand back to released(). Callers hold the path lock of `partial`
+        with self.cond:
+            entry = self.entries.get(partial)
+            if entry is not None:
+                entry.writers += 1
+                entry.version += 1
+                return entry
+            entry = self.entries[partial] = _Staged()
+            entry.writers = 1
+        staged = self.real_path(partial)
+        try:
+            self._log({'staged': partial})
+            os.makedirs(os.path.dirname(staged), exist_ok=True)
+            if fill:
+                fill(staged)
+        except BaseException:
+            with self.cond:
+                if self.entries.get(partial) is entry:
+                    del self.entries[partial]
+                    self._remove(partial)
+            raise
+        return entry
+
+    def released(self, partial, entry):
+        # A writer of `entry` closed it; the last one queues the upload
+        with self.cond:
+            if self.entries.get(partial) is not entry:
+                # Unlinked meanwhile
+                return
+            entry.writers = max(entry.writers - 1, 0)
+            entry.version += 1
+            if entry.writers == 0 and not entry.uploading:
+                entry.attempts = 0
+                self.ready.append(partial)
+                self.cond.notify()
+
+    def changed(self, partial):
+        # The staged copy changed outside a writable handle (truncate, chmod)
+        with self.cond:
+            entry = self.entries.get(partial)
+            if entry is None:
+                return
+            entry.version += 1
+            if entry.writers == 0 and not entry.uploading:
+                self.ready.append(partial)
+                self.cond.notify()
+
+    def discard(self, partial):
+        # `partial` was unlinked: nothing to upload any more. Returns whether
+        # it was staged
+        with self.cond:
+            while partial in self.entries and self.entries[partial].uploading:
+                self.cond.wait()
+            entry = self.entries.pop(partial, None)
+            if entry is None:
+                return False
+            self._remove(partial)
+        self._log({'done': partial})
+        return True
+
+    def resume(self):
+        # The remote tier is back: uploads that gave up try again
+        with self.cond:
+            for partial, entry in self.entries.items():
+                if not entry.writers and not entry.uploading and partial not in self.ready:
+                    entry.attempts = 0
+                    self.ready.append(partial)
+            self.cond.notify_all()
+
+    def holds(self, partial):
+        # Whether anything below the directory `partial` is staged
+        prefix = partial + "/" if partial else ""
+        with self.cond:
+            return any(p.startswith(prefix) for p in self.entries)
+
+    def settle_tree(self, partial, tree=True):
+        # Uploads `partial`, and what is staged below it, now; e.g. before it
+        # is renamed
+        prefix = partial + "/" if partial else ""
+        while True:
+            with self.cond:
+                staged = [p for p in self.entries if p == partial or (tree and p.startswith(prefix))]
+                if not staged:
+                    return
+                target = staged[0]
+                entry = self.entries[target]
+                if entry.writers:
+                    raise OSError(errno.EBUSY, "still open for writing", target)
+                if entry.uploading:
+                    self.cond.wait()
+                    continue
+                entry.uploading = True
+                version = entry.version
+            if not self._upload(target, version):
+                raise OSError(errno.EIO, "upload failed", target)
+
+    def _run(self):
+        while True:
+            partial = self._next()
+            if partial is None:
+                return
+            with self.cond:
+                entry = self.entries.get(partial)
+                if entry is None or entry.writers or entry.uploading:
+                    continue
+                entry.uploading = True
+                version = entry.version
+            self._upload(partial, version)
+
+    def _next(self):
+        with self.cond:
+            while True:
+                if self.stopping:
+                    return None
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.ready.append(heapq.heappop(self.delayed)[1])
+                if self.ready:
+                    return self.ready.popleft()
+                self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _upload(self, partial, version):
+        # One attempt; returns whether it reached the remote tier
+        staged = self.real_path(partial)
+        try:
+            size = os.path.getsize(staged)
+            self.upload(partial, staged)
+        except OSError as e:
+            with self.cond:
+                entry = self.entries[partial]
+                entry.uploading = False
+                entry.attempts += 1
+                self.failures += 1
+                if entry.attempts <= self.retries and not entry.writers:
+                    delay = self.backoff * 2 ** (entry.attempts - 1)
+                    heapq.heappush(self.delayed, (time.monotonic() + delay, partial))
+                    self.cond.notify()
+                    log.warning("Uploading %s failed (%s), retrying in %.1fs", partial, e, delay)
+                else:
+                    log.error("Uploading %s failed (%s), left staged", partial, e)
+                self.cond.notify_all()
+            return False
+        with self.cond:
+            entry = self.entries[partial]
+            entry.uploading = False
+            self.uploads += 1
+            self.bytes_uploaded += size
+            done = entry.version == version and not entry.writers
+            if done:
+                # Removed under the lock, so a writer staging it again gets
+                # a fresh copy
+                del self.entries[partial]
+                self._remove(partial)
+            elif not entry.writers:
+                # Written again meanwhile
+                self.ready.append(partial)
+            self.cond.notify_all()
+        if done:
+            self._log({'done': partial})
+            self.on_committed(partial)
+        return True
+
+    def _remove(self, partial):
+        # The staged copy, and the staging directories it leaves empty
+        try:
+            os.unlink(self.real_path(partial))
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(partial)
+        while directory:
+            try:
+                os.rmdir(os.path.join(self.data, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def _log(self, record):
+        with self.journal_lock:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def _recover(self):
+        # Staged files the journal says were not uploaded yet; compacts it
+        pending = set()
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The write a crash cut short
+                        continue
+                    if 'staged' in record:
+                        pending.add(record['staged'])
+                    elif 'done' in record:
+                        pending.discard(record['done'])
+        except FileNotFoundError:
+            pass
+        pending = sorted(p for p in pending if os.path.isfile(self.real_path(p)))
+        # Anything else in the staging area was uploaded before the crash
+        for directory, _, files in os.walk(self.data, topdown=False):
+            for name in files:
+                partial = os.path.relpath(os.path.join(directory, name), self.data)
+                if partial not in pending:
+                    self._remove(partial)
+        tmp = self.journal_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for partial in pending:
+                f.write(json.dumps({'staged': partial}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+        return pending
+
+    def stats(self):
+        with self.cond:
+            return {
+                'staged': len(self.entries),
+                'queued': len(self.ready),
+                'retrying': len(self.delayed),
+                'uploads': self.uploads,
+                'failures': self.failures,
+                'bytes_uploaded': self.bytes_uploaded,
+            }